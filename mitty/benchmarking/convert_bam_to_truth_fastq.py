@@ -1,9 +1,12 @@
 import io
+import os
 import time
 
 import click
 import pysam
 
+import mitty.lib.truth as truth
+
 import logging
 logger = logging.getLogger(__name__)
 
@@ -12,9 +15,10 @@ logger = logging.getLogger(__name__)
 @click.argument('inbam', type=click.Path(exists=True))
 @click.argument('fastq', type=click.Path())
 @click.option('--mq-threshold', type=click.IntRange(min=0, max=255), help='Skip reads below this threshold', default=0)
+@click.option('--compact-qnames', is_flag=True, help='Write the read serial as qname and the truth to a sidecar (.truth.h5)')
 @click.option('-v', count=True, help='Verbosity level')
 @click.option('-p', is_flag=True, help='Show progress bar')
-def cli(inbam, fastq, mq_threshold, v, p):
+def cli(inbam, fastq, mq_threshold, compact_qnames, v, p):
   """This consumes a BAM, treats it as a truth dataset and writes out all the mapped reads."""
   level = logging.DEBUG if v > 0 else logging.WARNING
   logging.basicConfig(level=level)
@@ -25,24 +29,29 @@ def cli(inbam, fastq, mq_threshold, v, p):
 
   cnt, rs = 0, 0
   t0 = time.time()
+  truth_writer = truth.TruthWriter(os.path.splitext(fastq)[0] + '.truth.h5', paired=True) if compact_qnames else None
   with click.progressbar(length=total_read_count, label='Processing BAM',
                          file=None if p else io.BytesIO()) as bar, open(fastq, 'w') as fastq_out_fp:
     for cnt, rs in process_file(bam_in_fp=bam_in_fp, fastq_out_fp=fastq_out_fp,
                                 mq_threshold=mq_threshold,
-                                progress_bar_update_interval=progress_bar_update_interval):
+                                progress_bar_update_interval=progress_bar_update_interval,
+                                truth_writer=truth_writer):
       bar.update(progress_bar_update_interval)
+  if truth_writer is not None:
+    truth_writer.close()
   t1 = time.time()
   logger.debug('Analyzed {:d} reads in {:2.2f}s. Wrote out {:d} templates'.format(cnt, t1 - t0, rs))
 
 
 
-def process_file(bam_in_fp, fastq_out_fp, mq_threshold, progress_bar_update_interval=100):
+def process_file(bam_in_fp, fastq_out_fp, mq_threshold, progress_bar_update_interval=100, truth_writer=None):
   """Main processing function that goes through the bam file, analyzing read alignment and writing out
 
   :param bam_in_fp:  Pointer to original BAM
   :param fastq_out_fp: Pointer to file to be written
   :param mq_threshold: Pointer to PERBAM being created
   :param progress_bar_update_interval: how many reads to process before yielding (to update progress bar as needed)
+  :param truth_writer: lib.truth.TruthWriter (paired) for compact qnames. None to put the truth in the qnames
   :return: number of reads processed
   """
   n0 = progress_bar_update_interval
@@ -64,28 +73,35 @@ def process_file(bam_in_fp, fastq_out_fp, mq_threshold, progress_bar_update_inte
       if read.qname in read_cache:  # Yay we found the mate
         read2 = read_cache.pop(read.qname)
         if read.mapping_quality >= mq_threshold and read2.mapping_quality >= mq_threshold:
-          read_serial = flush_reads([read, read2], fastq_out_fp, read_serial)
+          read_serial = flush_reads([read, read2], fastq_out_fp, read_serial, truth_writer)
       else:
         read_cache[read.qname] = read
     else:
       if read.mapping_quality >= mq_threshold:
-        read_serial = flush_reads([read], fastq_out_fp, read_serial)
+        read_serial = flush_reads([read], fastq_out_fp, read_serial, truth_writer)
 
   yield tot_read_cnt + 1, read_serial  # tot_read_cnt starts from 0 actually ...
 
 
-def flush_reads(read_l, fastq_out_fp, read_serial):
+def flush_reads(read_l, fastq_out_fp, read_serial, truth_writer=None):
   """Write out reads to a fastq file.
-  qname is 'read_serial|chrom|copy|ro|pos|rlen|cigar|ro|pos|rlen|cigar'
+  qname is 'read_serial|chrom|copy|ro|pos|rlen|cigar|ro|pos|rlen|cigar', or just 'read_serial' with a truth_writer
 
   :param read_l:
   :param fastq_out_fp:
   :param read_serial:
+  :param truth_writer: lib.truth.TruthWriter (paired) to put the truth in, in place of the qname
   :return: read_serial, updated
   """
-  qname = '|'.join([str(read_serial), str(read_l[0].reference_id + 1), '0'])
-  for ro, r in enumerate(read_l):
-    qname += '|'.join([str(ro), str(r.pos), str(r.query_length), r.cigarstring])
+  if truth_writer is not None:
+    qname = str(read_serial)
+    rows = read_l + read_l[:1] * (2 - len(read_l))  # Two rows for each template, even for an unpaired read
+    truth_writer.append(read_l[0].reference_id + 1, 0, range(len(rows)), [r.pos for r in rows],
+                        [r.query_length for r in rows], [r.cigarstring for r in rows])
+  else:
+    qname = '|'.join([str(read_serial), str(read_l[0].reference_id + 1), '0'])
+    for ro, r in enumerate(read_l):
+      qname += '|'.join([str(ro), str(r.pos), str(r.query_length), r.cigarstring])
 
   for n, r in enumerate(read_l):
     fastq_out_fp.write('@' + qname + ('/' + str(n + 1) if len(read_l) > 0 else '') + '\n'
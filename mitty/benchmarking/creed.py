@@ -1,6 +1,6 @@
 """Functions to categorize reads for further analysis."""
 import sqlite3 as sq
-from itertools import izip
+from itertools import izip, islice
 import array
 import re
 
@@ -14,11 +14,13 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def analyze_read(read, window=100, extended=False):
+def analyze_read(read, window=100, extended=False, truth=None):
   """Given a read process the qname and read properties to determine the correct (CHROM, POS, CIGAR) and determine
   what kind of alignment errors were made on it
 
   :param read: a psyam AlignedSegment object
+  :param truth: for reads with compact qnames, the truth for the read as given by read_truth. If None, the truth is
+                taken from the qname
   :returns read_serial, chrom, cpy, ro, pos, cigar, chrom_c, pos_c, cigar_c, unmapped, t_start, t_end
 
   read_serial = read_serial * 10 + 0 or 1 (for mate1 or mate2 of read) for paired reads
@@ -33,23 +35,26 @@ def analyze_read(read, window=100, extended=False):
   if read.is_secondary:
     return early_exit_value
 
-  ro_m, pos_m, rl_m, cigar_m = 0, 0, 0, ''  # These are the values passed in for unpaired reads
-  # We should never actually fail this, unless a tool messes badly with the qname
-  try:
-    #  'read_serial|chrom|copy|ro|pos|rlen|cigar|ro|pos|rlen|cigar'
-    if read.is_paired:
-      if read.is_read1:
-        rs, chrom, cpy, ro, pos, rl, cigar, ro_m, pos_m, rl_m, cigar_m = read.qname.split('|')
+  if truth is not None:
+    read_serial, chrom, cpy, ro, pos, rl, cigar, ro_m, pos_m, rl_m, cigar_m = truth
+  else:
+    ro_m, pos_m, rl_m, cigar_m = 0, 0, 0, ''  # These are the values passed in for unpaired reads
+    # We should never actually fail this, unless a tool messes badly with the qname
+    try:
+      #  'read_serial|chrom|copy|ro|pos|rlen|cigar|ro|pos|rlen|cigar'
+      if read.is_paired:
+        if read.is_read1:
+          rs, chrom, cpy, ro, pos, rl, cigar, ro_m, pos_m, rl_m, cigar_m = read.qname.split('|')
+        else:
+          rs, chrom, cpy, ro_m, pos_m, rl_m, cigar_m, ro, pos, rl, cigar = read.qname.split('|')
+        read_serial = int(rs) * 10 + (not read.is_read1)
       else:
-        rs, chrom, cpy, ro_m, pos_m, rl_m, cigar_m, ro, pos, rl, cigar = read.qname.split('|')
-      read_serial = int(rs) * 10 + (not read.is_read1)
-    else:
-      rs, chrom, cpy, ro, pos, rl, cigar = read.qname.split('|')[:9]
-      read_serial = int(rs)
-    ro, chrom, cpy, pos, rl, pos_m, rl_m = int(ro), int(chrom), int(cpy), int(pos), int(rl), int(pos_m), int(rl_m)
-  except ValueError:
-    logger.debug('Error processing qname: qname={:s}, chrom={:d}, pos={:d}'.format(read.qname, read.reference_id + 1, read.pos))
-    return early_exit_value
+        rs, chrom, cpy, ro, pos, rl, cigar = read.qname.split('|')[:9]
+        read_serial = int(rs)
+      ro, chrom, cpy, pos, rl, pos_m, rl_m = int(ro), int(chrom), int(cpy), int(pos), int(rl), int(pos_m), int(rl_m)
+    except ValueError:
+      logger.debug('Error processing qname: qname={:s}, chrom={:d}, pos={:d}'.format(read.qname, read.reference_id + 1, read.pos))
+      return early_exit_value
 
   chrom_c, pos_c, cigar_c, unmapped = 1, 1, 1, 0
 
@@ -71,6 +76,56 @@ def analyze_read(read, window=100, extended=False):
   return read_serial, chrom, cpy, ro, pos, rl, cigar, ro_m, pos_m, rl_m, cigar_m, chrom_c, pos_c, cigar_c, unmapped
 
 
+def read_truth(reads, truth_reader):
+  """Look up the truth for a batch of reads with compact qnames (the qname is the read serial) in one go
+
+  :param reads: list of pysam AlignedSegment objects
+  :param truth_reader: lib.truth.TruthReader for the sidecar written with the reads
+  :returns list with, for each read, the truth tuple analyze_read takes. None if the qname is not a serial we know
+  """
+  serial = np.empty(len(reads), dtype=np.int64)
+  for n, read in enumerate(reads):
+    try:
+      serial[n] = int(read.qname)
+    except ValueError:
+      logger.debug('Error processing qname: qname={:s}'.format(read.qname))
+      serial[n] = -1
+  paired = np.array([read.is_paired for read in reads], dtype=bool)
+  mate = np.array([not read.is_read1 for read in reads], dtype=np.int64) * paired
+  rows, mate_rows = truth_reader.get_rows(serial, mate), truth_reader.get_rows(serial, 1 - mate)
+  valid = (serial >= 0) & (rows < len(truth_reader)) & (~paired | (mate_rows < len(truth_reader)))
+  truth = [None] * len(reads)
+  idx = valid.nonzero()[0]
+  t, cigar = truth_reader.lookup(rows[idx])
+  t_m, cigar_m = truth_reader.lookup(np.where(paired[idx], mate_rows[idx], rows[idx]))
+  read_serial = np.where(paired[idx], serial[idx] * 10 + mate[idx], serial[idx])
+  for n, rs, chrom, cpy, ro, pos, rl, cig, p, ro_m, pos_m, rl_m, cig_m in izip(
+          idx.tolist(), read_serial.tolist(), t['chrom'].tolist(), t['cpy'].tolist(), t['ro'].tolist(),
+          t['pos'].tolist(), t['rlen'].tolist(), cigar, paired[idx].tolist(),
+          t_m['ro'].tolist(), t_m['pos'].tolist(), t_m['rlen'].tolist(), cigar_m):
+    truth[n] = (rs, chrom, cpy, ro, pos, rl, cig) + ((ro_m, pos_m, rl_m, cig_m) if p else (0, 0, 0, ''))
+  return truth
+
+
+def analyze_reads(reads, window=100, extended=False, truth_reader=None, batch_size=10000):
+  """analyze_read over a stream of reads. With compact qnames the truth for each batch of reads is looked up from the
+  sidecar in one go
+
+  :param reads: iterable of pysam AlignedSegment objects, e.g. an open BAM file
+  :param truth_reader: lib.truth.TruthReader. None if the truth is in the qnames
+  :param batch_size: reads per sidecar lookup
+  :returns generator of (read, analysis). analysis is as returned by analyze_read
+  """
+  reads = iter(reads)
+  if truth_reader is None:
+    for read in reads:
+      yield read, analyze_read(read, window, extended)
+    return
+  for batch in iter(lambda: list(islice(reads, batch_size)), []):
+    for read, truth in izip(batch, read_truth(batch, truth_reader)):
+      yield read, analyze_read(read, window, extended, truth) if truth is not None else [None] * 15
+
+
 # TODO: Revise algorithm to properly work with reads inside long insertions
 cigar_parser = re.compile(r'(\d+)(\D)')
 def check_read(read_pos, read_cigar, correct_pos, correct_cigar, window):
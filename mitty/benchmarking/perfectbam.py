@@ -23,6 +23,7 @@ import click
 from mitty.version import __version__
 import mitty.benchmarking.creed as creed
 import mitty.lib.mio as mio  # For the bam sort and index function
+import mitty.lib.truth as truth_lib
 from mitty.lib import DNA_complement
 from string import translate
 
@@ -56,7 +57,7 @@ def print_tags(ctx, param, value):
 
 def process_file(bam_in_fp, bad_bam_fp=None, per_bam_fp=None, full_perfect_bam=False, window=0, extended=False,
                  flag_cigar_errors_as_misalignments=False,
-                 progress_bar_update_interval=100):
+                 progress_bar_update_interval=100, truth_reader=None):
   """Main processing function that goes through the bam file, analyzing read alignment and writing out
 
   :param bam_in_fp:  Pointer to original BAM
@@ -67,14 +68,14 @@ def process_file(bam_in_fp, bad_bam_fp=None, per_bam_fp=None, full_perfect_bam=F
   :param extended:   If True write out new style CIGARs (With '=' and 'X')
   :param flag_cigar_errors_as_misalignments: Set to True if we want CIGAR errors to count as misalignments
   :param progress_bar_update_interval: how many reads to process before yielding (to update progress bar as needed)
+  :param truth_reader: lib.truth.TruthReader if the reads have compact qnames
   :return: number of reads processed
   """
   n0 = progress_bar_update_interval
-  analyze_read = creed.analyze_read
   mis_read_cnt = 0
-  for tot_read_cnt, read in enumerate(bam_in_fp):
+  for tot_read_cnt, (read, analysis) in enumerate(creed.analyze_reads(bam_in_fp, window, extended, truth_reader)):
     read_serial, chrom, cpy, ro, pos, rl, cigar, ro_m, pos_m, rl_m, cigar_m, chrom_c, pos_c, cigar_c, read_is_unmapped \
-      = analyze_read(read, window, extended)
+      = analysis
     if read_serial is None: continue  # Something wrong with this read.
     read_is_misaligned = not (chrom_c and pos_c and (cigar_c or (not flag_cigar_errors_as_misalignments)))
     if read_is_misaligned or full_perfect_bam:  # Need all the read info, incl seq and quality
@@ -154,9 +155,10 @@ def sort_and_index_bams(bad_bam_fname, per_bam_fname):
 @click.option('--window', help='Size of tolerance window', default=0, type=int)
 @click.option('-x', is_flag=True, help='Use extended CIGAR ("X"s and "="s) rather than traditional CIGAR (just "M"s)')
 @click.option('--no-index', is_flag=True, help="Mostly for the platform: Don't sort and index the output files")
+@click.option('--truth', type=click.Path(exists=True), help='Truth sidecar (.truth.h5), for reads with compact qnames')
 @click.option('-v', count=True, help='Verbosity level')
 @click.option('-p', is_flag=True, help='Show progress bar')
-def cli(inbam, bad_bam, per_bam, cigar_errors, perfect_bam, window, x, no_index, v, p):
+def cli(inbam, bad_bam, per_bam, cigar_errors, perfect_bam, window, x, no_index, truth, v, p):
   """Analyse BAMs produced from Mitty generated FASTQs for alignment accuracy.
   Produces two BAM files with reads having correct POS, CIGAR values. The original
   alignment information is written in the extended tags (use --tags for documentation)
@@ -210,7 +212,8 @@ def cli(inbam, bad_bam, per_bam, cigar_errors, perfect_bam, window, x, no_index,
     for cnt, mis in process_file(bam_in_fp=bam_in_fp, bad_bam_fp=bad_bam_fp, per_bam_fp=per_bam_fp,
                                  full_perfect_bam=perfect_bam, window=window,
                                  flag_cigar_errors_as_misalignments=cigar_errors, extended=x,
-                                 progress_bar_update_interval=progress_bar_update_interval):
+                                 progress_bar_update_interval=progress_bar_update_interval,
+                                 truth_reader=truth_lib.TruthReader(truth) if truth else None):
       bar.update(progress_bar_update_interval)
   t1 = time.time()
   logger.debug('Analyzed {:d} reads in {:2.2f}s. Found {:d} ({:2.2f}%) mis-aligned reads'.format(cnt, t1 - t0, mis, (100.0 * mis) / cnt))
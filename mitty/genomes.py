@@ -2,17 +2,21 @@
 import json
 import os
 import time
+import multiprocessing
 import io
+import hashlib
 from itertools import izip
 
 import click
 import numpy as np
+import h5py
 
 import mitty.lib
 import mitty.lib.util as mutil
 import mitty.lib.mio as mio
 import mitty.lib.variants as vr
 import mitty.lib.vcf2pop as vp
+from mitty.version import __version__
 
 import logging
 logger = logging.getLogger(__name__)
@@ -25,7 +29,9 @@ __param__ = """Parameter file example::
     "files": {
       "reference_dir": "/Users/kghose/Data/hg38/",  # If reference is chr1.fa, chr2.fa ... in this directory
       "reference_file": "/Users/kghose/Data/hg38/hg38.fa.gz",  # If reference is a single gz fasta file
-      "dbfile": "Out/test.db"  # Output database file
+      "dbfile": "Out/test.db",  # Output database file
+      "master_list_cache": "Cache/"  # Optional. Reuse master lists from earlier runs with the same reference,
+                                     # variant models, site model and seed
     },
     "rng": {
       "master_seed": 1
@@ -62,13 +68,17 @@ __param__ = """Parameter file example::
 
 class PopulationSimulator:
   """A convenience class that wraps the parameters and settings for a population simulation"""
-  def __init__(self, base_dir, params, ref_file=None, db_file=None):
+  def __init__(self, base_dir, params, ref_file=None, db_file=None, queue_depth=None, ml_cache_dir=None):
     """Create a genome simulation object
 
     :param base_dir: the directory with respect to which relative file paths will be resolved
     :param params: dict loaded from json file
     :param ref_file: Override for ref file
     :param db_file: Override for db file
+    :param queue_depth: number of samples that can wait to be written out by the background writer process.
+                        0 means we write out samples ourselves. None means 4 if we have more than one CPU, else 0.
+                        Call close() when done in any case
+    :param ml_cache_dir: Override for master list cache directory
     """
     pop_db_name = db_file or mitty.lib.rpath(base_dir, params['files']['dbfile'])
     if os.path.exists(pop_db_name):
@@ -88,8 +98,18 @@ class PopulationSimulator:
     assert 0 < master_seed < mitty.lib.SEED_MAX
 
     self.seed_rng = np.random.RandomState(seed=master_seed)
-    self.pop = vr.Population(fname=pop_db_name, mode='w', in_memory=False,
-                             genome_metadata=self.ref.get_seq_metadata())
+    if queue_depth is None:
+      queue_depth = 4 if multiprocessing.cpu_count() > 1 else 0  # With one CPU the writer process only adds overhead
+    self.pop = vr.PopulationWriter(fname=pop_db_name, genome_metadata=self.ref.get_seq_metadata(),
+                                   queue_depth=queue_depth) if queue_depth > 0 else \
+      vr.Population(fname=pop_db_name, mode='w', in_memory=False, genome_metadata=self.ref.get_seq_metadata())
+
+    self.ml_cache_dir = ml_cache_dir or mitty.lib.rpath(base_dir, params['files'].get('master_list_cache', None))
+    if self.ml_cache_dir is not None and not os.path.exists(self.ml_cache_dir):
+      os.makedirs(self.ml_cache_dir)
+    # Everything apart from the reference and the seeds that goes into making a master list
+    self.ml_cache_params = {'variant_models': params['variant_models'], 'site_model': params.get('site_model', None)}
+    self.ml_cache_hits = 0
 
     self.sfs_model = load_site_frequency_model(params.get('site_model', None))
     self.sfs_p, self.sfs_f = self.sfs_model.get_spectrum() if self.sfs_model is not None else (None, None)
@@ -97,27 +117,89 @@ class PopulationSimulator:
     self.population_model = load_population_model(params.get('population_model', None), params)
 
     self.unique_variant_count, self.total_variant_count = 0, 0
+    self.pedigree_saved = False
 
   def get_chromosome_list(self):
     return self.chromosomes
 
+  def close(self):
+    """Finish writing out the genome file.
+
+    :return: dict of background writer stats (empty if we wrote the file ourselves)
+    """
+    return self.pop.close() or {}
+
   def get_total_blocks_to_do(self):
     return len(self.chromosomes) * self.population_model.get_sample_count_estimate()
 
-  def generate_and_save_samples(self, chrom):
+  def generate_master_list(self, chrom):
+    """Create the master list for this chromosome or load it from the cache, if we have made it before"""
+    seeds = [self.seed_rng.randint(mutil.SEED_MAX) for _ in self.variant_models]  # Drawn even if we hit the cache
+    if self.ml_cache_dir is not None:
+      cache_fname = os.path.join(self.ml_cache_dir, 'ml-{:s}.h5'.format(master_list_cache_key(
+        self.ref.get_seq_metadata()[chrom - 1]['seq_md5'], self.ml_cache_params, seeds)))
+      if os.path.exists(cache_fname):
+        logger.debug('Loading master list for chrom {:d} from {:s}'.format(chrom, cache_fname))
+        self.ml_cache_hits += 1
+        return load_master_list(cache_fname)
+
     ml = vr.VariantList()
-    for m in self.variant_models:
+    for m, seed in zip(self.variant_models, seeds):
       ml.add(*m.get_variants(ref=self.ref[chrom]['seq'], chrom=chrom,
                              p=self.sfs_p, f=self.sfs_f,
-                             seed=self.seed_rng.randint(mutil.SEED_MAX)))
+                             seed=seed))
     ml.sort()
     if self.sfs_model is not None: ml.balance_probabilities(*self.sfs_model.get_spectrum())
+    if self.ml_cache_dir is not None:
+      save_master_list(cache_fname, ml)
+    return ml
+
+  def generate_and_save_samples(self, chrom):
+    ml = self.generate_master_list(chrom)
     self.pop.set_master_list(chrom=chrom, master_list=ml)
     self.unique_variant_count += len(ml)
+    # Models that produce closely related samples can tell us which earlier sample to delta encode each sample against
+    parent_sample = getattr(self.population_model, 'parent_sample', lambda sample_name: None)
     for sample_name, this_sample, frac_done in self.population_model.samples(chrom_no=chrom, ml=ml, rng_seed=self.seed_rng.randint(mutil.SEED_MAX)):
-      self.pop.add_sample_chromosome(chrom=chrom, sample_name=sample_name, indexes=this_sample)
+      self.pop.add_sample_chromosome(chrom=chrom, sample_name=sample_name, indexes=this_sample,
+                                     parent=parent_sample(sample_name))
       self.total_variant_count += len(this_sample)
       yield
+    if not self.pedigree_saved and hasattr(self.population_model, 'get_pedigree'):
+      pedigree = self.population_model.get_pedigree()  # Models that simulate families give us a family tree
+      if pedigree:
+        self.pop.set_pedigree(pedigree)
+        self.pedigree_saved = True
+
+
+def master_list_cache_key(seq_md5, model_params, seeds):
+  """Hash of everything that determines a master list
+
+  :param seq_md5: md5 of the chromosome sequence
+  :param model_params: dict with the variant and site model parameter json
+  :param seeds: seeds passed to the variant models for this chromosome
+  :return: hex digest
+  """
+  return hashlib.sha1(json.dumps({'seq_md5': seq_md5, 'models': model_params, 'seeds': [int(s) for s in seeds],
+                                  'mitty': __version__},  # The models may change between versions
+                                 sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+def save_master_list(fname, ml):
+  """Save the master list to a cache file. We write to a temporary file first so that an interrupted run does not
+  leave a broken cache entry"""
+  tmp_fname = fname + '.{:d}.tmp'.format(os.getpid())
+  with h5py.File(tmp_fname, 'w') as fp:
+    fp.create_dataset('master_list', shape=ml.variants.shape, dtype=vr.Population.ml_dt, data=ml.variants,
+                      chunks=True, compression='gzip')
+  os.rename(tmp_fname, fname)
+
+
+def load_master_list(fname):
+  with h5py.File(fname, 'r') as fp:
+    ml = vr.VariantList()
+    ml.variants, ml.sorted = fp['master_list'][:], True
+  return ml
 
 
 def load_site_frequency_model(sfs_model_json):
@@ -161,9 +243,11 @@ def cli():
 @click.option('--ref', type=click.Path(exists=True), help="Use this path for reference file. Over-rides entry in parameter file")
 @click.option('--db', type=click.Path(), help="Use this path for output file. Over-rides entry in parameter file")
 @click.option('--dry-run', is_flag=True, help="Print useful information about simulation, but don't run")
+@click.option('--queue-depth', type=int, help='Samples that can wait for the background writer. 0 to write in the foreground. Default 4 (0 on single CPU machines)')
+@click.option('--ml-cache', type=click.Path(), help="Master list cache directory. Over-rides entry in parameter file")
 @click.option('-v', count=True, help='Verbosity level')
 @click.option('-p', is_flag=True, help='Show progress bar')
-def generate(param_fname, ref, db, dry_run, v, p):
+def generate(param_fname, ref, db, dry_run, queue_depth, ml_cache, v, p):
   """Generate population of genomes"""
   level = logging.DEBUG if v > 1 else logging.WARNING
   logging.basicConfig(level=level)
@@ -177,15 +261,23 @@ def generate(param_fname, ref, db, dry_run, v, p):
     do_dry_run(params)
     return
 
-  simulation = PopulationSimulator(base_dir, params, ref_file=ref, db_file=db)
+  simulation = PopulationSimulator(base_dir, params, ref_file=ref, db_file=db, queue_depth=queue_depth,
+                                   ml_cache_dir=ml_cache)
   t0 = time.time()
   with click.progressbar(length=simulation.get_total_blocks_to_do(), label='Generating genomes', file=None if p else io.BytesIO()) as bar:
     for chrom in simulation.get_chromosome_list():
       for _ in simulation.generate_and_save_samples(chrom):
         bar.update(1)
+  writer_stats = simulation.close()
   t1 = time.time()
+  if writer_stats:
+    logger.debug('Writer: {items:d} items, queue depth max {max_queue_depth:d} mean {mean_queue_depth:.1f}, '
+                 'generator stalled {producer_stall_s:.2f}s, writer busy {writer_busy_s:.2f}s '
+                 'idle {writer_idle_s:.2f}s'.format(**writer_stats))
   logger.debug('Took {:f}s'.format(t1 - t0))
   logger.debug('{:d} unique variants, {:d} variants in samples'.format(simulation.unique_variant_count, simulation.total_variant_count))
+  if simulation.ml_cache_dir is not None:
+    logger.debug('{:d} master lists loaded from cache'.format(simulation.ml_cache_hits))
 
 
 @cli.command('from-vcf')
@@ -261,6 +353,14 @@ def list_samples(dbfile):
   print(vr.Population(fname=dbfile).get_sample_names())
 
 
+@g_file.command('pedigree')
+@click.argument('dbfile', type=click.Path(exists=True))
+def print_pedigree(dbfile):
+  """Print family tree of samples (sample, father, mother)"""
+  for sample_name, father, mother in vr.Population(fname=dbfile).get_pedigree():
+    print('{:s}\t{:s}\t{:s}'.format(sample_name, father or '.', mother or '.'))
+
+
 @g_file.command('sfs')
 @click.argument('dbfile', type=click.Path(exists=True))
 @click.argument('chrom', type=int)
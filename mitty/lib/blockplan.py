@@ -0,0 +1,133 @@
+"""Plan the block sizes of a read simulation to fit a memory budget.
+
+A block of reads lives in memory while it goes through the stages of the read pipeline (sample -> cigars -> bam ->
+format -> compress -> write) and while it waits in the queues between them. Its size at each point is close to linear in
+the number of reads, so we estimate the bytes per read at each point from the read length, corruption and output
+settings. With every stage busy and every queue full - what happens when writing out is the slow part - the reads of a
+block cost `working + depth * queued` bytes each, and we cut each chromosome into as many blocks as it takes for this to
+fit in what is left of the budget after the fixed costs (interpreter and libraries, reference and expanded sequences).
+A share of the budget is held back for memory Python has freed but not handed back.
+
+The per read costs were measured on CPython 2.7 (64 bit) for reads of 100 bases and come out as
+  sampled reads   40 + read_len per read column (perfect, corrupted) - the columns of a ReadBatch
+  sampling        read_len per read column, released once sampling is done
+  POS and CIGARs  60 per set of CIGARs (the truth BAM gets a second, old style, set)
+  FASTQ text      2 * read_len + qname + 8 per output stream, plus one more stream's worth while it is copied out
+  BGZF blocks     about a third of the FASTQ text. The compress stage holds on to about twice the FASTQ text it is
+                  given: zlib's many small allocations leave the text of the block before in the heap
+  SAM text        2 * read_len + qname + 60 per BAM, made and dropped in the bam stage
+The template length does not come in: the number of reads for a given coverage depends only on the read length.
+"""
+import math
+import re
+import resource
+import sys
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_MEM_SUFFIX = {'': 1 << 20, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+MIN_BLOCK_BYTES = 1 << 22  # We do not plan blocks smaller than this, even if the budget is too small
+HEADROOM = 0.25  # Share of the budget left for freed memory the allocator holds on to, as the arenas fragment
+
+
+def parse_mem(text):
+  """Convert a memory size like '4G', '512M' or '1.5g' to bytes. A plain number is in MB, like --queue-mem"""
+  m = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*([KMGT]?)B?\s*$', str(text), re.IGNORECASE)
+  if m is None:
+    raise ValueError('Can not understand memory size "{:s}". Use e.g. 4G or 512M'.format(str(text)))
+  return int(float(m.group(1)) * _MEM_SUFFIX[m.group(2).upper()])
+
+
+def peak_rss():
+  """Peak resident set size of this process, in bytes"""
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss if sys.platform == 'darwin' else rss * 1024  # Linux gives KB
+
+
+def read_cost(read_len, corrupt=False, qname_len=50, truth_bam=False, unaligned_bam=False, gzipped=False, workers=1):
+  """Estimated bytes per read of a block as it goes through the read pipeline
+
+  :param read_len: read length
+  :param corrupt: True if we also make (and write out) corrupted reads
+  :param qname_len: average length of the qnames
+  :param truth_bam: True if we write a truth BAM (needs a second set of CIGARs)
+  :param unaligned_bam: True if we write an unaligned BAM
+  :param gzipped: True if the FASTQ is compressed
+  :param workers: number of worker processes generating blocks (expand, sample and cigars)
+  :return: (working, queued). working is the sum over the stages of what a stage holds while it works on the block,
+           queued the sum over the queues of what the block takes while waiting after a stage
+  """
+  streams = 2 if corrupt else 1
+  sampled = 40 + read_len * streams
+  sampling = read_len * streams
+  cigars = sampled + 60 * (2 if truth_bam else 1)
+  fastq_stream = 2 * read_len + qname_len + 8
+  fastq = fastq_stream * streams
+  bgzf = fastq / 3 if gzipped else 0
+  n_bams = int(truth_bam) + int(unaligned_bam)
+
+  if workers <= 1:
+    # (working, queued after) for expand, sample and cigars
+    stages = [(0, 0), (sampled + sampling, sampled), (cigars, cigars)]
+  else:
+    # Each worker makes one block, and we keep up to two more per worker waiting for the output stages
+    stages = [(workers * (cigars + sampling) + 2 * workers * cigars, cigars)]
+  if n_bams:
+    stages.append((cigars + (2 * read_len + qname_len + 60) * n_bams, cigars))
+  stages.append((cigars + fastq + fastq_stream, fastq))
+  if gzipped:
+    stages.append((2 * fastq + bgzf, bgzf))
+  stages.append((bgzf or fastq, 0))
+  return sum(w for w, _ in stages), sum(q for _, q in stages)
+
+
+class BlockPlan:
+  """Block counts for each chromosome, chosen to fit a memory budget, and the peak RSS we expect from them"""
+  def __init__(self, max_mem, reads_per_copy, cost, depth=2, fixed=0, baseline=None, min_blocks=None):
+    """
+    :param max_mem:        memory budget in bytes
+    :param reads_per_copy: dict chrom -> number of reads we expect from each copy of the chromosome
+    :param cost:           (working, queued) bytes per read, as returned by read_cost
+    :param depth:          number of blocks waiting between two stages of the pipeline
+    :param fixed:          bytes taken up whatever the block size, e.g. reference and expanded sequences
+    :param baseline:       bytes taken up before we start (interpreter, libraries). Defaults to our peak RSS now.
+                           Worker processes start as copies of us, so count it once for each process
+    :param min_blocks:     optional dict chrom -> smallest number of blocks we should use
+    """
+    self.max_mem, self.fixed = max_mem, fixed
+    self.baseline = peak_rss() if baseline is None else baseline
+    working, queued = cost
+    per_read = working + depth * queued
+    budget = (max_mem - self.baseline - fixed) * (1 - HEADROOM)
+    if budget < MIN_BLOCK_BYTES * per_read / working:
+      logger.warning('Memory budget of {:d} MB is too small: {:d} MB are taken up before reads are generated. '
+                     'Using the smallest blocks we can'.format(max_mem >> 20, (self.baseline + fixed) >> 20))
+      budget = MIN_BLOCK_BYTES * per_read / float(working)
+    # The queues get their share of the budget as a cap (--queue-mem), in case our estimates are off
+    self.queue_mem = int(budget * depth * queued / per_read)
+    self.blocks, self.block_bytes, self.predicted_rss = {}, {}, {}
+    for chrom, n_reads in reads_per_copy.items():
+      n = max(1, int(math.ceil(n_reads * per_read / float(budget))), (min_blocks or {}).get(chrom, 1))
+      self.blocks[chrom] = n
+      self.block_bytes[chrom] = int(n_reads * working / n)  # What a block takes over all the stages
+      self.predicted_rss[chrom] = self.baseline + fixed + int(n_reads * per_read / n)
+
+  def log(self, measured_rss=None, chroms=None, log=logger.debug):
+    """Log the plan as a small table
+
+    :param measured_rss: optional dict chrom -> peak RSS (bytes) reached by the time the chromosome was done
+    :param chroms: order to list the chromosomes in, ideally the order they are done in. Sorted if None
+    """
+    log('Memory plan: budget {:d} MB, baseline {:d} MB, fixed {:d} MB, queues {:d} MB'.format(
+      self.max_mem >> 20, self.baseline >> 20, self.fixed >> 20, self.queue_mem >> 20))
+    log('{:>6s} {:>8s} {:>10s} {:>14s} {:>14s}'.format('chrom', 'blocks', 'block MB', 'predicted MB', 'peak so far MB'))
+    for chrom in chroms or sorted(self.blocks):
+      measured = (measured_rss or {}).get(chrom)
+      log('{:6d} {:8d} {:10.1f} {:14.1f} {:>14s}'.format(
+        chrom, self.blocks[chrom], self.block_bytes[chrom] / 1048576.0, self.predicted_rss[chrom] / 1048576.0,
+        '{:.1f}'.format(measured / 1048576.0) if measured is not None else '-'))
+    if measured_rss:
+      log('Peak RSS: predicted {:.1f} MB, measured {:.1f} MB'.format(
+        max(self.predicted_rss.values()) / 1048576.0, max(measured_rss.values()) / 1048576.0))
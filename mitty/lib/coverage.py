@@ -0,0 +1,97 @@
+"""Truth coverage track: how deeply the reads we generate cover each base of the reference, for each chromosome copy.
+
+The track is kept in bins of bin_size bases. For each bin we store the number of read bases over it, counted in
+reference coordinates (the sum, over the bases of the bin, of the number of reads covering the base), so the mean depth
+of a bin is its count over the number of bases in it, and the counts add up exactly over any run of bins.
+
+  /chrom_<chrom>/copy_<cpy>  int64 array, one count per bin. seq_len (attribute) is the length of the chromosome
+  bin_size                   (attribute) bases per bin
+
+While generating we keep two difference arrays over the bins for the copy we are working on, filled with bincount:
+a read covering [start, stop) adds (bin end - start) to the bin it starts in and bin_size to each bin after it, and
+takes (bin end - stop) off the bin it stops in and bin_size off each bin after that. The running sum that turns the
+second kind into counts is done once per chromosome copy, when the copy is written out.
+"""
+import h5py
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class CoverageWriter:
+  """Accumulate the coverage of batches of reads and write it out a chromosome copy at a time"""
+  def __init__(self, fname, seq_len, bin_size=100):
+    """
+    :param fname: name of coverage file
+    :param seq_len: dict chrom -> length of reference sequence, for the chromosomes we will see
+    :param bin_size: bases per bin
+    """
+    self.fp = h5py.File(fname, 'w')
+    self.fp.attrs['bin_size'] = bin_size
+    self.seq_len, self.bin_size = seq_len, bin_size
+    self.key, self.start_diff, self.bin_diff = None, None, None
+
+  def add(self, chrom, cpy, ref_span):
+    """Add the coverage of a batch of reads
+
+    :param chrom: chromosome number
+    :param cpy: chromosome copy
+    :param ref_span: N x 2 array of (start, stop) of the reference each read covers (see lib.reads.read_ref_spans)
+    """
+    if self.key != (chrom, cpy):
+      self.write_copy()
+      n_bins = -(-self.seq_len[chrom] // self.bin_size) + 1  # One more for reads stopping at the end of the sequence
+      self.key = (chrom, cpy)
+      self.start_diff = np.zeros(n_bins, dtype=np.int64)  # Bases added to (or taken off) just this bin
+      self.bin_diff = np.zeros(n_bins, dtype=np.int64)  # Whole bins added to (or taken off) each bin after this one
+    n_bins, bin_size = self.bin_diff.shape[0], self.bin_size
+    start = np.clip(np.asarray(ref_span[:, 0], dtype=np.int64), 0, self.seq_len[chrom])
+    stop = np.clip(np.asarray(ref_span[:, 1], dtype=np.int64), start, self.seq_len[chrom])
+    for edge, op in [(start, np.add), (stop, np.subtract)]:
+      b = edge // bin_size
+      op(self.bin_diff, np.bincount(b, minlength=n_bins), out=self.bin_diff)
+      # The weights are whole numbers, so the float sums are exact
+      op(self.start_diff, np.bincount(b, weights=(b + 1) * bin_size - edge, minlength=n_bins), out=self.start_diff,
+         casting='unsafe')
+
+  def write_copy(self):
+    """Write out the coverage of the chromosome copy we are working on"""
+    if self.key is None:
+      return
+    chrom, cpy = self.key
+    counts = (self.start_diff + self.bin_size * (np.cumsum(self.bin_diff) - self.bin_diff))[:-1]
+    name = '/chrom_{:d}/copy_{:d}'.format(chrom, cpy)
+    if name in self.fp:  # We have seen this copy before
+      self.fp[name][:] += counts
+    else:
+      ds = self.fp.create_dataset(name, data=counts, chunks=True, compression='gzip', shuffle=True)
+      ds.attrs['seq_len'] = self.seq_len[chrom]
+    self.key, self.start_diff, self.bin_diff = None, None, None
+
+  def flush(self):
+    self.fp.flush()
+
+  def close(self):
+    if self.fp.id.valid:
+      self.write_copy()
+      self.fp.close()
+
+
+def load_coverage(fname, chrom, cpy):
+  """Coverage track of a chromosome copy
+
+  :param fname: name of coverage file
+  :param chrom: chromosome number
+  :param cpy: chromosome copy
+  :return: counts, depth, bin_size. counts is the number of read bases over each bin and depth the mean depth of each
+           bin (the last bin may be short)
+  """
+  with h5py.File(fname, 'r') as fp:
+    bin_size = int(fp.attrs['bin_size'])
+    ds = fp['/chrom_{:d}/copy_{:d}'.format(chrom, cpy)]
+    counts, seq_len = ds[:], int(ds.attrs['seq_len'])
+  bases = np.full(counts.shape[0], bin_size, dtype=np.int64)
+  if bases.shape[0]:
+    bases[-1] = seq_len - bin_size * (bases.shape[0] - 1)
+  return counts, counts / bases.astype(float), bin_size
@@ -9,6 +9,10 @@ import string
 from contextlib import contextmanager
 import hashlib  # We decided to include md5 hashes of the sequences too
 from itertools import izip
+from collections import deque
+from multiprocessing.pool import ThreadPool
+import struct
+import zlib
 
 import pysam
 
@@ -274,6 +278,24 @@ def write_chromosomes_to_vcf(fp, seq_id='chr1', chrom_list=None, master_list=Non
       wr(seq_id + "\t" + str(pos[idx]) + "\t.\t" + ref[idx] + "\t" + alt[idx] + "\t100\tPASS\t.\tGT\t" + gt_string[gt] + "\n")
 
 
+def read_bed(bed_fname):
+  """Load the intervals from a BED file (gzipped or not). Only the first three columns are used and header lines
+  (track, browser, #) are skipped
+
+  :param bed_fname: name of BED file
+  :return: dict keyed by sequence name. Each entry is a list of (start, stop) intervals, 0 indexed, stop exclusive,
+           in the order they appear in the file
+  """
+  targets = {}
+  with (gzip.open if bed_fname.endswith('.gz') else open)(bed_fname, 'r') as fp:
+    for line in fp:
+      if line.startswith(('track', 'browser', '#')) or not line.strip():
+        continue
+      cells = line.split()
+      targets.setdefault(cells[0], []).append((int(cells[1]), int(cells[2])))
+  return targets
+
+
 def sort_and_index_bam(bamfile):
   """Do the filename gymnastics required to end up with a sorted, indexed, bam file."""
   # samtools sort adds a '.bam' to the end of the file name.
@@ -281,4 +303,110 @@ def sort_and_index_bam(bamfile):
   os.rename(bamfile, t_bam)
   pysam.sort(t_bam, os.path.splitext(bamfile)[0])
   pysam.index(bamfile)
-  os.remove(t_bam)
\ No newline at end of file
+  os.remove(t_bam)
+
+
+BGZF_BLOCK_SIZE = 0xff00  # Uncompressed bytes per BGZF block. Same as bgzip, guarantees the compressed block fits
+BGZF_EOF = '\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+
+
+def bgzf_compress(data, level=6):
+  """Compress data into a string of BGZF blocks. Each block is a complete gzip member, so the result can be
+  concatenated with other such strings and read by gzip, bgzip, samtools etc.
+
+  :param data:  string (or buffer) to compress
+  :param level: zlib compression level
+  :return: string of BGZF blocks
+  """
+  blocks = []
+  for i in xrange(0, len(data), BGZF_BLOCK_SIZE):
+    chunk = buffer(data, i, BGZF_BLOCK_SIZE)
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)  # zlib releases the GIL while it compresses
+    cdata = c.compress(chunk) + c.flush()
+    blocks += [struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25),
+               cdata, struct.pack('<II', zlib.crc32(chunk) & 0xffffffff, len(chunk))]
+  return ''.join(blocks)
+
+
+class BgzfWriter:
+  """File like object that writes BGZF (blocked gzip), compressing on a pool of threads.
+
+  Data is cut into chunks of several BGZF blocks which are compressed in parallel and written out in order, so the
+  file is the same however many threads we use. The output is readable by gzip and can be indexed by bgzip/samtools.
+  """
+  def __init__(self, fname, mode='w', threads=1, level=6, pool=None, chunk_size=16 * BGZF_BLOCK_SIZE):
+    """
+    :param fname:      name of output file
+    :param mode:       only writing is supported. Here so we can stand in for gzip.open
+    :param threads:    number of compression threads. If pool is given, the number of threads it has
+    :param level:      zlib compression level
+    :param pool:       ThreadPool to share with other writers. We do not close it
+    :param chunk_size: bytes of uncompressed data handed to a thread at a time
+    """
+    assert mode.startswith('w'), 'BgzfWriter only writes'
+    self.fp = open(fname, 'wb')
+    self.level, self.chunk_size = level, chunk_size
+    self.own_pool = pool is None and threads > 1
+    self.pool = ThreadPool(threads) if self.own_pool else pool
+    self.max_pending = 2 * max(1, threads)  # Keep every thread busy without queuing up too much data
+    self.pending = deque()
+    self.buf, self.buf_len = [], 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def _submit(self, data):
+    if self.pool is None:
+      self.fp.write(bgzf_compress(data, self.level))
+      return
+    self.pending.append(self.pool.apply_async(bgzf_compress, (data, self.level)))
+    while len(self.pending) > self.max_pending:
+      self.fp.write(self.pending.popleft().get())
+
+  def write(self, data):
+    self.buf.append(data)
+    self.buf_len += len(data)
+    if self.buf_len < self.chunk_size:
+      return
+    data = ''.join(self.buf) if len(self.buf) > 1 else self.buf[0]
+    n = len(data) - len(data) % self.chunk_size
+    for i in xrange(0, n, self.chunk_size):
+      self._submit(buffer(data, i, self.chunk_size))
+    self.buf = [data[n:]] if n < len(data) else []
+    self.buf_len = len(data) - n
+
+  def compress(self, data):
+    """Compress data into BGZF blocks, spread over our threads, and return them for write_blocks. This lets
+    compression run as its own step, apart from writing"""
+    if self.pool is None or len(data) <= self.chunk_size:
+      return bgzf_compress(data, self.level)
+    return ''.join(self.pool.map(lambda i: bgzf_compress(buffer(data, i, self.chunk_size), self.level),
+                                 xrange(0, len(data), self.chunk_size)))
+
+  def write_blocks(self, blocks):
+    """Write out BGZF blocks returned by compress, after anything still pending from write"""
+    if self.buf_len or self.pending:
+      self.flush()
+    self.fp.write(blocks)
+
+  def flush(self):
+    """Compress and write out everything we have been given so far"""
+    if self.buf_len:
+      self._submit(''.join(self.buf))
+    self.buf, self.buf_len = [], 0
+    while self.pending:
+      self.fp.write(self.pending.popleft().get())
+    self.fp.flush()
+
+  def close(self):
+    if self.fp.closed:
+      return
+    self.flush()
+    self.fp.write(BGZF_EOF)
+    self.fp.close()
+    if self.own_pool:
+      self.pool.close()
+      self.pool.join()
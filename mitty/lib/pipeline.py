@@ -0,0 +1,172 @@
+"""A small producer/consumer pipeline. Each stage runs in its own thread and the stages are connected by bounded
+queues, so a slow stage (e.g. writing to disk) overlaps with the others instead of holding them up. Stages that spend
+their time in numpy, zlib or file I/O release the GIL, so threads are enough here.
+
+Items go through the stages in order, so the output order is the same as the input order. Each stage keeps a tally of
+the time it spends working (busy), waiting for input (stall_in) and waiting for room downstream (stall_out). The stage
+with the most busy time and least stall time is the one limiting throughput.
+"""
+import sys
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+_END = object()  # Sent down the pipeline after the last item
+
+
+def approx_size(obj):
+  """Rough size in bytes of an item in a queue. Good enough to keep the pipeline inside a memory budget
+
+  Long lists and arrays of objects are estimated from their first element
+  """
+  if isinstance(obj, (str, buffer)):
+    return len(obj)
+  if isinstance(obj, np.ndarray):
+    n = obj.nbytes
+    if obj.size and obj.dtype.hasobject:
+      if obj.dtype.names is None:
+        n += approx_size(obj.flat[0]) * obj.size
+      else:
+        n += sum(approx_size(obj[k].flat[0]) for k in obj.dtype.names if obj.dtype[k].hasobject) * obj.size
+    return n
+  if isinstance(obj, (list, tuple)):
+    if len(obj) > 16:
+      return approx_size(obj[0]) * len(obj)
+    return sum(approx_size(o) for o in obj)
+  return getattr(obj, 'nbytes', 0)  # e.g. a ReadBatch
+
+
+class Pipeline:
+  """Run items from a source through a chain of stages.
+
+  p = Pipeline(source, [('double', lambda x: 2 * x), ('print', show)], depth=2)
+  for result in p:  # Results of the last stage, in source order
+    ...
+  p.get_stats()
+  """
+  def __init__(self, source, stages, depth=2, max_mem=None, source_name='source', sizeof=approx_size):
+    """
+    :param source:  iterable of items. It is read in its own thread and counts as the first stage
+    :param stages:  list of (name, function). Each function takes the item from the previous stage and returns the
+                    item for the next one
+    :param depth:   maximum number of items waiting between two stages
+    :param max_mem: maximum bytes (as estimated by sizeof) waiting in all the queues together. An item is always let
+                    into an empty queue, so the pipeline can not lock up on a big item. None for no limit
+    :param source_name: name of the source in the stats
+    :param sizeof:  function estimating the size of an item
+    """
+    assert depth > 0, 'Queues need room for at least one item'
+    self.source, self.stages = source, stages
+    self.depth, self.max_mem, self.sizeof = depth, max_mem, sizeof
+    self.names = [source_name] + [name for name, _ in stages]
+    self.queues = [deque() for _ in self.names]  # queues[i] holds the output of stage i as (item, size)
+    self.mem = 0
+    self.cv = threading.Condition()
+    self.error, self.stopped = None, False
+    self.stats = [{'name': name, 'items': 0, 'busy': 0.0, 'stall_in': 0.0, 'stall_out': 0.0} for name in self.names]
+    self.wall = None  # Seconds from start to finish
+
+  def _put(self, i, item):
+    t0 = time.time()
+    size = self.sizeof(item) if item is not _END else 0
+    q = self.queues[i]
+    with self.cv:
+      while not self.stopped and \
+              (len(q) >= self.depth or (self.max_mem is not None and q and self.mem + size > self.max_mem)):
+        self.cv.wait()  # Untimed: a timed wait polls in Python 2
+      q.append((item, size))
+      self.mem += size
+      self.cv.notify_all()
+    self.stats[i]['stall_out'] += time.time() - t0
+
+  def _get(self, i):
+    """Take the next item from queue i. Returns _END if the pipeline has been stopped"""
+    q = self.queues[i]
+    with self.cv:
+      while not self.stopped and not q:
+        self.cv.wait()
+      if self.stopped:
+        return _END
+      item, size = q.popleft()
+      self.mem -= size
+      self.cv.notify_all()
+    return item
+
+  def _stop(self, error=None):
+    with self.cv:
+      if error is not None and self.error is None:
+        self.error = error
+      self.stopped = True
+      self.cv.notify_all()
+
+  def _run_source(self):
+    st = self.stats[0]
+    try:
+      it = iter(self.source)
+      while not self.stopped:
+        t0 = time.time()
+        item = next(it, _END)
+        st['busy'] += time.time() - t0
+        self._put(0, item)
+        if item is _END:
+          return
+        st['items'] += 1
+    except:
+      self._stop(sys.exc_info())
+
+  def _run_stage(self, i):
+    st, fun = self.stats[i], self.stages[i - 1][1]
+    try:
+      while True:
+        t0 = time.time()
+        item = self._get(i - 1)
+        st['stall_in'] += time.time() - t0
+        if item is not _END:
+          t0 = time.time()
+          item = fun(item)
+          st['busy'] += time.time() - t0
+          st['items'] += 1
+        self._put(i, item)
+        if item is _END:
+          return
+    except:
+      self._stop(sys.exc_info())
+
+  def __iter__(self):
+    threads = [threading.Thread(target=self._run_source, name=self.names[0])] + \
+              [threading.Thread(target=self._run_stage, args=(i,), name=self.names[i])
+               for i in range(1, len(self.names))]
+    for t in threads:
+      t.daemon = True
+      t.start()
+    t_start = time.time()
+    try:
+      while True:
+        item = self._get(len(self.names) - 1)
+        if item is _END:
+          break
+        yield item
+    finally:
+      self._stop()  # Also tells the stages to quit if our consumer stops early
+      for t in threads:
+        t.join()
+      self.wall = time.time() - t_start
+    if self.error is not None:
+      raise self.error[0], self.error[1], self.error[2]
+
+  def get_stats(self):
+    """List of dicts, one per stage, with keys name, items, busy, stall_in and stall_out (seconds)"""
+    return [dict(st) for st in self.stats]
+
+
+def log_stats(stats, log=logger.debug):
+  """Log stage stats as a small table"""
+  log('{:>12s} {:>8s} {:>10s} {:>10s} {:>10s}'.format('stage', 'items', 'busy', 'stall_in', 'stall_out'))
+  for st in stats:
+    log('{name:>12s} {items:8d} {busy:10.3f} {stall_in:10.3f} {stall_out:10.3f}'.format(**st))
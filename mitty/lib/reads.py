@@ -2,10 +2,20 @@
 import re
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
+import mitty.lib
 
-def expand_sequence(ref_seq, ml, chrom, copy):
-  """Apply the variants in the list and return the consensus sequence
+import pyximport
+pyximport.install(setup_args={"include_dirs": np.get_include()})
+from reads_cy import *
+
+# 256 byte lookup table version of mitty.lib.DNA_complement. Indexing it with a uint8 array complements the bases
+DNA_complement_lut = np.frombuffer(mitty.lib.DNA_complement, dtype=np.uint8)
+
+
+def py_expand_sequence(ref_seq, ml, chrom, copy):
+  """Apply the variants in the list and return the consensus sequence. Pure Python version of expand_sequence
 
   :param ref_seq:    reference sequence
   :param ml:     master list of variants
@@ -65,11 +75,220 @@ def expand_sequence(ref_seq, ml, chrom, copy):
   return ''.join(alt_fragments), np.rec.fromrecords(variant_waypoint, dtype=dtype), var_loc_alt_coordinates
 
 
+class HaplotypeView:
+  """A chromosome copy with the sample's variants applied, without writing out the whole sequence. The alt sequence is
+  a table of segments, each pointing either into the reference or into a heap of the alleles we put in, so the memory
+  we need is proportional to the number of variants, not the length of the chromosome. Reads (gather) and regions
+  (slicing) copy only the bytes they cover. With no variants we pass the reference through as is."""
+  def __init__(self, ref_seq, ml, chrom, copy, table=None):
+    """
+    :param ref_seq: reference sequence
+    :param ml:      master list of variants
+    :param chrom:   [(no, het) ...] list of variants pointing to master list
+    :param copy:    0/1 which copy of the chromosome
+    :param table:   (seg_start, seg_src, seg_heap, heap, variant_waypoints, var_locs_alt_coords) as returned by
+                    haplotype_table, if we have it already (e.g. from a cache). ml, chrom and copy are then not used
+    """
+    self.ref_seq = ref_seq
+    self.seg_start, self.seg_src, self.seg_heap, self.heap, self.variant_waypoints, self.var_locs_alt_coords = \
+      table if table is not None else haplotype_table(len(ref_seq), ml, chrom, copy)
+    # No alleles put in and the reference in one piece: we are the reference
+    self.null = self.seg_src.size == 0 or (self.seg_src.size == 1 and self.seg_heap[0] == 0 and self.seg_src[0] == 0
+                                           and self.seg_start[-1] == len(ref_seq))
+
+  def __len__(self):
+    return int(self.seg_start[-1])
+
+  def get_table(self):
+    """The arrays we are made from, as returned by haplotype_table"""
+    return self.seg_start, self.seg_src, self.seg_heap, self.heap, self.variant_waypoints, self.var_locs_alt_coords
+
+  def __getitem__(self, item):
+    """Bases as a string. Only simple slices (and single positions) are supported"""
+    if isinstance(item, slice):
+      assert item.step is None, 'Only simple slices are supported'
+      lo, hi, _ = item.indices(len(self))
+    else:
+      lo = item + len(self) if item < 0 else item
+      if not 0 <= lo < len(self):
+        raise IndexError('Haplotype index out of range')
+      hi = lo + 1
+    if self.null:
+      return self.ref_seq[lo:hi]  # Whole sequence slice hands back the reference itself
+    return copy_segments(self.ref_seq, self.heap, self.seg_start, self.seg_src, self.seg_heap, lo, hi)
+
+  def gather(self, start, read_len):
+    """Cut out a batch of reads, all of the same length
+
+    :param start:    array of start positions of the reads. All reads should lie wholly inside the sequence
+    :param read_len: length of the reads
+    :return: N x read_len uint8 matrix of reads (forward strand)
+    """
+    if self.null:
+      return extract_reads(self.ref_seq, start, np.zeros(len(start), dtype=bool), read_len)
+    return gather_segments(self.ref_seq, self.heap, self.seg_start, self.seg_src, self.seg_heap, start, read_len)
+
+
+def extract_reads(seq, start, read_order, read_len):
+  """Cut out a batch of reads, all of the same length, from the sequence in one go
+
+  :param seq:        forward sequence (string or HaplotypeView)
+  :param start:      array of start positions of the reads on seq. All reads should lie wholly inside seq
+  :param read_order: array of 0/1. 1 means the read is off the reverse strand and is reverse complemented
+  :param read_len:   length of the reads
+  :return: N x read_len uint8 matrix of reads
+  """
+  if isinstance(seq, HaplotypeView):
+    reads = seq.gather(start, read_len)
+  else:
+    buf = np.frombuffer(seq, dtype=np.uint8)
+    # Every read_len long window on the sequence as a row of a (read only) matrix, without copying anything
+    windows = as_strided(buf, shape=(max(0, buf.size - read_len + 1), read_len), strides=(1, 1))
+    reads = windows[start]  # The fancy index makes a copy
+  rev = np.asarray(read_order, dtype=bool)
+  if rev.any():
+    reads[rev] = DNA_complement_lut[reads[rev, ::-1]]
+  return reads
+
+
+def merge_intervals(start, stop):
+  """Merge overlapping or touching intervals into disjoint ones
+
+  :param start: array of interval starts, sorted
+  :param stop:  array of interval stops (one past the end)
+  :return: N x 2 array of (start, stop) of disjoint intervals, in order
+  """
+  start, stop = np.asarray(start, dtype=np.int64), np.asarray(stop, dtype=np.int64)
+  if start.size == 0:
+    return np.empty((0, 2), dtype=np.int64)
+  reach = np.maximum.accumulate(stop)  # Furthest any interval so far goes
+  new = np.concatenate(([True], start[1:] > reach[:-1]))  # Intervals that do not touch anything before them
+  first = new.nonzero()[0]
+  last = np.append(first[1:], start.size) - 1
+  return np.column_stack((start[first], reach[last]))
+
+
+def intersect_intervals(a, b):
+  """Intersect two sets of disjoint, sorted intervals
+
+  :param a: N x 2 array of (start, stop)
+  :param b: M x 2 array of (start, stop)
+  :return: K x 2 array of (start, stop) of the regions covered by both, in order
+  """
+  a, b = np.asarray(a, dtype=np.int64).reshape(-1, 2), np.asarray(b, dtype=np.int64).reshape(-1, 2)
+  lo = np.searchsorted(b[:, 1], a[:, 0], side='right')  # First b interval ending after each a interval starts
+  hi = np.searchsorted(b[:, 0], a[:, 1], side='left')  # One past the last b interval starting before it ends
+  cnt = np.maximum(hi - lo, 0)
+  ai = np.repeat(np.arange(a.shape[0]), cnt)
+  bi = np.repeat(lo, cnt) + np.arange(ai.size) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+  start, stop = np.maximum(a[ai, 0], b[bi, 0]), np.minimum(a[ai, 1], b[bi, 1])
+  keep = stop > start
+  return np.column_stack((start[keep], stop[keep]))
+
+
+def n_free_intervals(seq, chunk_size=1 << 24):
+  """Index of the stretches of a sequence without N, so reads can be placed to avoid N runs (assembly gaps,
+  centromeres etc.). We go through the sequence in chunks to keep the temporary arrays small
+
+  :param seq:        sequence (string)
+  :param chunk_size: bases to look at in one go
+  :return: N x 2 array of (start, stop) of the runs of non-N bases, in order
+  """
+  buf = np.frombuffer(seq, dtype=np.uint8)
+  edges, prev_n = [], True  # We start as if just after an N, so the edges go start, stop, start, stop ...
+  for i in xrange(0, buf.size, chunk_size):
+    is_n = buf[i:i + chunk_size] == ord('N')
+    if is_n[0] != prev_n:
+      edges.append([i])
+    edges.append((is_n[1:] != is_n[:-1]).nonzero()[0] + i + 1)
+    prev_n = is_n[-1]
+  if not prev_n:
+    edges.append([buf.size])
+  return np.concatenate(edges).astype(np.int64).reshape(-1, 2) if edges else np.empty((0, 2), dtype=np.int64)
+
+
+def ref_to_alt(variant_waypoints, ref_pos):
+  """Map positions on the reference to positions on the expanded sequence. Positions inside a deletion map to the
+  base after the deletion
+
+  :param variant_waypoints: recarray, as returned by expand_sequence (pos_ref, pos_alt, delta)
+  :param ref_pos: array of positions on the reference
+  :return: array of positions on the expanded sequence
+  """
+  ref_pos = np.asarray(ref_pos, dtype=np.int64)
+  # The end waypoint is left out, its ref_pos is only a marker and need not be in order
+  v_r = variant_waypoints['ref_pos'][:-1].astype(np.int64)
+  v_a = variant_waypoints['alt_pos'][:-1].astype(np.int64)
+  dl = variant_waypoints['delta'][:-1].astype(np.int64)
+  n = np.searchsorted(v_r, ref_pos, side='right') - 1
+  alt_pos = v_a[n] + ref_pos - v_r[n] + np.maximum(dl[n], 0)  # Insertions push everything after them to the right
+  # Inside a deletion we land before the waypoint of the deletion, so we need to clip to it
+  nxt = np.minimum(n + 1, v_r.size - 1)
+  inside_del = (dl[nxt] < 0) & (nxt > n) & (alt_pos > v_a[nxt])
+  alt_pos[inside_del] = v_a[nxt][inside_del]
+  return alt_pos
+
+
+def alt_to_ref(variant_waypoints, alt_pos, insertion_side='right'):
+  """Map positions on the expanded sequence to positions on the reference. The inverse of ref_to_alt
+
+  :param variant_waypoints: recarray, as returned by expand_sequence (pos_ref, pos_alt, delta)
+  :param alt_pos: array of positions on the expanded sequence
+  :param insertion_side: positions inside an insertion map to the reference base after the insertion ('right') or the
+                         one before it, that the insertion is anchored on ('left')
+  :return: array of positions on the reference
+  """
+  alt_pos = np.asarray(alt_pos, dtype=np.int64)
+  # The end waypoint is left out, as for ref_to_alt
+  v_r = variant_waypoints['ref_pos'][:-1].astype(np.int64)
+  v_a = variant_waypoints['alt_pos'][:-1].astype(np.int64)
+  dl = variant_waypoints['delta'][:-1].astype(np.int64)
+  n = np.searchsorted(v_a, alt_pos, side='right') - 1
+  k, ins = alt_pos - v_a[n], np.maximum(dl[n], 0)  # The waypoint of an insertion is on its first inserted base
+  ref_pos = v_r[n] + np.maximum(k - ins, 0)
+  if insertion_side == 'left':
+    ref_pos -= k < ins
+  return ref_pos
+
+
+def read_ref_spans(variant_waypoints, reads):
+  """(start, stop) of the stretch of reference each read covers. Bases deleted from the middle of a read count as
+  covered, as they do for the D of a CIGAR, and a read lying wholly inside an insertion covers nothing (start == stop)
+
+  :param variant_waypoints: recarray, as returned by expand_sequence (pos_ref, pos_alt, delta)
+  :param reads: ReadBatch, or recarray with fields 'start_a' and 'read_len'
+  :return: N x 2 int64 array
+  """
+  start = np.asarray(reads['start_a'], dtype=np.int64)
+  last = start + np.asarray(reads['read_len'], dtype=np.int64) - 1
+  return np.column_stack((alt_to_ref(variant_waypoints, start),
+                          alt_to_ref(variant_waypoints, last, insertion_side='left') + 1)).reshape(-1, 2)
+
+
+def read_matrix_to_strings(reads):
+  """Convert an N x read_len uint8 read matrix into an array of N strings (e.g. to fill out 'perfect_reads')"""
+  return reads.view('S{:d}'.format(reads.shape[1])).ravel() if reads.shape[1] else np.array([''] * reads.shape[0])
+
+
+def roll_cigars(variant_waypoints, reads, old_style=False):
+  """Use beacons to generate POS and CIGAR strings for reads. Uses the compiled roll_cigars_packed
+
+  :param variant_waypoints: recarray, as returned by expand_sequence (pos_ref, pos_alt, delta)
+  :param reads: numpy recarray with fields 'start_a' and 'read_len'
+  :param old_style: If True give us old style CIGARs ('M' for both matches and mismatches)
+  :return: pos, cigars
+     - array of POS values
+     - list of CIGAR strings same length as reads array
+  """
+  pos, cigar_buf, cigar_offsets = roll_cigars_packed(variant_waypoints, reads, old_style)
+  return pos, unpack_cigars(cigar_buf, cigar_offsets)
+
+
 # TODO: make this code more elegant
 # TODO: write up algorithm. See if we can refactor it
 # TODO: revise algorithm to handle reads in the middle of insertions properly
 # TODO: Add appropriate tests for longer insertions POS and CIGAR
-def roll_cigars(variant_waypoints, reads):
+def py_roll_cigars(variant_waypoints, reads):
   """Use beacons to generate POS and CIGAR strings for reads
 
   :param variant_waypoints: recarray, as returned by expand_sequence (pos_ref, pos_alt, delta)
@@ -0,0 +1,117 @@
+"""Truth sidecar for reads written with compact qnames.
+
+Normally the truth for a read is packed into its qname ('serial|chrom|copy|ro|pos|rlen|cigar|ro|pos|rlen|cigar'), which
+for indel rich reads can be longer than the read itself. With compact qnames the qname is just the serial number of the
+template and the truth goes into an HDF5 sidecar file:
+
+  /reads        table with one row per read (chrom, cpy, ro, pos, rlen, cigar_start)
+                paired reads: row = serial * 2 + mate (mate = 0 for read 1, 1 for read 2)
+                unpaired reads: row = serial
+  /cigars       all the CIGARs, one after the other. Read n has cigars[cigar_start[n]:cigar_start[n + 1]]
+  cigar_end     (attribute) end of the CIGARs, so the last read can be looked up like the others
+  paired        (attribute) True if the reads are paired
+
+The row of a read is computed from its serial, so looking up the truth for a batch of reads is a numpy fancy index.
+"""
+import h5py
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+truth_dt = [('chrom', 'u2'), ('cpy', 'u1'), ('ro', 'u1'), ('pos', 'i4'), ('rlen', 'i4'), ('cigar_start', 'i8')]
+
+
+class TruthWriter:
+  """Append the truth for batches of reads to a sidecar file. Writes are buffered and go out in large chunks"""
+  def __init__(self, fname, paired, chunk_size=1 << 16):
+    """
+    :param fname: name of sidecar file
+    :param paired: True if reads come in pairs. Each template then gets two rows
+    :param chunk_size: rows per HDF5 chunk (and per write)
+    """
+    self.fp = h5py.File(fname, 'w')
+    self.fp.attrs['paired'] = paired
+    self.reads = self.fp.create_dataset('/reads', shape=(0,), maxshape=(None,), dtype=truth_dt,
+                                        chunks=(chunk_size,), compression='gzip', shuffle=True)
+    self.cigars = self.fp.create_dataset('/cigars', shape=(0,), maxshape=(None,), dtype='u1',
+                                         chunks=(16 * chunk_size,), compression='gzip')
+    self.chunk_size = chunk_size
+    self.buf, self.cigar_buf, self.buf_rows = [], [], 0
+    self.rows, self.cigar_len = 0, 0
+
+  def append(self, chrom, cpy, read_order, pos, read_len, cigars):
+    """Append the truth for a batch of reads, in row order
+
+    :param chrom:       chromosome number (scalar or array)
+    :param cpy:         chromosome copy (scalar or array)
+    :param read_order:  array of read orders (0/1)
+    :param pos:         array of POS values
+    :param read_len:    array of read lengths
+    :param cigars:      list of CIGAR strings
+    """
+    n = len(cigars)
+    rows = np.empty(n, dtype=truth_dt)
+    rows['chrom'], rows['cpy'], rows['ro'], rows['pos'], rows['rlen'] = chrom, cpy, read_order, pos, read_len
+    cigar_len = np.fromiter((len(c) for c in cigars), dtype=np.int64, count=n)
+    rows['cigar_start'] = self.cigar_len + np.cumsum(cigar_len) - cigar_len
+    self.cigar_len += int(cigar_len.sum())
+    self.buf.append(rows)
+    self.cigar_buf.append(''.join(cigars))
+    self.buf_rows += n
+    if self.buf_rows >= self.chunk_size:
+      self.flush()
+
+  def flush(self):
+    if not self.buf_rows:
+      return
+    rows, cigars = np.concatenate(self.buf), np.frombuffer(''.join(self.cigar_buf), dtype='u1')
+    self.reads.resize((self.rows + rows.shape[0],))
+    self.reads[self.rows:] = rows
+    if cigars.shape[0]:
+      self.cigars.resize((self.cigars.shape[0] + cigars.shape[0],))
+      self.cigars[-cigars.shape[0]:] = cigars
+    self.rows += rows.shape[0]
+    self.buf, self.cigar_buf, self.buf_rows = [], [], 0
+    self.fp.flush()
+
+  def close(self):
+    if self.fp.id.valid:
+      self.flush()
+      self.fp.attrs['cigar_end'] = self.cigar_len
+      self.fp.close()
+
+
+class TruthReader:
+  """Look up the truth for reads with compact qnames. The sidecar is loaded into memory when opened"""
+  def __init__(self, fname):
+    with h5py.File(fname, 'r') as fp:
+      self.paired = bool(fp.attrs['paired'])
+      self.reads = fp['/reads'][:]
+      self.cigars = fp['/cigars'][:].tostring()
+      self.cigar_start = np.append(self.reads['cigar_start'], fp.attrs['cigar_end'])
+
+  def __len__(self):
+    return self.reads.shape[0]
+
+  def get_rows(self, serial, mate=0):
+    """Rows of the given reads
+
+    :param serial: array of template serial numbers
+    :param mate: array (or scalar) with 0 for read 1 and 1 for read 2. Ignored for unpaired reads
+    :return: array of rows
+    """
+    serial = np.asarray(serial, dtype=np.int64)
+    return 2 * serial + mate if self.paired else serial
+
+  def lookup(self, rows):
+    """Truth for a batch of reads
+
+    :param rows: array of rows, as given by get_rows
+    :return: (table, cigars) - the rows of the reads table and the list of CIGAR strings
+    """
+    rows = np.asarray(rows, dtype=np.int64)
+    st, en = self.cigar_start[rows].tolist(), self.cigar_start[rows + 1].tolist()
+    cigars = self.cigars
+    return self.reads[rows], [cigars[s:e] for s, e in zip(st, en)]
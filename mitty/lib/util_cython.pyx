@@ -287,3 +287,52 @@ def score_sequences_by_k_mer_count(sequence_list, k_mer_count_table):
   if len(k_mer_count_table) == 0: return []
   k = len(k_mer_count_table.keys()[0])
   return [sequence_k_mer_score(seq, k, k_mer_count_table) for seq in sequence_list]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def alias_table(weights):
+  """Build a Walker alias table (Vose's method) so we can draw from a discrete distribution in constant time per draw
+
+  :param weights: array of non-negative weights, not all zero
+  :return: prob, alias - use with alias_sample
+  """
+  cdef:
+    int n = len(weights), n_small = 0, n_large = 0, i, j
+    np.ndarray[np.float64_t, ndim=1] prob = np.asarray(weights, dtype=np.float64) * (len(weights) / float(np.sum(weights)))
+    np.ndarray[np.int32_t, ndim=1] alias = np.arange(n, dtype=np.int32)
+    np.ndarray[np.int32_t, ndim=1] small = np.empty(n, dtype=np.int32)
+    np.ndarray[np.int32_t, ndim=1] large = np.empty(n, dtype=np.int32)
+
+  for i in range(n):
+    if prob[i] < 1.0:
+      small[n_small] = i
+      n_small += 1
+    else:
+      large[n_large] = i
+      n_large += 1
+
+  while n_small > 0 and n_large > 0:
+    n_small -= 1
+    i = small[n_small]
+    j = large[n_large - 1]
+    alias[i] = j  # The rest of bin i goes to j
+    prob[j] = prob[j] + prob[i] - 1.0
+    if prob[j] < 1.0:
+      n_large -= 1
+      small[n_small] = j
+      n_small += 1
+
+  # Whatever is left over is full, up to rounding error
+  for i in range(n_small):
+    prob[small[i]] = 1.0
+  for i in range(n_large):
+    prob[large[i]] = 1.0
+
+  return prob, alias
+
+
+def alias_sample(rng, prob, alias, size):
+  """Draw size samples (indexes into the original weights) using a table made by alias_table"""
+  idx = rng.randint(prob.size, size=size)
+  return np.where(rng.rand(size) < prob[idx], idx, alias[idx])
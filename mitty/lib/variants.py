@@ -1,3 +1,8 @@
+import multiprocessing
+import Queue
+import time
+import traceback
+
 import numpy as np
 import h5py
 
@@ -26,9 +31,16 @@ class Population:
              /2
              ...
 
-
+  A sample chromosome is normally stored as the full array of (index, gt) records. Samples that are closely related
+  to a sample written before them (e.g. the nested samples of the vn model) can instead be stored as a delta against
+  that parent sample. The dataset then carries the attributes 'parent', 'n_added' and 'variant_count' and has an extra
+  field 'at'. The first n_added rows are the records the parent lacks, with 'at' giving their position in the full
+  sample. The remaining rows are the parent records the sample lacks, with 'at' giving their position in the parent.
+  Parents may themselves be stored as deltas.
   """
   str_dt = h5py.special_dtype(vlen=bytes)
+  ml_dt = [('pos', 'i4'), ('stop', 'i4'), ('ref', str_dt), ('alt', str_dt), ('p', 'f2')]
+  delta_dt = [('index', 'i4'), ('gt', 'i1'), ('at', 'i4')]
 
   def __init__(self, fname='test.h5', mode='r', genome_metadata=None, in_memory=False):
     """Load a population from file, or create a new file. Over write or store the passed master list and/or samples
@@ -48,6 +60,7 @@ class Population:
         raise RuntimeError('Creating a new Population object requires genome metadata')
       self.set_genome_metadata(genome_metadata)
       self.fp.attrs['Mitty version'] = __version__
+    self._last_sample = (None, None)  # (path, indexes) of the last full sample we wrote or read. Usually the next parent
 
   @staticmethod
   def _ml_path(chrom):
@@ -94,23 +107,54 @@ class Population:
     path = self._ml_path(chrom)
     assert path not in self.fp, "The master list exists"
 
-    dtype = [('pos', 'i4'), ('stop', 'i4'), ('ref', Population.str_dt), ('alt', Population.str_dt), ('p', 'f2')]
     self.fp.create_dataset(name=path, shape=master_list.variants.shape,
-                           dtype=dtype, data=master_list.variants, chunks=True, compression='gzip')
+                           dtype=Population.ml_dt, data=master_list.variants, chunks=True, compression='gzip')
 
-  def add_sample_chromosome(self, chrom, sample_name, indexes):
+  def add_sample_chromosome(self, chrom, sample_name, indexes, parent=None):
     """Add sample. Error if already exists
 
     :param chrom:  chrom number [1, 2, 3, ...]
     :param sample_name:
     :param indexes: [(chrom, gt) ...]
+    :param parent: name of an already stored sample. If given, store this sample as a delta against the parent. We
+                   fall back to storing the full sample if the two do not share a common ordering
     """
     path = self._s_path(sample_name, chrom)
     assert path not in self.fp, "This sample/chrom exists"
     assert self._ml_path(chrom) in self.fp, "This chromosome is absent in the master list"
 
-    self.fp.create_dataset(name=path, shape=indexes.shape, dtype=[('index', 'i4'), ('gt', 'i1')],
-                           data=indexes, chunks=True, compression='gzip')
+    delta = self._sample_delta(self.get_sample_variant_index_for_chromosome(chrom, parent), indexes) \
+      if parent is not None else None
+    if delta is None:
+      self.fp.create_dataset(name=path, shape=indexes.shape, dtype=[('index', 'i4'), ('gt', 'i1')],
+                             data=indexes, chunks=True, compression='gzip')
+    else:
+      dset = self.fp.create_dataset(name=path, shape=delta[0].shape, dtype=Population.delta_dt,
+                                    data=delta[0], chunks=True, compression='gzip')
+      dset.attrs['parent'], dset.attrs['n_added'], dset.attrs['variant_count'] = parent, delta[1], indexes.size
+    # Our own copy: the caller may go on to change theirs
+    self._last_sample = (path, np.array(indexes, dtype=[('index', 'i4'), ('gt', 'i1')], copy=True))
+
+  @staticmethod
+  def _sample_delta(parent_indexes, indexes):
+    """Work out the records to add to and remove from the parent sample to get this sample
+
+    :param parent_indexes: full (index, gt) array of the parent sample
+    :param indexes: full (index, gt) array of this sample
+    :return: (delta array, number of added records) or None if the sample can not be expressed as a delta
+    """
+    key = lambda x: x['index'].astype('i8') * 4 + x['gt']
+    added = ~np.in1d(key(indexes), key(parent_indexes))
+    removed = ~np.in1d(key(parent_indexes), key(indexes))
+    # The records common to both have to come in the same order, otherwise we can not splice the delta back in
+    if not np.array_equal(indexes[~added], parent_indexes[~removed]):
+      return None
+    at_a, at_r = added.nonzero()[0], removed.nonzero()[0]
+    delta = np.empty(at_a.size + at_r.size, dtype=Population.delta_dt)
+    for k in ['index', 'gt']:
+      delta[k] = np.concatenate((indexes[k][at_a], parent_indexes[k][at_r]))
+    delta['at'] = np.concatenate((at_a, at_r))
+    return delta, at_a.size
 
   def get_variant_master_list_count(self, chrom):
     path = self._ml_path(chrom)
@@ -125,12 +169,35 @@ class Population:
 
   def get_sample_variant_count(self, chrom, sample_name):
     path = self._s_path(sample_name, chrom)
-    return self.fp[path].size if path in self.fp else 0
+    if path not in self.fp:
+      return 0
+    return self.fp[path].attrs['variant_count'] if 'parent' in self.fp[path].attrs else self.fp[path].size
 
   def get_sample_variant_index_for_chromosome(self, chrom, sample_name):
-    """Return the indexes pointing to the master list for given sample and chromosome"""
+    """Return the indexes pointing to the master list for given sample and chromosome. Samples stored as deltas are
+    reconstructed from their parents"""
     path = self._s_path(sample_name, chrom)
-    return self.fp[path][:] if path in self.fp else np.array([], dtype=[('index', 'i4'), ('gt', 'i1')])
+    if path not in self.fp:
+      return np.array([], dtype=[('index', 'i4'), ('gt', 'i1')])
+    if self._last_sample[0] == path:
+      return self._last_sample[1].copy()
+    dset = self.fp[path]
+    if 'parent' not in dset.attrs:
+      return dset[:]
+
+    parent_indexes = self.get_sample_variant_index_for_chromosome(chrom, dset.attrs['parent'])
+    delta, n_added = dset[:], dset.attrs['n_added']
+    added, removed_at = delta[:n_added], delta['at'][n_added:]
+    kept = np.ones(parent_indexes.size, dtype=bool)
+    kept[removed_at] = False
+    indexes = np.empty(dset.attrs['variant_count'], dtype=[('index', 'i4'), ('gt', 'i1')])
+    in_parent = np.ones(indexes.size, dtype=bool)
+    in_parent[added['at']] = False
+    for k in ['index', 'gt']:
+      indexes[k][added['at']] = added[k]
+      indexes[k][in_parent] = parent_indexes[k][kept]
+    self._last_sample = (path, indexes)
+    return indexes.copy()
 
   def get_sample_variant_list_for_chromosome(self, chrom, sample_name, ignore_zygosity=False):
     """Return variant list for this sample and chromosome."""
@@ -142,6 +209,20 @@ class Population:
       return [ml.variants[v_idx['index'][(v_idx['gt'] == 0) | (v_idx['gt'] == 2)]],
               ml.variants[v_idx['index'][(v_idx['gt'] == 1) | (v_idx['gt'] == 2)]]]
 
+  def set_pedigree(self, pedigree):
+    """Save the family tree of the samples. Error if it already exists
+
+    :param pedigree: [(sample_name, father, mother) ...] Use '' for parents that are not known
+    """
+    assert '/pedigree' not in self.fp, "The pedigree exists"
+    dtype = [('sample', Population.str_dt), ('father', Population.str_dt), ('mother', Population.str_dt)]
+    self.fp.create_dataset('/pedigree', shape=(len(pedigree),), dtype=dtype,
+                           data=np.array(pedigree, dtype=dtype), chunks=True, compression='gzip')
+
+  def get_pedigree(self):
+    """Return [(sample_name, father, mother) ...]. Empty if the population model did not record a family tree"""
+    return [tuple(x) for x in self.fp['/pedigree'][:]] if '/pedigree' in self.fp else []
+
   def get_sample_names(self):
     """Return a list of sample names"""
     return self.fp[self._s_path()].keys()
@@ -149,6 +230,9 @@ class Population:
   def get_version(self):
     return self.fp.attrs['Mitty version']
 
+  def close(self):
+    self.fp.close()
+
   #TODO: make more detailed
   def __repr__(self):
     """Pretty print the genome file"""
@@ -193,6 +277,118 @@ class Population:
     return rep_str
 
 
+class PopulationWriter:
+  """Write a new Population file from a separate process. The calls that write data (set_master_list,
+  add_sample_chromosome, set_pedigree) are the same as for Population but only queue the data and return immediately,
+  so we can go on generating the next sample while the last one is being compressed and written out. We need a
+  process, not a thread, because h5py holds the GIL while it compresses. The queue is bounded, so the producer waits
+  if it gets too far ahead of the writer. Arrays handed to the writer should not be changed afterwards.
+  """
+  def __init__(self, fname, genome_metadata, queue_depth=4):
+    """
+    :param fname:           name of the file to create
+    :param genome_metadata: [{seq_id, seq_len, seq_md5} ...] same as for Population
+    :param queue_depth:     number of items that can be waiting to be written before the producer is made to wait
+    """
+    self.q, self.result_q = multiprocessing.Queue(maxsize=queue_depth), multiprocessing.Queue()
+    self.proc = multiprocessing.Process(target=_population_writer, args=(fname, genome_metadata, self.q, self.result_q))
+    self.proc.daemon = True
+    self.proc.start()
+    self.stats = {'items': 0, 'max_queue_depth': 0, 'mean_queue_depth': 0.0, 'producer_stall_s': 0.0}
+    self._queue_depth_sum = 0
+
+  def _writer_result(self):
+    """What the writer process has sent back, if anything: its stats when it is done, or the traceback if it failed.
+    Raises RuntimeError if the process has died without sending anything"""
+    try:
+      return self.result_q.get_nowait()
+    except Queue.Empty:
+      if self.proc.is_alive():
+        return None
+    try:  # It may have sent something just before it exited
+      return self.result_q.get_nowait()
+    except Queue.Empty:
+      raise RuntimeError('Population writer process has died (exit code {})'.format(self.proc.exitcode))
+
+  def _put(self, item):
+    result = self._writer_result()
+    if result is not None:  # Before close, anything sent back means the writer has failed
+      raise RuntimeError('Population writer failed:\n' + result)
+    try:
+      depth = self.q.qsize()
+    except NotImplementedError:  # Mac OS X
+      depth = 0
+    self.stats['items'] += 1
+    self.stats['max_queue_depth'] = max(self.stats['max_queue_depth'], depth)
+    self._queue_depth_sum += depth
+    self.stats['mean_queue_depth'] = float(self._queue_depth_sum) / self.stats['items']
+
+    t0 = time.time()
+    while True:
+      try:
+        self.q.put(item, timeout=1.0)
+        break
+      except Queue.Full:
+        result = self._writer_result()
+        if result is not None:
+          raise RuntimeError('Population writer failed:\n' + result)
+    self.stats['producer_stall_s'] += time.time() - t0
+
+  def set_master_list(self, chrom, master_list):
+    assert master_list.sorted, 'Master list has not been sorted. Please check your program'
+    self._put(('set_master_list', chrom, master_list.variants))  # The collision index etc. need not be pickled
+
+  def add_sample_chromosome(self, chrom, sample_name, indexes, parent=None):
+    self._put(('add_sample_chromosome', chrom, sample_name, indexes, parent))
+
+  def set_pedigree(self, pedigree):
+    self._put(('set_pedigree', pedigree))
+
+  def close(self):
+    """Wait for the writer to finish and close the file.
+
+    :return: dict of stats: items written, max and mean queue depth seen by the producer, time the producer spent
+             waiting for room in the queue and time the writer spent busy and waiting for data
+    """
+    self._put(None)
+    while True:
+      try:
+        result = self.result_q.get(timeout=1.0)
+        break
+      except Queue.Empty:
+        result = self._writer_result()
+        if result is not None:
+          break
+    self.proc.join()
+    if not isinstance(result, dict):
+      raise RuntimeError('Population writer failed:\n' + result)
+    self.stats.update(result)
+    return self.stats
+
+
+def _population_writer(fname, genome_metadata, q, result_q):
+  """Main loop of the PopulationWriter process. Sends back the writer stats, or the traceback if we fail"""
+  try:
+    pop = Population(fname=fname, mode='w', genome_metadata=genome_metadata)
+    idle, busy = 0.0, 0.0
+    t0 = time.time()
+    for item in iter(q.get, None):
+      t1 = time.time()
+      idle += t1 - t0
+      if item[0] == 'set_master_list':
+        ml = VariantList()
+        ml.variants, ml.sorted = item[2], True
+        pop.set_master_list(item[1], ml)
+      else:
+        getattr(pop, item[0])(*item[1:])
+      t0 = time.time()
+      busy += t0 - t1
+    pop.close()
+    result_q.put({'writer_idle_s': idle, 'writer_busy_s': busy})
+  except Exception:
+    result_q.put(traceback.format_exc())
+
+
 def l2ca(l):
   """Convenience function that converts a Python list of tuples into an numpy structured array corresponding to a
   chromosome index array"""
@@ -215,6 +411,7 @@ class VariantList:
                                                dtype=[('pos', 'i4'), ('stop', 'i4'), ('ref', 'object'), ('alt', 'object'), ('p', 'f2')])
     self.sorted = False
     self.site_freq_spectrum = None
+    self._collision_index = (None, None)  # (variants the index was computed for, index)
 
   def __len__(self):
     return self.variants.shape[0]
@@ -240,6 +437,13 @@ class VariantList:
     self.variants = self.variants[idx]
     self.sorted = True
 
+  def get_collision_index(self):
+    """Return the collision index (see collision_index) for the master list. This is computed once and reused for
+    every sample we make from this master list. It is recomputed if the variants are replaced (e.g. by sort)"""
+    if self._collision_index[0] is not self.variants:
+      self._collision_index = (self.variants, collision_index(self.variants['pos'], self.variants['stop']))
+    return self._collision_index[1]
+
   def balance_probabilities(self, p, f):
     """Use the ideal site probability spectrum to rescale the probability values
     :param p: probability values
@@ -276,11 +480,11 @@ class VariantList:
       self.sort()
 
     # Pass 1: get rid of the colliding variants
-    pos, stop = self.variants['pos'], self.variants['stop']
-    z0, z1 = avoid_collisions(pos, stop, idx0), avoid_collisions(pos, stop, idx1)
+    nxt = self.get_collision_index()
+    z0, z1 = avoid_collisions_indexed(nxt, idx0), avoid_collisions_indexed(nxt, idx1)
 
     # Pass 2: merge homozygous where needed
-    return merge_homozygous(pos, z0, z1, filter_multi_allele)
+    return merge_homozygous(self.variants['pos'], z0, z1, filter_multi_allele)
 
   def generate_chromosome(self, rng):
     """Convenient wrapper around select and zip_up_chromosome
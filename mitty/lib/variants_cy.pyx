@@ -105,4 +105,82 @@ cpdef merge_homozygous(pos, z0, z1, bint filter_multi_allele=False):
     chrom_n += 1
     n1 += 1
 
-  return chrom[:chrom_n]
\ No newline at end of file
+  return chrom[:chrom_n]
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef collision_index(pos, stop):
+  """Precompute, for a position sorted master list, the index of the first variant that does not collide with each
+  variant. Variant j collides with variant i (i < j) if pos[j] <= stop[i]. Since pos is sorted, all the variants that
+  collide with i form the contiguous run i + 1 ... nxt[i] - 1
+
+  :param pos:  array of start positions of master list variants (sorted)
+  :param stop: array of end positions of master list variants
+  :return: nxt, an int32 array the same size as pos
+  """
+  _pos = np.asarray(pos, dtype=np.int32)
+  _stop = np.asarray(stop, dtype=np.int32)
+  return np.maximum(np.searchsorted(_pos, _stop, side='right'),
+                    np.arange(1, _pos.size + 1)).astype(np.int32)
+
+
+# (100k variant master list, 10% of variants selected, 10000 calls)
+#   483 ms for avoid_collisions
+#   283 ms for avoid_collisions_indexed
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef avoid_collisions_indexed(nxt, idx):
+  """Same as avoid_collisions, but uses the collision index of the master list so we never have to look at pos and stop.
+  idx should be in ascending order (as returned by nonzero), which is also what avoid_collisions assumes
+
+  :param nxt:  collision index, as returned by collision_index
+  :param idx:  array of indexes into the variant list
+  :return: an array of non-colliding indexes
+  """
+  cdef:
+    np.ndarray[np.int32_t, ndim=1] _nxt, z_idx = np.empty(len(idx), dtype=np.int32)
+    np.ndarray[np.int64_t, ndim=1] _idx
+    int n = 0, n_max = len(idx), z_n = 0, skip_to
+
+  _nxt = np.array(nxt, dtype=np.int32) if type(nxt) is not np.ndarray else nxt
+  _idx = np.array(idx, dtype=np.int64) if type(idx) is not np.ndarray or idx.dtype != np.int64 else idx
+
+  while n < n_max:
+    z_idx[z_n] = _idx[n]
+    z_n += 1
+    skip_to = _nxt[_idx[n]]
+    n += 1
+    while n < n_max and _idx[n] < skip_to:
+      n += 1  # Collision, skip
+  return z_idx[:z_n]
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def avoid_collisions_block(np.ndarray[np.int32_t, ndim=1] nxt, sel):
+  """Collision removal for a whole block of haplotypes in one pass. Each row of sel is one haplotype (chromosome copy)
+  with one column per master list variant. A row gives the same result as avoid_collisions(pos, stop, row.nonzero()[0])
+
+  :param nxt: collision index, as returned by collision_index
+  :param sel: boolean matrix (haplotypes x variants) indicating which variants are proposed for each haplotype
+  :return: list of arrays of non-colliding indexes, one per haplotype
+  """
+  cdef:
+    np.ndarray[np.uint8_t, ndim=2] _sel = np.ascontiguousarray(sel).view(np.uint8)
+    np.ndarray[np.int32_t, ndim=1] z_idx
+    int h, n, z_n, n_max = _sel.shape[1]
+
+  assert nxt.shape[0] == n_max, 'Collision index and selection are not the same size'
+  z_list = []
+  for h in range(_sel.shape[0]):
+    z_idx = np.empty(n_max, dtype=np.int32)
+    z_n, n = 0, 0
+    while n < n_max:
+      if _sel[h, n]:
+        z_idx[z_n] = n
+        z_n += 1
+        n = nxt[n]  # Jump over everything that collides with this
+      else:
+        n += 1
+    z_list.append(z_idx[:z_n].copy())
+  return z_list
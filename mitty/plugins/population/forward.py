@@ -0,0 +1,184 @@
+"""A forward-time population model. A founder generation is drawn from the master list, exactly like the standard model
+does for each sample, and the population then evolves for a number of generations by random mating. Each child gets one
+chromosome copy from the father and one from the mother, each a recombinant of the two copies the parent carries.
+Samples from the last few generations are written out, so parents, children and siblings (trios and pedigrees) occur
+naturally in the population. The family tree is stored in the genome file and can be printed by
+'genomes genome-file pedigree'.
+
+Haplotypes are stored bit-packed over the master list (one bit per variant), so a whole generation of 1000 individuals
+over a master list of 1 million variants takes 250 MB and recombination is a few slice copies per crossover.
+Variant collisions are resolved only when samples are written out, like in the standard model.
+"""
+import numpy as np
+
+import mitty.lib.util as mutil
+import mitty.lib.variants as vr
+
+__example_param_text = """
+{
+  "forward": {
+    "population_size": 1000,      # Number of individuals in each generation
+    "generations": 20,            # Number of generations to evolve the population for
+    "recombination_rate": 1e-8,   # Expected number of cross-overs per base per meiosis
+    "output_generations": 2,      # Write out the individuals of the last n generations (2 gives us trios)
+    "filter_multi_allele": False, # Take out loci with different variants on the two copies
+    "block_size": None            # Number of samples we unpack and write out at a time. None: as many as fit in 64 MB
+  }
+}
+"""
+
+_description = __doc__ + '\nExample parameters:\n' + __example_param_text
+
+#_example_params = json.loads(__example_param_text)
+_example_params = eval(__example_param_text)
+
+UNPACK_BYTES = 1 << 26  # Bytes of unpacked haplotypes we hold at a time when no block_size is given
+
+
+class Model:
+  def __init__(self, population_size=100, generations=10, recombination_rate=1e-8, output_generations=1,
+               filter_multi_allele=False, block_size=None):
+    """Forward-time population model that evolves bit-packed haplotypes over generations
+
+    :param population_size: number of individuals in each generation
+    :param generations: number of generations to evolve the founders for
+    :param recombination_rate: expected number of cross-overs per base per meiosis
+    :param output_generations: number of generations (counting back from the last one) to write out
+    :param filter_multi_allele: If True discard any alleles that are both non-Ref (and not homozygous)
+    :param block_size: number of samples that are unpacked and written out at a time. If None, as many as take up
+                       about UNPACK_BYTES unpacked (one byte per variant per chromosome copy)
+    """
+    assert population_size > 1, 'We need at least two individuals for sexual reproduction'
+    assert 0 < output_generations <= generations + 1, 'output_generations should be between 1 and generations + 1'
+    self.population_size, self.generations = population_size, generations
+    self.recombination_rate, self.output_generations = recombination_rate, output_generations
+    self.filter_multi_allele, self.block_size = filter_multi_allele, block_size
+    self.pedigree = None  # The family tree has to be the same for all chromosomes, so it is made on the first call
+
+  def make_pedigree(self, rng):
+    """Work out the parents of each individual in each generation. Individuals are alternately male and female. The
+    father of each child is picked from the males and the mother from the females of the previous generation
+
+    :param rng: random number generator
+    :return: list of (father, mother) index arrays, one for each generation after the founders
+    """
+    males = np.arange(0, self.population_size, 2)
+    females = np.arange(1, self.population_size, 2)
+    return [(rng.choice(males, size=self.population_size), rng.choice(females, size=self.population_size))
+            for _ in range(self.generations)]
+
+  def get_pedigree(self):
+    """Return [(sample_name, father, mother) ...] for every sample we write out. The parents of the founders are ''"""
+    if self.pedigree is None:
+      return []
+    first_gen = self.generations + 1 - self.output_generations
+    return [(sample_name(g, n),
+             sample_name(g - 1, self.pedigree[g - 1][0][n]) if g > 0 else '',
+             sample_name(g - 1, self.pedigree[g - 1][1][n]) if g > 0 else '')
+            for g in range(first_gen, self.generations + 1) for n in range(self.population_size)]
+
+  def founders(self, ml, rng):
+    """Draw the founder haplotypes from the master list based on the variant probabilities
+
+    :param ml: master list
+    :param rng: random number generator
+    :return: haplotype array (individuals x 2 x packed bytes)
+    """
+    p, n_v = ml.variants['p'], len(ml)
+    haps = np.empty((self.population_size, 2, (n_v + 7) // 8), dtype=np.uint8)
+    blk = max(1, (1 << 24) // max(1, 2 * n_v))  # Keep the random matrix to about 128 MB
+    for n in range(0, self.population_size, blk):
+      r = rng.rand(min(blk, self.population_size - n), 2, n_v)
+      haps[n:n + r.shape[0]] = np.packbits(r < p, axis=2)
+    return haps
+
+  def next_generation(self, haps, parents, pos, rng):
+    """Create the next generation from this one
+
+    :param haps: haplotype array of this generation (individuals x 2 x packed bytes)
+    :param parents: (father, mother) index arrays for the new generation
+    :param pos: position array of the master list
+    :param rng: random number generator
+    :return: haplotype array for the new generation
+    """
+    span = int(pos[-1]) + 1 if pos.size else 0
+    children = np.empty_like(haps)
+    for cpy, par in enumerate(parents):  # Copy 0 comes from the father, copy 1 from the mother
+      first_strand = rng.randint(2, size=par.size)
+      children[:, cpy] = haps[par, first_strand]  # Everything up to the first cross-over, in one go
+      cross_over_cnt = rng.poisson(self.recombination_rate * span, size=par.size)
+      for n in cross_over_cnt.nonzero()[0]:
+        breaks = np.searchsorted(pos, np.sort(rng.randint(0, span, size=cross_over_cnt[n])).astype(pos.dtype))
+        breaks = np.append(breaks, pos.size)
+        # Odd segments come from the other strand
+        other = haps[par[n], 1 - first_strand[n]]
+        for lo, hi in zip(breaks[0::2], breaks[1::2]):
+          copy_bits(other, children[n, cpy], lo, hi)
+    return children
+
+  def samples(self, chrom_no=None, ml=None, rng_seed=1, **kwargs):
+    """This returns an iterator
+
+    :param chrom_no:  number of the chromosome being considered [1,2,3 ...]  (ignored here)
+    :param ml:        VariantList. master list of variants as created by genomes program
+    :param rng_seed:  seed for random number generators
+    :return: A generator returning (sample name, chromosome, % samples done) for each sample in population
+    """
+    pedigree_rng, founder_rng, meiosis_rng = mutil.initialize_rngs(rng_seed, 3)
+    if self.pedigree is None:
+      self.pedigree = self.make_pedigree(pedigree_rng)
+    if not ml.sorted:
+      ml.sort()
+
+    # searchsorted copies a strided or differently typed haystack on every call, so we make it contiguous once here
+    pos = np.ascontiguousarray(ml.variants['pos'])
+    first_gen = self.generations + 1 - self.output_generations
+    haps = self.founders(ml, founder_rng)
+    out_gens = [haps] if first_gen == 0 else []
+    for g in range(self.generations):
+      haps = self.next_generation(haps, self.pedigree[g], pos, meiosis_rng)
+      if g + 1 >= first_gen:
+        out_gens.append(haps)
+
+    nxt, n_v, cnt = ml.get_collision_index(), len(ml), 0
+    block_size = self.block_size or max(1, UNPACK_BYTES // max(1, 2 * n_v))
+    for g, haps in enumerate(out_gens, first_gen):
+      for n0 in range(0, self.population_size, block_size):
+        blk = haps[n0:n0 + block_size]
+        sel = np.unpackbits(blk, axis=2)[:, :, :n_v].reshape(-1, n_v).view(bool)
+        z = vr.avoid_collisions_block(nxt, sel)
+        for n in range(blk.shape[0]):
+          cnt += 1
+          yield sample_name(g, n0 + n), \
+                vr.merge_homozygous(pos, z[2 * n], z[2 * n + 1], self.filter_multi_allele), \
+                float(cnt) / self.get_sample_count_estimate()
+
+  def get_sample_count_estimate(self):
+    """Give us an as exact as possible estimate of how many samples we will produce"""
+    return self.output_generations * self.population_size
+
+
+def sample_name(gen, n):
+  return 'g{:d}_s{:d}'.format(gen, n)
+
+
+def copy_bits(src, dst, lo, hi):
+  """Copy bits lo .. hi - 1 from src to dst. Both are arrays of bits packed by np.packbits (first bit is the MSB)
+
+  :param src: packed bits (uint8 array)
+  :param dst: packed bits (uint8 array) same size as src. Changed in place
+  :param lo: first bit to copy
+  :param hi: one past the last bit to copy
+  """
+  if hi <= lo:
+    return
+  lo_byte, hi_byte = lo >> 3, hi >> 3
+  lo_mask, hi_mask = 0xff >> (lo & 7), (0xff00 >> (hi & 7)) & 0xff  # Bits at or after lo, bits before hi
+  if lo_byte == hi_byte:
+    m = lo_mask & hi_mask
+    dst[lo_byte] = (dst[lo_byte] & ~m) | (src[lo_byte] & m)
+    return
+  dst[lo_byte] = (dst[lo_byte] & ~lo_mask) | (src[lo_byte] & lo_mask)
+  dst[lo_byte + 1:hi_byte] = src[lo_byte + 1:hi_byte]
+  if hi_mask:
+    dst[hi_byte] = (dst[hi_byte] & ~hi_mask) | (src[hi_byte] & hi_mask)
@@ -14,6 +14,9 @@ v2 E v3
 v(n-1) E vn
 
 This plugin does not honor the site frequency spectrum model and ignores the original 'p' values
+
+With 'delta_encode' set, each sample is stored in the genome file as the difference from the previous one (v0 from vx,
+v1 from v0 and so on) which keeps the file size linear, rather than quadratic, in the number of levels.
 """
 import numpy as np
 
@@ -22,6 +25,7 @@ __example_param_text = """
   "vn": {
     "p_vx": 0.2,
     "p_vn": [0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7],
+    "delta_encode": True
   }
 }
 """
@@ -33,13 +37,21 @@ _example_params = eval(__example_param_text)
 
 
 class Model:
-  def __init__(self, p_vx, p_vn):
+  def __init__(self, p_vx, p_vn, delta_encode=False):
     """A population model that creates samples with more and more variants. Suitable for the aligner paper experiments
 
     :param p_vx: probability value for vx set
     :param p_vn: probability values for v0, v1, v2, v3 .... set
+    :param delta_encode: If True store each sample as a delta against the previous one
     """
-    self.p_vx, self.p_vn = p_vx, p_vn
+    self.p_vx, self.p_vn, self.delta_encode = p_vx, p_vn, delta_encode
+
+  def parent_sample(self, sample_name):
+    """Return the name of the sample this one should be stored as a delta against, None for a full sample"""
+    if not self.delta_encode or sample_name == 'vx':
+      return None
+    n = int(sample_name[1:])
+    return 'vx' if n == 0 else 'v{:d}'.format(n - 1)
 
   def samples(self, chrom_no=None, ml=None, rng_seed=1, **kwargs):
     """This returns an iterator
@@ -1,19 +1,164 @@
-"""A dummy base class for read plugins to simplify some things"""
+"""Base classes for read plugins, and the two versions of what get_reads gives back.
+
+v1 (ReadModel.abi_version = 1): get_reads returns a recarray of ReadModel.dtype. Each read's sequence, corrupted
+sequence and base qualities are Python strings in object columns, which costs a string allocation per read per column.
+
+v2 (abi_version = 2): get_reads returns a ReadBatch, where the bases and qualities of all the reads of a batch are in
+uint8 arrays - an N x read_len matrix when the reads are all the same length, one buffer with the reads one after the
+other otherwise - and the start, length and order of the reads are plain numeric arrays.
+
+The simulator works on ReadBatch. It wraps v1 plugins with V1Adapter (see as_v2) so they keep working unchanged.
+"""
 import numpy as np
 
 
+class ReadBatch:
+  """A batch of reads in columns (read plugin ABI v2).
+
+    start_a    int64 array (N) - start of each read on the sequence it was taken from
+    read_len   int32 array (N) - length of each read
+    read_order int8 array (N)  - 0 for a read from the forward strand, 1 for one that is reverse complemented
+    seq        uint8 array - perfect reads. N x L if all reads have length L (fixed width), otherwise a flat buffer
+               with the reads one after the other (ragged, read n is seq[offsets[n]:offsets[n + 1]])
+    corrupt    uint8 array laid out like seq - corrupted reads. None if we did not make any
+    qual       uint8 array laid out like seq - base qualities (phred + 33) of the corrupted reads. For fixed width
+               reads this can also be a single row of L values that every read shares. None for perfect quality
+
+  The numeric columns can also be read by name, like the v1 recarray: batch['start_a']
+  """
+  _columns = ('start_a', 'read_len', 'read_order')
+
+  def __init__(self, start_a, read_len, read_order, seq, corrupt=None, qual=None):
+    self.start_a = np.asarray(start_a, dtype=np.int64)
+    self.read_len = np.asarray(read_len, dtype=np.int32)
+    self.read_order = np.asarray(read_order, dtype=np.int8)
+    self.seq = np.asarray(seq, dtype=np.uint8)
+    self.corrupt = np.asarray(corrupt, dtype=np.uint8) if corrupt is not None else None
+    self.qual = np.asarray(qual, dtype=np.uint8) if qual is not None else None
+    self._offsets = None
+
+  def __len__(self):
+    return self.start_a.shape[0]
+
+  def __getitem__(self, key):
+    if key not in self._columns:
+      raise KeyError(key)
+    return getattr(self, key)
+
+  @property
+  def nbytes(self):
+    return sum(c.nbytes for c in (self.start_a, self.read_len, self.read_order, self.seq, self.corrupt, self.qual)
+               if c is not None)
+
+  @property
+  def fixed_width(self):
+    return self.seq.ndim == 2
+
+  @property
+  def qual_shared(self):
+    """True if every read uses the same row of base qualities"""
+    return self.qual is not None and self.fixed_width and self.qual.ndim == 1
+
+  @property
+  def offsets(self):
+    """int64 array (N + 1) of where each read starts in the flattened columns"""
+    if self._offsets is None:
+      self._offsets = np.zeros(len(self) + 1, dtype=np.int64)
+      np.cumsum(self.read_len, out=self._offsets[1:])
+    return self._offsets
+
+  def flat(self, column):
+    """A column (seq, corrupt or qual) as a flat buffer, without copying"""
+    return column.reshape(-1) if column.ndim == 2 else column
+
+  def as_strings(self, column):
+    """A column (seq, corrupt or qual) as a list of one string per read. For tests and v1 style code"""
+    if column is None:
+      return [None] * len(self)
+    if column is self.qual and self.qual_shared:
+      return [column.tostring()] * len(self)
+    buf, off = self.flat(column).tostring(), self.offsets.tolist()
+    return [buf[off[n]:off[n + 1]] for n in xrange(len(self))]
+
+  @staticmethod
+  def empty(read_len=0):
+    return ReadBatch(np.empty(0), np.empty(0), np.empty(0), np.empty((0, read_len)))
+
+  @staticmethod
+  def concatenate(batches):
+    """Join batches, in order. The result is fixed width if all the batches are, with the same width"""
+    batches = [b for b in batches if len(b)] or batches[:1] or [ReadBatch.empty()]
+    if len(batches) == 1:
+      return batches[0]
+    widths = set(b.seq.shape[1] if b.fixed_width else -1 for b in batches)
+    fixed = len(widths) == 1 and widths.pop() >= 0
+
+    def stack(columns):
+      if any(c is None for c in columns):
+        return None
+      return np.concatenate(columns) if fixed else np.concatenate([c.reshape(-1) for c in columns])
+
+    quals, shared = [b.qual for b in batches], [b.qual_shared for b in batches]
+    if fixed and all(shared) and all(np.array_equal(q, quals[0]) for q in quals[1:]):
+      qual = quals[0]
+    else:  # Expand any shared rows out
+      qual = stack([np.tile(q, (len(b), 1)) if sh else q for q, sh, b in zip(quals, shared, batches)])
+    return ReadBatch(np.concatenate([b.start_a for b in batches]), np.concatenate([b.read_len for b in batches]),
+                     np.concatenate([b.read_order for b in batches]),
+                     stack([b.seq for b in batches]), stack([b.corrupt for b in batches]), qual)
+
+  @staticmethod
+  def from_recarray(reads):
+    """Convert the recarray a v1 plugin returns"""
+    read_len = np.asarray(reads['read_len'], dtype=np.int32)
+    n = reads.shape[0]
+
+    def column(strings):
+      if n == 0 or strings[0] is None:
+        return None
+      buf = np.frombuffer(''.join(strings), dtype=np.uint8)
+      if buf.shape[0] != read_len.sum():
+        raise ValueError('Read strings do not match read_len')
+      return buf
+
+    seq, corrupt = column(reads['perfect_reads']), column(reads['corrupt_reads'])
+    qual = column(reads['phred'])
+    if n and (read_len == read_len[0]).all():
+      seq = seq.reshape(n, -1) if seq is not None else np.empty((n, 0), dtype=np.uint8)
+      corrupt = corrupt.reshape(n, -1) if corrupt is not None else None
+      qual = qual.reshape(n, -1) if qual is not None else None
+    elif seq is None:
+      seq = np.empty((0, 0), dtype=np.uint8)
+    return ReadBatch(reads['start_a'], read_len, reads['read_order'], seq, corrupt, qual)
+
+
 class ReadModel:
   """Base class for read plugins"""
   dtype = [('start_a', 'i4'), ('read_len', 'i4'), ('read_order', 'i1'),
            ('perfect_reads', 'O'), ('corrupt_reads', 'O'), ('phred', 'O')]
+  # Version of what get_reads returns: 1 for a recarray of dtype, 2 for a ReadBatch
+  abi_version = 1
+  # Set this to True if get_reads can be given a lib.reads.HaplotypeView as seq (and None as seq_c). It then needs to
+  # cut out reads with lib.reads.extract_reads and only use len(seq) and slices of seq otherwise
+  accepts_haplotype_view = False
+  # Set this to True if get_reads takes an 'intervals' argument: an N x 2 array of (start, stop) regions to take reads
+  # from in one call, in place of start_base and end_base
+  accepts_intervals = False
 
   def __init__(self, paired):
     self.paired = paired
 
   def get_zero_reads(self):
     """Return empty array of reads. Useful for concatenation etc."""
+    if self.abi_version >= 2:
+      return ReadBatch.empty(), self.paired
     return np.recarray(dtype=ReadModel.dtype, shape=0), self.paired
 
+  def fixed_memory(self, seq_len):
+    """Bytes the plugin keeps between calls while working on a chromosome copy of length seq_len (tables built once
+    per copy and the like). Used to plan the memory of a run"""
+    return 0
+
   def get_reads(self, seq, seq_c, start_base=0, end_base=None, coverage=0.01, corrupt=False, seed=1):
     """The main simulation calls this function.
 
@@ -26,14 +171,41 @@ class ReadModel:
     :param seed:     random number generator seed
     :return: reads, paired
 
-    reads is a numpy recarray with the following fields
+    For v1 plugins reads is a numpy recarray with the following fields
       'start_a'  -> start index on the seq
       'read_len' -> length of the read
       'read_order' ->  0 or 1, indicating if the read is from the forward or reverse strand
       'perfect_reads'     -> perfect read sequence
       'corrupt_reads'   -> corrupted read sequence
       'phred'  -> phred score string for base quality
+    For v2 plugins it is a ReadBatch
 
     paired indicates if the reads are in pairs or not
     """
-    return self.get_zero_reads()
\ No newline at end of file
+    return self.get_zero_reads()
+
+
+class V1Adapter(ReadModel):
+  """Wrap a v1 read plugin so it gives ReadBatch"""
+  abi_version = 2
+
+  def __init__(self, model):
+    self.model = model
+    self.accepts_haplotype_view = model.accepts_haplotype_view
+    self.accepts_intervals = model.accepts_intervals
+    ReadModel.__init__(self, model.paired)
+
+  def __getattr__(self, name):  # read_len etc. of the plugin
+    return getattr(self.__dict__['model'], name)
+
+  def fixed_memory(self, seq_len):
+    return self.model.fixed_memory(seq_len) if hasattr(self.model, 'fixed_memory') else 0
+
+  def get_reads(self, *args, **kwargs):
+    reads, paired = self.model.get_reads(*args, **kwargs)
+    return ReadBatch.from_recarray(reads), paired
+
+
+def as_v2(model):
+  """The read model, wrapped if need be so that get_reads gives a ReadBatch"""
+  return model if getattr(model, 'abi_version', 1) >= 2 else V1Adapter(model)
@@ -32,12 +32,11 @@ _description = __doc__ + '\nExample parameter set:\n' + __example_param_text
 
 _example_params = eval(__example_param_text)
 
-from itertools import izip
-
 import numpy as np
 
 import mitty.lib.util as mutil
-from mitty.plugins.reads.base_plugin import ReadModel
+import mitty.lib.reads as lib_reads
+from mitty.plugins.reads.base_plugin import ReadModel, ReadBatch
 
 import logging
 logger = logging.getLogger(__name__)
@@ -45,6 +44,10 @@ logger = logging.getLogger(__name__)
 
 class Model(ReadModel):
   """Stock read plugin that approximates Illumina reads"""
+  abi_version = 2
+  accepts_haplotype_view = True
+  accepts_intervals = True
+
   def __init__(self, read_len=100, template_len_mean=250, template_len_sd=50, max_p_error=0.01, k=20, gc_bias=None):
     """Initialization
 
@@ -66,6 +69,7 @@ class Model(ReadModel):
     self.gc_bias = gc_bias
     if gc_bias is not None:
       self.gc_curve = self.initialize_gc_curve()
+    self._gc_cumsum = (None, None)  # (sequence, G/C running count), see gc_cumsum
     ReadModel.__init__(self, True)
 
   def initialize_gc_curve(self):
@@ -76,23 +80,41 @@ class Model(ReadModel):
     center, height, spread = self.gc_bias['bias_center'], self.gc_bias['bias_height'], self.gc_bias['bias_spread']
     return height * np.exp(-((gc_f - center) / spread) ** 2)
 
-  def gc_bias_reads(self, template_locs, template_lens, seq, gc_bias_rng):
+  def fixed_memory(self, seq_len):
+    """The G/C running count of gc_cumsum, kept for a chromosome copy, and the chunks it is built from"""
+    if self.gc_bias is None:
+      return 0
+    return 4 * (seq_len + 1) + 8 * GC_CHUNK_BASES
+
+  def gc_cumsum(self, seq):
+    """Running count of G/C bases in seq (cum[n] = G/C count in seq[:n]), kept for the last sequence we were given.
+    We build it a chunk of GC_CHUNK_BASES at a time, so only a chunk of a HaplotypeView is ever copied out"""
+    if self._gc_cumsum[0] is not seq:
+      cum = np.zeros(len(seq) + 1, dtype=np.int32)
+      for lo in range(0, len(seq), GC_CHUNK_BASES):
+        buf = np.frombuffer(seq[lo:lo + GC_CHUNK_BASES], dtype=np.uint8)
+        np.cumsum((buf == ord('G')) | (buf == ord('C')), dtype=np.int32, out=cum[lo + 1:lo + 1 + buf.size])
+        cum[lo + 1:lo + 1 + buf.size] += cum[lo]
+      self._gc_cumsum = (seq, cum)
+    return self._gc_cumsum[1]
+
+  def gc_accept_templates(self, seq, template_locs, template_lens, rng):
+    """Templates are proposed uniformly at bias_height, the peak of the GC curve. We keep each with probability
+    curve / bias_height, looking the curve up for the GC content of the template's own span, so the templates end up
+    placed with a density that follows the GC curve exactly
+
+    :param seq:           sequence
+    :param template_locs: start of each template
+    :param template_lens: length of each template
+    :param rng:           random number generator
+    :return: index of the templates we keep
     """
+    cum = self.gc_cumsum(seq)
+    gc_cnt = cum[template_locs + template_lens] - cum[template_locs]
+    template_bias = self.gc_curve[np.minimum((100 * gc_cnt / template_lens.astype(float)).astype(int), 99)]
+    return (rng.rand(template_locs.shape[0]) * self.gc_bias['bias_height'] < template_bias).nonzero()[0]
 
-    :param template_locs:
-    :param template_lens:
-    :return:
-    """
-    rg = gc_bias_rng.rand(len(template_locs))
-    s_cnt = seq.count
-    gc_crv = self.gc_curve
-    idx = [n for n, (r, t_loc, t_len) in enumerate(izip(rg, template_locs, template_lens))
-           if r < gc_crv[int(100 * (s_cnt('G', t_loc, t_loc + t_len) + s_cnt('C', t_loc, t_loc + t_len)) / float(t_len))]]
-    # return zip(*[(t_loc, t_len) for r, t_loc, t_len in izip(rg, template_locs, template_lens)
-    #              if r < gc_crv[int(100 * (s_cnt('G', t_loc, t_loc + t_len) + s_cnt('C', t_loc, t_loc + t_len)) / float(t_len))]])
-    return template_locs[idx], template_lens[idx]
-
-  def get_reads(self, seq, seq_c, start_base=0, end_base=None, coverage=0.01, corrupt=False, seed=1):
+  def get_reads(self, seq, seq_c, start_base=0, end_base=None, coverage=0.01, corrupt=False, seed=1, intervals=None):
     """The main simulation calls this function.
 
     :param seq:      forward sequence
@@ -102,39 +124,39 @@ class Model(ReadModel):
     :param coverage: coverage
     :param corrupt:  T/F whether we should compute corrupted read or not
     :param seed:     random number generator seed
+    :param intervals: N x 2 array of (start, stop). If given, take reads from these regions instead of
+                      start_base to end_base. Coverage is per base, so each region gets reads in proportion to its length
     :return: reads, paired
 
-    reads is a numpy recarray with the following fields
-      'start_a'  -> start index on the seq
-      'read_len' -> length of the read
-      'rev_complement' ->  0 or 1, indicating if the read is from the forward or reverse strand
-      'perfect_read'     -> perfect read sequence
-      'corrupted_read'   -> corrupted read sequence
+    reads is a ReadBatch of fixed width. All the corrupted reads share one row of base qualities (self.phred)
 
     paired indicates if the reads are in pairs or not
     """
-    end_base = end_base or len(seq)
+    if intervals is None:
+      intervals = [(start_base, end_base or len(seq))]
+    intervals = np.array(intervals, dtype=np.int64).reshape(-1, 2)
     p_template = 0.5 * coverage / float(self.read_len)  # Per base probability of a template
                                                         # 0.5 because each template has two reads
-    if self.gc_bias is not None:
-      p_template *= self.gc_bias['bias_height']
-    template_cnt = int(p_template * (end_base - start_base))
 
     template_loc_rng, read_order_rng, template_len_rng, error_loc_rng, base_choice_rng, gc_bias_rng = mutil.initialize_rngs(seed, 6)
-    template_locs = template_loc_rng.randint(start_base, end_base + 1, size=template_cnt)
+    if self.gc_bias is None:
+      template_locs, template_stops = uniform_template_locs(intervals, p_template, template_loc_rng)
+    else:  # Propose at the peak of the curve, see gc_accept_templates
+      template_locs, template_stops = uniform_template_locs(intervals, p_template * self.gc_bias['bias_height'],
+                                                            template_loc_rng, poisson=True)
     template_lens = (template_len_rng.randn(template_locs.shape[0]) * self.template_len_sd + self.template_len_mean).astype('i4')
-    idx = ((template_locs + template_lens < end_base) & (template_lens > self.read_len)).nonzero()[0]
+    idx = ((template_locs + template_lens < template_stops) & (template_lens > self.read_len)).nonzero()[0]
     template_locs, template_lens = template_locs[idx], template_lens[idx]
     if self.gc_bias is not None:
-      template_locs, template_lens = self.gc_bias_reads(template_locs, template_lens, seq, gc_bias_rng)
+      idx = self.gc_accept_templates(seq, template_locs, template_lens, gc_bias_rng)
+      template_locs, template_lens = template_locs[idx], template_lens[idx]
 
     read_order = read_order_rng.randint(2, size=template_locs.shape[0])  # Which read comes first?
 
-    reads = np.recarray(dtype=ReadModel.dtype, shape=2 * template_locs.shape[0])
-    r_start, r_o, pr = reads['start_a'], reads['read_order'], reads['perfect_reads']
-    reads['read_len'] = self.read_len
-    reads['read_order'][::2] = read_order[:]
-    reads['read_order'][1::2] = 1 - read_order[:]
+    r_start = np.empty(2 * template_locs.shape[0], dtype=np.int64)
+    r_o = np.empty(2 * template_locs.shape[0], dtype=np.int8)
+    r_o[::2] = read_order[:]
+    r_o[1::2] = 1 - read_order[:]
     r_len = self.read_len
 
     idx_fwd = (read_order == 0).nonzero()[0]
@@ -145,12 +167,8 @@ class Model(ReadModel):
     r_start[2 * idx_rev] = template_locs[idx_rev] + template_lens[idx_rev] - r_len
     r_start[2 * idx_rev + 1] = template_locs[idx_rev]
 
-    for n in xrange(reads.shape[0]):
-      if r_o[n] == 0:  # Forward read comes first
-        pr[n] = seq[r_start[n]:r_start[n] + r_len]
-      else:  # Reverse strand read
-        pr[n] = seq_c[r_start[n]:r_start[n] + r_len][::-1]
-
+    reads = ReadBatch(r_start, np.full(r_start.shape[0], r_len, dtype=np.int32), r_o,
+                      lib_reads.extract_reads(seq, r_start, r_o, r_len))
     if corrupt:
       self.corrupt_reads(reads, error_loc_rng, base_choice_rng)
     return reads, self.paired
@@ -158,27 +176,61 @@ class Model(ReadModel):
   def corrupt_reads(self, reads, error_loc_rng, base_choice_rng):
     """Corrupt reads
 
-    :param reads:   with the start_a, read_len and read_order fields filled out
-    :return: Fill in corrupted reads in place
+    :param reads:   ReadBatch with the perfect reads (seq) filled out
+    :return: Fill in corrupted reads and base qualities in place
     """
-    pr, cr, ph = reads['perfect_reads'], reads['corrupt_reads'], reads['phred']
-    p = error_loc_rng.rand(reads.shape[0], self.read_len)
-    idx = [np.where(p[n, :] < self.error_profile)[0] for n in xrange(reads.shape[0])]
-    idx_tot = 0
-    for n in xrange(reads.shape[0]):
-      idx_tot += idx[n].size
-    corrupt_bases = base_choice_rng.choice(['A','C','G','T'], size=idx_tot, replace=True, p=[.3, .2, .2, .3]).tostring()
-
-    offset = 0
-    for n in xrange(reads.shape[0]):
-      ph[n] = self.phred
-      #idx, = np.where(p[n, :] < self.error_profile)
-      #corrupt_bases = base_choice_rng.choice(['A','C','G','T'], size=idx.size, replace=True, p=[.3, .2, .2, .3]).tostring()
-      b = bytearray(pr[n])
-      for m, i in enumerate(idx[n]):
-        b[i] = corrupt_bases[offset +m]
-      cr[n] = str(b)
-      offset += idx[n].size
+    rows, cols = sample_error_locations(error_loc_rng, len(reads), self.error_profile)
+    corrupted = reads.seq.copy()
+    corrupted[rows, cols] = base_choice_rng.choice(np.fromstring('ACGT', dtype=np.uint8), size=rows.size,
+                                                   replace=True, p=[.3, .2, .2, .3])
+    reads.corrupt = corrupted
+    reads.qual = np.frombuffer(self.phred, dtype=np.uint8)  # Every read shares the one row
+
+
+GC_CHUNK_BASES = 1 << 22  # gc_cumsum copies out this many bases at a time
+
+
+def uniform_template_locs(intervals, p_template, rng, poisson=False):
+  """Place templates uniformly over a set of intervals. Each base is a candidate start, as is the stop of each interval
+
+  :param intervals:  N x 2 array of (start, stop)
+  :param p_template: per base template probability
+  :param rng:        random number generator
+  :param poisson:    if True draw the number of templates from a Poisson distribution, so that the expected number is
+                     kept even when it is below one. Otherwise take the expected number, rounded down
+  :return: template_locs, template_stops - start of each template and the end of the interval it is in
+  """
+  i_len = np.maximum(0, intervals[:, 1] - intervals[:, 0])
+  template_cnt = rng.poisson(p_template * i_len.sum()) if poisson else int(p_template * i_len.sum())
+  cs = np.cumsum(i_len + 1)
+  u = rng.randint(0, cs[-1], size=template_cnt) if cs.size else np.array([], dtype=np.int64)
+  k = np.searchsorted(cs, u, side='right')
+  return intervals[k, 0] + u - (cs[k] - i_len[k] - 1), intervals[k, 1]
+
+
+def sample_error_locations(rng, n_reads, error_profile):
+  """Pick the read bases that have errors. For each cycle (base position in the read) we draw the number of errors from
+  a binomial distribution and then pick that many distinct reads, so the work done is proportional to the number of
+  errors, not the number of bases
+
+  :param rng:           random number generator
+  :param n_reads:       number of reads
+  :param error_profile: probability of an error at each cycle
+  :return: rows, cols - read index and cycle of each error
+  """
+  rows, cols = [np.array([], dtype=np.int64)], [np.array([], dtype=np.int64)]
+  for cycle, k in enumerate(rng.binomial(n_reads, np.clip(error_profile, 0, 1.0))):
+    if k == 0:
+      continue
+    if k > n_reads // 4:  # Errors are not rare here, a permutation is cheap enough
+      pos = np.sort(rng.choice(n_reads, size=k, replace=False))
+    else:
+      pos = np.unique(rng.randint(n_reads, size=k))
+      while pos.size < k:  # Redraw the few duplicates
+        pos = np.unique(np.concatenate((pos, rng.randint(n_reads, size=k - pos.size))))
+    rows.append(pos)
+    cols.append(np.full(k, cycle, dtype=np.int64))
+  return np.concatenate(rows), np.concatenate(cols)
 
 
 def self_test():
@@ -189,7 +241,7 @@ def self_test():
   seq_c = string.translate(seq, DNA_complement)
   mdl = Model(4, 8, 2, max_p_error=1)
   rd, paired = mdl.get_reads(seq, seq_c, start_base=0, end_base=len(seq), coverage=.00001, corrupt=True)
-  assert type(rd) == np.core.records.recarray  # Basically, the previous code should just run
+  assert isinstance(rd, ReadBatch)  # Basically, the previous code should just run
   assert paired == True
 
 if __name__ == "__main__":
@@ -20,20 +20,23 @@ _example_params = eval(__example_param_text)
 
 import numpy as np
 
-from mitty.plugins.reads.base_plugin import ReadModel
+import mitty.lib.reads as lib_reads
+from mitty.plugins.reads.base_plugin import ReadModel, ReadBatch
 
 import logging
 logger = logging.getLogger(__name__)
 
 
 class Model(ReadModel):
+  abi_version = 2
+  accepts_intervals = True
+
   def __init__(self, read_len=100, template_len=250, paired=True):
     """."""
     self.read_len, self.template_len = read_len, template_len
-    self.start_base = 0
     ReadModel.__init__(self, paired)
 
-  def get_reads(self, seq, seq_c, start_base=0, end_base=None, coverage=0.01, corrupt=False, seed=1):
+  def get_reads(self, seq, seq_c, start_base=0, end_base=None, coverage=0.01, corrupt=False, seed=1, intervals=None):
     """The main simulation calls this function.
 
     :param seq:      forward sequence
@@ -43,45 +46,38 @@ class Model(ReadModel):
     :param coverage: coverage
     :param corrupt:  T/F whether we should compute corrupted read or not
     :param seed:     random number generator seed
+    :param intervals: N x 2 array of (start, stop). If given, take reads from these regions instead of
+                      start_base to end_base. Otherwise we use the stretches of start_base to end_base without N
     :return: reads, paired
 
-    reads is a numpy recarray with the following fields
-      'start_a'  -> start index on the seq
-      'read_len' -> length of the read
-      'rev_complement' ->  0 or 1, indicating if the read is from the forward or reverse strand
-      'perfect_read'     -> perfect read sequence
-      'corrupted_read'   -> corrupted read sequence
+    reads is a ReadBatch of fixed width. The corrupted reads, if asked for, are the perfect reads with perfect qualities
 
     paired indicates if the reads are in pairs or not
     """
     assert len(seq) > self.template_len, 'Template size should be less than sequence length'
-    while seq[self.start_base] == 'N' or self.start_base < start_base:
-      self.start_base += 10
+    if intervals is None:
+      intervals = lib_reads.intersect_intervals(lib_reads.n_free_intervals(seq), [(start_base, end_base or len(seq))])
+    intervals = np.array(intervals, dtype=np.int64).reshape(-1, 2)
 
     stride = float(self.read_len) / coverage
-    template_locs = np.array([x for x in np.arange(self.start_base, end_base or len(seq), stride, dtype='i4') if seq[x] != 'N'], dtype='i4')
-
-    reads = np.core.recarray(dtype=ReadModel.dtype, shape=(2 if self.paired else 1) * template_locs.shape[0])
-    reads['read_len'] = self.read_len
+    template_len = self.template_len if self.paired else self.read_len
+    # A template every stride bases from the start of each interval, leaving out those that run off its end
+    template_locs = np.concatenate([np.array([], dtype=np.int64)] +
+                                   [np.arange(start, stop - template_len + 1, stride).astype(np.int64)
+                                    for start, stop in intervals])
+
+    n_reads = (2 if self.paired else 1) * template_locs.shape[0]
+    start_a, read_order = np.empty(n_reads, dtype=np.int64), np.zeros(n_reads, dtype=np.int8)
     if self.paired:
-      reads['start_a'][::2] = template_locs
-      reads['start_a'][1::2] = template_locs + self.template_len - self.read_len
-      reads['read_order'][::2] = 0
-      reads['read_order'][1::2] = 1
+      start_a[::2] = template_locs
+      start_a[1::2] = template_locs + self.template_len - self.read_len
+      read_order[1::2] = 1
     else:
-      reads['start_a'] = template_locs
-      reads['read_len'] = self.read_len
-      reads['read_order'] = 0
-
-    r_start, r_len, r_o, pr, cr = reads['start_a'], reads['read_len'], reads['read_order'], reads['perfect_reads'], reads['corrupt_reads']
-    for n in xrange(reads.shape[0]):
-      if r_o[n] == 0:  # Forward read
-        pr[n] = seq[r_start[n]:r_start[n] + r_len[n]]
-      else:  # Reverse strand read
-        pr[n] = seq_c[r_start[n]:r_start[n] + r_len[n]][::-1]
-      if corrupt:
-        cr[n] = pr[n]
+      start_a[:] = template_locs
 
+    read_matrix = lib_reads.extract_reads(seq, start_a, read_order, self.read_len)
+    reads = ReadBatch(start_a, np.full(n_reads, self.read_len, dtype=np.int32), read_order, read_matrix,
+                      corrupt=read_matrix if corrupt else None)
     return reads, self.paired
 
 
@@ -93,7 +89,7 @@ def self_test():
   seq_c = string.translate(seq, DNA_complement)
   mdl = Model(4, 8, True)
   rd, paired = mdl.get_reads(seq, seq_c, start_base=0, end_base=len(seq), coverage=.00001, corrupt=True)
-  assert type(rd) == np.core.records.recarray  # Basically, the previous code should just run
+  assert isinstance(rd, ReadBatch)  # Basically, the previous code should just run
   assert paired is True
 
 
@@ -1,17 +1,29 @@
 #!python
+import hashlib
 import json
 import os
 import time
 import io
-import gzip
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from functools import partial
 
 import numpy as np
+import h5py
 import click
+import pysam
 
 import mitty.lib
 import mitty.lib.reads as lib_reads
 import mitty.lib.mio as mio
 import mitty.lib.variants as vr
+import mitty.lib.pipeline as pipeline
+import mitty.lib.truth as truth
+import mitty.lib.coverage as coverage
+import mitty.lib.blockplan as blockplan
+from mitty.plugins.reads.base_plugin import ReadBatch, as_v2
+from mitty.version import __version__
 
 import logging
 logger = logging.getLogger(__name__)
@@ -32,7 +44,20 @@ __param__ = """Parameter file example::
                               # files will then be named reads_1.fq, reads_c_1.fq and reads_2.fq, reads_c_2.fq
                               # If the reads are actually not paired and you set interleaved to false you will get two
                               # files _1 and _2 and all the data will be in _1 only
-      "gzipped": true    # file(s) should be gzipped
+      "gzipped": true,   # file(s) should be gzipped. They are written as BGZF, compressed on --gzip-threads threads
+      "unaligned_bam": false, # Also write the reads as an unaligned BAM (reads.unaligned.bam)
+      "truth_bam": false,     # Also write the reads as a coordinate sorted, indexed, BAM aligned to where they came from
+                              # (reads.truth.bam). A perfect aligner baseline, without aligning the FASTQ and running
+                              # perfectbam. The BAMs hold the corrupted reads if we call for them, the perfect ones if not
+      "compact_qnames": false # If true, qnames are just the read serial. The truth goes in a sidecar (reads.truth.h5)
+                              # read by perfectbam --truth. Use this for indel heavy simulations, where the qnames can
+                              # be longer than the reads
+      "targets": "exome.bed"  # Optional. Only take reads from the intervals in this BED file (e.g. an exome or panel).
+                              # Sequence names should match the reference sequence ids (or be chromosome numbers)
+      "haplotype_cache": "Cache/"  # Optional. Keep the expanded chromosome copies of the sample here, and reuse them
+                                   # in later runs with the same genome file, sample and reference
+      "coverage_track": false # Also write how deeply the reads cover the reference, for each chromosome copy, in bins
+                              # of coverage_bin bases (reads.coverage.h5, see mitty.lib.coverage)
     },
     "sample_name": "g0_s0",   # Name of sample
     "rng": {
@@ -43,11 +68,19 @@ __param__ = """Parameter file example::
                                         # [2, 0.7, 0.8]] -> chrom2, take reads only from fraction 0.7 to 0.8 of chromosome
     "variants_only": false,             # If true, reads will only come from the vicinity of variants
     "variant_window": 500,              # Only used if variants_only is true. Reads will be taken from this vicinity
+    "target_padding": 100,              # Only used with a targets file. Bases added to either side of each target
+    "coverage_bin": 100,                # Only used with coverage_track. Bases per bin of the coverage track
     "corrupt": true,                    # If true, corrupted reads will also be written
     "coverage": 10,                     # Coverage
     "coverage_per_block": 0.01          # For each block of the simulation we generate reads giving this coverage
                                         # In some simulations we will have too many reads to fit in memory and we must
                                         # write them out in blocks of smaller size.
+                                        # Blocks are written out longest chromosome first. The reads in a block depend
+                                        # only on the master seed, chromosome, copy and block number, so the output is
+                                        # the same however many worker processes (--workers) we use
+                                        # With --max-mem the blocks are sized to fit the memory budget instead, and
+                                        # this, if given, is the smallest block count. Different block counts give
+                                        # different reads for the same seed
     "read_model": "simple_illumina",    # Model specific parameters, need to be under the key "model_params"
     "model_params": {
       "read_len": 100,          # length of each read
@@ -81,34 +114,103 @@ cigar       = correct CIGAR string                                      |
 """
 
 
+class SharedInputs:
+  """What a read simulation needs that does not depend on the sample: the reference, the genome file and what we work
+  out from them. A Cohort makes one of these for all its samples, so the reference is loaded, and the master list of
+  each chromosome decoded, only once"""
+  def __init__(self, base_dir, params, ref_file=None, db_file=None, haplotype_cache_dir=None):
+    """
+    :param base_dir: the directory with respect to which relative file paths will be resolved
+    :param params: dict loaded from json file
+    :param ref_file: Override for reference file
+    :param db_file: Override for genome DB file
+    :param haplotype_cache_dir: Override for haplotype cache directory
+    """
+    self.ref = mio.Fasta(multi_fasta=ref_file or mitty.lib.rpath(base_dir, params['files'].get('reference_file', None)),
+                         multi_dir=mitty.lib.rpath(base_dir, params['files'].get('reference_dir', None)),
+                         persistent=True)
+
+    self.pop = None
+    if 'dbfile' in params['files'] or db_file is not None:
+      self.pop_db_name = db_file or mitty.lib.rpath(base_dir, params['files']['dbfile'])
+      self.open_pop()
+    else:
+      self.pop_db_name = None
+      logger.debug('Taking reads from reference')
+
+    # Expanded chromosome copies are cached by the contents of the genome file, so we hash it once here (and not in
+    # each worker process). Reads from the reference need no expanding
+    self.haplotype_cache_dir = haplotype_cache_dir or \
+      mitty.lib.rpath(base_dir, params['files'].get('haplotype_cache', None))
+    if self.haplotype_cache_dir is not None and not os.path.exists(self.haplotype_cache_dir):
+      os.makedirs(self.haplotype_cache_dir)
+    self.pop_hash = file_hash(self.pop_db_name) \
+      if self.haplotype_cache_dir is not None and self.pop is not None else None
+
+    self._n_free = {}  # chrom -> runs of the reference without N, see get_n_free_intervals
+    self._master_list = (None, None)  # (chrom, VariantList) for the chromosome we last worked on
+    # The last chromosome copy worked on, by any of the samples, as ((sample_name, chrom, cpy), HaplotypeView) and
+    # ((sample_name, chrom, cpy), (seq, seq_c)). See ReadSimulator.get_haplotype and get_expanded_sequence
+    self.last_haplotype = (None, None)
+    self.last_expanded_seq = (None, None)
+
+  def open_pop(self):
+    if self.pop_db_name is not None:
+      self.pop = vr.Population(fname=self.pop_db_name, mode='r', in_memory=False)
+
+  def close_pop(self):
+    """Close the genome file before forking worker processes. Otherwise HDF5 hands them our open file, and they trip
+    over each other reading it. They, and we, call open_pop afterwards"""
+    if self.pop is not None:
+      self.pop.close()
+      self.pop = None
+
+  def get_master_list(self, chrom):
+    """Master list of variants of the chromosome. We keep the last one, since blocks come chromosome by chromosome (for
+    all the samples, in a Cohort)"""
+    if self._master_list[0] != chrom:
+      self._master_list = (None, None)  # Let go of the old list before decoding the new one
+      self._master_list = (chrom, self.pop.get_variant_master_list(chrom=chrom))
+    return self._master_list[1]
+
+  def get_n_free_intervals(self, chrom):
+    """N x 2 array of (start, stop) of the stretches of the reference chromosome without N. Reads are only taken from
+    these, mapped onto each chromosome copy. Worked out once for each chromosome"""
+    if chrom not in self._n_free:
+      self._n_free[chrom] = lib_reads.n_free_intervals(self.ref[chrom]['seq'])
+    return self._n_free[chrom]
+
+
 class ReadSimulator:
   """A convenience class that wraps the parameters and settings for a read simulation"""
-  def __init__(self, base_dir, params, ref_file=None, db_file=None, out_prefix=None):
+  def __init__(self, base_dir, params, ref_file=None, db_file=None, out_prefix=None, gzip_threads=1,
+               queue_depth=2, queue_mem=None, haplotype_cache_dir=None, inputs=None, gzip_pool=None):
     """Create a read simulator object
 
     :param base_dir: the directory with respect to which relative file paths will be resolved
     :param params: dict loaded from json file
+    :param haplotype_cache_dir: Override for haplotype cache directory
+    :param gzip_threads: number of threads compressing the output, if it is gzipped
+    :param queue_depth: number of blocks waiting between two stages of the pipeline
+    :param queue_mem: bytes (approximately) of blocks waiting in the pipeline as a whole. None for no limit
+    :param inputs: SharedInputs to use (see Cohort). If None we load our own, with ref_file, db_file and
+                   haplotype_cache_dir
+    :param gzip_pool: ThreadPool to compress gzipped output on, in place of one of our own with gzip_threads threads.
+                      We leave it open when we close
     """
 
     fname_prefix = out_prefix or mitty.lib.rpath(base_dir, params['files']['output_prefix'])
     if not os.path.exists(os.path.abspath(os.path.dirname(fname_prefix))):
       os.makedirs(os.path.dirname(fname_prefix))
 
-    self.ref = mio.Fasta(multi_fasta=ref_file or mitty.lib.rpath(base_dir, params['files'].get('reference_file', None)),
-                         multi_dir=mitty.lib.rpath(base_dir, params['files'].get('reference_dir', None)),
-                         persistent=True)
-
+    self.inputs = inputs or SharedInputs(base_dir, params, ref_file=ref_file, db_file=db_file,
+                                         haplotype_cache_dir=haplotype_cache_dir)
+    self.ref, self.pop_db_name = self.inputs.ref, self.inputs.pop_db_name
     self.sample_name = params.get('sample_name', None)
-    if 'dbfile' in params['files'] or db_file is not None:
-      pop_db_name = db_file or mitty.lib.rpath(base_dir, params['files']['dbfile'])
-      self.pop = vr.Population(fname=pop_db_name, mode='r', in_memory=False)
-    else:
-      self.pop = None
-      logger.debug('Taking reads from reference')
+    self.haplotype_cache_hits = 0
 
-    master_seed = int(params['rng']['master_seed'])
-    assert 0 < master_seed < mitty.lib.SEED_MAX
-    self.seed_rng = np.random.RandomState(seed=master_seed)
+    self.master_seed = int(params['rng']['master_seed'])
+    assert 0 < self.master_seed < mitty.lib.SEED_MAX
 
     # In the parameter file we only need to specify a region with the chromosome only if we are not taking reads from
     # the entire chromosome. This is for convenience. Here we have to unpack this into a consistent format
@@ -120,20 +222,49 @@ class ReadSimulator:
 
     self.coverage = float(params['coverage'])
 
-    total_blocks_to_do = self.coverage / float(params['coverage_per_block'])
+    # Without coverage_per_block we start from one block per chromosome copy and leave it to plan_memory
+    total_blocks_to_do = self.coverage / float(params['coverage_per_block']) \
+      if 'coverage_per_block' in params else None
 
     chrom_meta = self.ref.get_seq_metadata()
     self.sum_of_chromosome_lengths = float(sum([chrom_meta[c - 1]['seq_len'] for c in self.chromosomes]))
-    self.blocks_for_chromosome = {c: int(max(1, round(total_blocks_to_do * (self.chromosome_regions[c]['stop_f'] - self.chromosome_regions[c]['start_f']) * chrom_meta[c - 1]['seq_len'] / self.sum_of_chromosome_lengths)))
-                                  for c in self.chromosomes}
 
-    self.read_model = mitty.lib.load_reads_plugin(params['read_model']).Model(**params['model_params'])
+    # Targets are kept in reference coordinates and mapped onto each chromosome copy when we make reads from it
+    targets_fname = mitty.lib.rpath(base_dir, params['files'].get('targets', None))
+    self.targets = load_targets(targets_fname, chrom_meta, self.chromosome_regions,
+                                int(params.get('target_padding', 0))) if targets_fname else None
+    self.sum_of_target_lengths = float(sum(int((t[:, 1] - t[:, 0]).sum()) for t in self.targets.values())) \
+      if self.targets is not None else None
+    if self.targets is not None and total_blocks_to_do is not None:
+      # Block size (bases x coverage) is the same as for a whole genome run, so a small target set needs few blocks
+      total_blocks_to_do *= self.sum_of_target_lengths / self.sum_of_chromosome_lengths
+    self.blocks_for_chromosome = {c: int(max(1, round(total_blocks_to_do * self.get_region_len(c) / (self.sum_of_target_lengths or self.sum_of_chromosome_lengths))))
+                                  for c in self.chromosomes} if total_blocks_to_do is not None else \
+                                 {c: 1 for c in self.chromosomes}
+    self.min_blocks = dict(self.blocks_for_chromosome) if total_blocks_to_do is not None else None
+
+    self.read_model = as_v2(mitty.lib.load_reads_plugin(params['read_model']).Model(**params['model_params']))
     self.corrupt_reads = bool(params['corrupt'])
 
     self.variants_only = params.get('variants_only', None)
     self.variant_window = int(params.get('variant_window', 200)) if self.variants_only else None
 
-    fname_suffix, open_fun = ('.fq.gz', gzip.open) if params['files'].get('gzipped', False) else ('.fq', open)
+    self.queue_depth, self.queue_mem = queue_depth, queue_mem
+    self.stage_stats = None  # Filled out by generate_and_save_reads
+    self.memory_plan = None  # Filled out by plan_memory
+    self.block_rss = []  # (chrom, cpy, blk, peak RSS in bytes) after each block is written
+    self.worker_rss = {}  # pid -> peak RSS (bytes) of each worker process
+
+    self.gzip_pool = None
+    self.gzipped = params['files'].get('gzipped', False)
+    if self.gzipped:
+      # Block gzipped (BGZF) so compression can be spread over threads. The output files share the pool
+      self.gzip_pool = gzip_pool or (ThreadPool(gzip_threads) if gzip_threads > 1 else None)
+      fname_suffix = '.fq.gz'
+      open_fun = lambda fname, mode: mio.BgzfWriter(fname, mode, threads=gzip_threads, pool=self.gzip_pool)
+    else:
+      fname_suffix, open_fun = '.fq', open
+    self._own_gzip_pool = self.gzip_pool is not None and self.gzip_pool is not gzip_pool
     if params['files'].get('interleaved', True):
       self.fastq_fp = [open_fun(fname_prefix + fname_suffix, 'w')] * 2
       self.fastq_c_fp = [open_fun(fname_prefix + '_c' + fname_suffix, 'w')] * 2 if self.corrupt_reads else [None, None]
@@ -141,10 +272,82 @@ class ReadSimulator:
       self.fastq_fp = [open_fun(fname_prefix + '_1' + fname_suffix, 'w'), open_fun(fname_prefix + '_2' + fname_suffix, 'w')]
       self.fastq_c_fp = [open_fun(fname_prefix + '_c_1' + fname_suffix, 'w'), open_fun(fname_prefix + '_c_2' + fname_suffix, 'w')] if self.corrupt_reads else [None, None]
 
+    self.compact_qnames = params['files'].get('compact_qnames', False)
+    self.truth_writer = truth.TruthWriter(fname_prefix + '.truth.h5', paired=self.read_model.paired) \
+      if self.compact_qnames else None
+    self.coverage_writer = coverage.CoverageWriter(
+      fname_prefix + '.coverage.h5', {c: chrom_meta[c - 1]['seq_len'] for c in self.chromosomes},
+      bin_size=int(params.get('coverage_bin', 100))) if params['files'].get('coverage_track', False) else None
+
+    self.bam_fp, self.bam_fname = {}, {}
+    if params['files'].get('unaligned_bam', False) or params['files'].get('truth_bam', False):
+      self.open_bams(fname_prefix, params['files'].get('unaligned_bam', False), params['files'].get('truth_bam', False),
+                     gzip_threads)
+    self.bam_templates_written = 0
+
     self.templates_written = 0
     self.reads_generated = 0
     self.bases_covered = 0
 
+  def open_bams(self, fname_prefix, unaligned, truth, threads=1):
+    """Open the BAM files. The truth BAM is written unsorted and sorted when we close"""
+    header = {'HD': {'VN': '1.4', 'SO': 'unsorted'},
+              'PG': [{'ID': 'mitty-reads', 'PN': 'reads', 'VN': __version__}]}
+    if unaligned:
+      self.bam_fname['unaligned'] = fname_prefix + '.unaligned.bam'
+      self.bam_fp['unaligned'] = pysam.AlignmentFile(self.bam_fname['unaligned'], 'wb', header=header, threads=threads)
+    if truth:
+      seq_meta = self.ref.get_seq_metadata()
+      header['SQ'] = [{'SN': m['seq_id'].split(' ')[0], 'LN': m['seq_len']} for m in seq_meta]
+      self.bam_rname = [m['seq_id'].split(' ')[0] for m in seq_meta]
+      self.bam_fname['truth'] = fname_prefix + '.truth.bam'
+      self.bam_fp['truth'] = pysam.AlignmentFile(self.bam_fname['truth'][:-4] + '.unsorted.bam', 'wb', header=header,
+                                                 threads=threads)
+    self.bam_threads = threads
+
+  def plan_memory(self, max_mem, workers=1):
+    """Size the blocks for each chromosome, and the memory for queued blocks, to fit in a memory budget. Call before
+    generate_and_save_reads.
+
+    :param max_mem: memory budget in bytes, for us and any worker processes together
+    :param workers: number of worker processes we will use
+    :return: a lib.blockplan.BlockPlan, also kept as memory_plan
+    """
+    read_len = getattr(self.read_model, 'read_len', 100)
+    reads_per_copy = {c: 0.5 * self.coverage * self.get_region_len(c) / read_len for c in self.chromosomes}
+    if self.compact_qnames:
+      qname_len = len(str(int(sum(reads_per_copy.values())))) + 2
+    else:  # serial|chrom|copy + ro|pos|rlen|cigar for each mate, with short CIGARs
+      seq_len = max(self.ref.get_seq_metadata()[c - 1]['seq_len'] for c in self.chromosomes)
+      qname_len = len(str(int(2 * sum(reads_per_copy.values())))) + 8 + \
+                  2 * (len(str(seq_len)) + len(str(read_len)) + 10)
+    cost = blockplan.read_cost(read_len, self.corrupt_reads, qname_len, truth_bam='truth' in self.bam_fp,
+                               unaligned_bam='unaligned' in self.bam_fp, gzipped=self.gzipped, workers=workers)
+
+    # Reference sequences stay loaded once used. Read models that can not take a HaplotypeView also need the whole
+    # chromosome copy and its complement. The read model may keep tables of its own for the copy it is working on. With
+    # workers this all happens in each worker process
+    seq_lens = [self.ref.get_seq_metadata()[c - 1]['seq_len'] for c in self.chromosomes]
+    per_process = sum(seq_lens) + (0 if self.read_model.accepts_haplotype_view else 2 * max(seq_lens)) + \
+                  self.read_model.fixed_memory(max(seq_lens))
+    # The coverage track of a chromosome copy is two int64 arrays over the bins, and a bincount while we add to it
+    track = 3 * 8 * max(seq_lens) / self.coverage_writer.bin_size if self.coverage_writer is not None else 0
+    self.memory_plan = blockplan.BlockPlan(max_mem, reads_per_copy, cost, depth=self.queue_depth,
+                                           fixed=per_process * max(1, workers) + track,
+                                           baseline=blockplan.peak_rss() * (1 + workers if workers > 1 else 1),
+                                           min_blocks=self.min_blocks)
+    self.blocks_for_chromosome = dict(self.memory_plan.blocks)
+    self.queue_mem = self.memory_plan.queue_mem
+    return self.memory_plan
+
+  def get_measured_rss(self):
+    """Peak RSS (bytes) reached by the time the last block of each chromosome was written. With workers, the peaks of
+    the worker processes are added on"""
+    rss = {}
+    for chrom, _, _, r in self.block_rss:
+      rss[chrom] = max(rss.get(chrom, 0), r)
+    return {c: r + sum(self.worker_rss.values()) for c, r in rss.items()}
+
   def get_total_blocks_to_do(self):
     return sum(self.blocks_for_chromosome.values()) * 2  # Two copies for each chromosome
 
@@ -154,37 +357,204 @@ class ReadSimulator:
   def get_blocks_to_do(self, chrom):
     return self.blocks_for_chromosome
 
-  def generate_and_save_reads(self, chrom, cpy):
-    """Grab the appropriate seq, apply variants as needed, generate reads, roll cigars and then save."""
-    if self.pop is not None:
-      ml = self.pop.get_variant_master_list(chrom=chrom)
-      v_index = self.pop.get_sample_variant_index_for_chromosome(chrom=chrom, sample_name=self.sample_name)
+  def get_region_len(self, chrom):
+    """Number of reference bases we take reads from on this chromosome"""
+    if self.targets is not None:
+      t = self.targets[chrom]
+      return int((t[:, 1] - t[:, 0]).sum())
+    return (self.chromosome_regions[chrom]['stop_f'] - self.chromosome_regions[chrom]['start_f']) * \
+           self.ref.get_seq_metadata()[chrom - 1]['seq_len']
+
+  def get_block_list(self):
+    """Return [(chrom, cpy, blk) ...] in the order the blocks are written out. Longest chromosome (region) first, so
+    that when we run in parallel the big jobs are not left for the end"""
+    region_len = {c: self.get_region_len(c) for c in self.chromosomes}
+    return [(chrom, cpy, blk)
+            for chrom in sorted(self.chromosomes, key=lambda c: -region_len[c])  # sorted is stable
+            for cpy in [0, 1]
+            for blk in range(self.blocks_for_chromosome[chrom])]
+
+  def get_haplotype_cache_fname(self, chrom, cpy):
+    """Cache file for the sample's chromosome copy. None if we are not caching"""
+    if self.inputs.pop_hash is None:
+      return None
+    return os.path.join(self.inputs.haplotype_cache_dir, 'hap-{:s}.h5'.format(haplotype_cache_key(
+      self.inputs.pop_hash, self.sample_name, chrom, cpy, self.ref.get_seq_metadata()[chrom - 1]['seq_md5'])))
+
+  def get_haplotype(self, chrom, cpy):
+    """Return a HaplotypeView of the sample's chromosome copy, from the cache if we have expanded it before. The last
+    one is kept (in inputs, so in a Cohort only one is kept for all the samples), since consecutive blocks usually come
+    from the same chromosome copy"""
+    key = (self.sample_name, chrom, cpy)
+    if self.inputs.last_haplotype[0] != key:
+      cache_fname = self.get_haplotype_cache_fname(chrom, cpy)
+      if cache_fname is not None and os.path.exists(cache_fname):
+        logger.debug('Loading chrom {:d} copy {:d} from {:s}'.format(chrom, cpy, cache_fname))
+        self.haplotype_cache_hits += 1
+        haplotype = load_haplotype(cache_fname, self.ref[chrom]['seq'])
+      else:
+        if self.inputs.pop is not None:
+          ml = self.inputs.get_master_list(chrom)
+          v_index = self.inputs.pop.get_sample_variant_index_for_chromosome(chrom=chrom, sample_name=self.sample_name)
+        else:
+          ml, v_index = vr.VariantList(), []  # Need a dummy variant list for nulls
+        haplotype = lib_reads.HaplotypeView(self.ref[chrom]['seq'], ml, v_index, cpy)
+        if cache_fname is not None:
+          save_haplotype(cache_fname, haplotype)
+      self.inputs.last_haplotype = (key, haplotype)
+    return self.inputs.last_haplotype[1]
+
+  def get_expanded_sequence(self, chrom, cpy):
+    """Write out the whole haplotype and return (seq, seq_c). Only needed for read models that do not take a
+    HaplotypeView. We keep the last one, like get_haplotype"""
+    key = (self.sample_name, chrom, cpy)
+    if self.inputs.last_expanded_seq[0] != key:
+      self.inputs.last_expanded_seq = (None, None)  # Let go of the old sequence before making the new one
+      seq = self.get_haplotype(chrom, cpy)[:]
+      seq_c = mitty.lib.string.translate(seq, mitty.lib.DNA_complement)
+      self.inputs.last_expanded_seq = (key, (seq, seq_c))
+    return self.inputs.last_expanded_seq[1]
+
+  # The stages of the pipeline. Each takes the output of the previous one
+
+  def expand_block(self, task):
+    """Stage 'expand': find the sequence we take a block of reads from
+
+    :param task: (chrom, cpy, blk)
+    :return: (chrom, cpy, blk, haplotype, seq, seq_c)
+    """
+    chrom, cpy, blk = task
+    haplotype = self.get_haplotype(chrom, cpy)
+    if self.read_model.accepts_haplotype_view:
+      seq, seq_c = haplotype, None
     else:
-      ml, v_index = vr.VariantList(), []  # Need a dummy variant list for nulls
-
-    seq, variant_waypoints, var_locs_alt_coords = lib_reads.expand_sequence(self.ref[chrom]['seq'], ml, v_index, cpy)
-    seq_c = mitty.lib.string.translate(seq, mitty.lib.DNA_complement)
-    coverage_per_block = 0.5 * self.coverage / self.blocks_for_chromosome[chrom]
-    for blk in range(self.blocks_for_chromosome[chrom]):
-      reads, paired = generate_reads(seq, seq_c, var_locs_alt_coords,
-                                     self.variant_window, self.read_model,
-                                     coverage_per_block,
-                                     self.corrupt_reads,
-                                     self.seed_rng,
-                                     start_f=self.chromosome_regions[chrom]['start_f'],
-                                     stop_f=self.chromosome_regions[chrom]['stop_f'],
-                                     variants_only=self.variants_only)
-      pos, cigars = lib_reads.roll_cigars(variant_waypoints, reads)
-      template_count, bases_covered = write_reads_to_file(
-        self.fastq_fp[0], self.fastq_fp[1],
-        self.fastq_c_fp[0], self.fastq_c_fp[1],
-        reads, paired, pos, cigars,
-        chrom, cpy,
-        self.templates_written)
-      self.templates_written += template_count
-      self.reads_generated += reads.shape[0]
-      self.bases_covered += bases_covered
-      yield
+      seq, seq_c = self.get_expanded_sequence(chrom, cpy)
+    return chrom, cpy, blk, haplotype, seq, seq_c
+
+  def sample_block(self, block):
+    """Stage 'sample': sample templates and extract (and corrupt) the reads. The result depends only on the master
+    seed, chrom, cpy and blk
+
+    :return: (chrom, cpy, haplotype, reads, paired)
+    """
+    chrom, cpy, blk, haplotype, seq, seq_c = block
+    reads, paired = generate_reads(seq, seq_c, haplotype.var_locs_alt_coords,
+                                   self.variant_window, self.read_model,
+                                   0.5 * self.coverage / self.blocks_for_chromosome[chrom],
+                                   self.corrupt_reads,
+                                   np.random.RandomState(seed=[self.master_seed, chrom, cpy, blk]),
+                                   start_f=self.chromosome_regions[chrom]['start_f'],
+                                   stop_f=self.chromosome_regions[chrom]['stop_f'],
+                                   variants_only=self.variants_only,
+                                   targets=lib_reads.ref_to_alt(haplotype.variant_waypoints, self.targets[chrom])
+                                   if self.targets is not None else None,
+                                   n_free=lib_reads.ref_to_alt(haplotype.variant_waypoints,
+                                                               self.inputs.get_n_free_intervals(chrom)))
+    return chrom, cpy, haplotype, reads, paired
+
+  def cigar_block(self, block):
+    """Stage 'cigars': work out the POS and CIGAR of each read. The truth BAM gets old style CIGARs, like perfectbam.
+    For the coverage track we also map each read back onto the reference
+
+    :return: (chrom, cpy, reads, paired, pos, cigars, bam_cigars, ref_span). bam_cigars is None if we write no truth
+             BAM, ref_span (see lib.reads.read_ref_spans) None if we write no coverage track
+    """
+    chrom, cpy, haplotype, reads, paired = block
+    pos, cigars = lib_reads.roll_cigars(haplotype.variant_waypoints, reads)
+    bam_cigars = lib_reads.roll_cigars(haplotype.variant_waypoints, reads, old_style=True)[1] \
+      if 'truth' in self.bam_fp else None
+    ref_span = lib_reads.read_ref_spans(haplotype.variant_waypoints, reads) \
+      if self.coverage_writer is not None else None
+    return chrom, cpy, reads, paired, pos, cigars, bam_cigars, ref_span
+
+  def bam_block(self, block):
+    """Stage 'bam': write a block to the BAM files. The block is passed on as is"""
+    chrom, cpy, reads, paired, pos, cigars, bam_cigars, _ = block
+    seq, qual = (reads.corrupt, reads.qual) if self.corrupt_reads else (reads.seq, None)
+    for kind, fp in self.bam_fp.items():
+      write_sam_to_bam(fp, lib_reads.format_sam(
+        self.bam_templates_written, chrom, cpy, reads.read_order, pos, cigars,
+        reads.flat(seq), reads.offsets, reads.flat(qual) if qual is not None else None, paired,
+        rname=self.bam_rname[chrom - 1] if kind == 'truth' else None,
+        bam_cigars=bam_cigars if kind == 'truth' else None, compact=self.compact_qnames, qual_shared=reads.qual_shared))
+    self.bam_templates_written += len(reads) / 2 if paired else len(reads)
+    return block
+
+  def format_block(self, block):
+    """Stage 'format': format a block as FASTQ. Read serials are handed out here, in the order the blocks are written
+
+    :param block: (chrom, cpy, reads, paired, pos, cigars, bam_cigars, ref_span)
+    :return: list of data for each of the output files (fastq_fp + fastq_c_fp). None where there is nothing to write
+    """
+    chrom, cpy, reads, paired, pos, cigars, _, ref_span = block
+    buffers, template_count, bases_covered = format_reads(
+      reads, paired, pos, cigars, chrom, cpy, self.templates_written,
+      interleaved=self.fastq_fp[0] is self.fastq_fp[1], corrupt=self.corrupt_reads, compact=self.compact_qnames)
+    if self.truth_writer is not None:
+      self.truth_writer.append(chrom, cpy, reads.read_order, pos, reads.read_len, cigars)
+    if self.coverage_writer is not None:
+      self.coverage_writer.add(chrom, cpy, ref_span)
+    self.templates_written += template_count
+    self.reads_generated += len(reads)
+    self.bases_covered += bases_covered
+    return buffers
+
+  def compress_block(self, buffers):
+    """Stage 'compress': BGZF compress the formatted data. Only used for gzipped output"""
+    return [fp.compress(b) if b is not None else None for fp, b in zip(self.fastq_fp + self.fastq_c_fp, buffers)]
+
+  def write_block(self, buffers, compressed=False):
+    """Stage 'write': write the data to the output files
+
+    :param buffers: as returned by format_block or compress_block
+    :param compressed: set if buffers have been through compress_block
+    """
+    for fp, b in zip(self.fastq_fp + self.fastq_c_fp, buffers):
+      if b is not None:
+        if compressed:
+          fp.write_blocks(b)
+        else:
+          fp.write(b)
+
+  def generate_block(self, chrom, cpy, blk):
+    """Generate reads for one block. The result depends only on the master seed, chrom, cpy and blk
+
+    :return: reads, paired, pos, cigars, bam_cigars, ref_span
+    """
+    return self.cigar_block(self.sample_block(self.expand_block((chrom, cpy, blk))))[2:]
+
+  def save_block(self, chrom, cpy, reads, paired, pos, cigars, bam_cigars=None, ref_span=None):
+    """Write out a block of reads"""
+    block = (chrom, cpy, reads, paired, pos, cigars, bam_cigars, ref_span)
+    if self.bam_fp:
+      self.bam_block(block)
+    self.write_block(self.format_block(block))
+
+  def generate_and_save_reads(self, workers=1):
+    """Generate and write out all the blocks, yielding after each block is written. See generate_and_save_blocks
+
+    :param workers: number of processes to generate reads in. The output does not depend on this
+    """
+    return generate_and_save_blocks([self], workers=workers)
+
+  def close(self):
+    for fp in set(self.fastq_fp + self.fastq_c_fp):
+      if fp is not None: fp.close()
+    if self.gzip_pool is not None and self._own_gzip_pool:
+      self.gzip_pool.close()
+      self.gzip_pool.join()
+    for fp in self.bam_fp.values():
+      fp.close()
+    if self.truth_writer is not None:
+      self.truth_writer.close()
+    if self.coverage_writer is not None:
+      self.coverage_writer.close()
+    if 'truth' in self.bam_fp:
+      unsorted = self.bam_fname['truth'][:-4] + '.unsorted.bam'
+      pysam.sort('-@', str(self.bam_threads), '-o', self.bam_fname['truth'], unsorted)
+      pysam.index(self.bam_fname['truth'])
+      os.remove(unsorted)
+    self.bam_fp = {}
 
   def get_templates_written(self):
     return self.templates_written
@@ -193,45 +563,319 @@ class ReadSimulator:
     return self.reads_generated
 
   def get_coverage_done(self):
-    return float(self.bases_covered / self.sum_of_chromosome_lengths)
+    return float(self.bases_covered / (self.sum_of_target_lengths or self.sum_of_chromosome_lengths))
     # This is approximate, since sample will have different length than reference, reference has 'N's, but good enough
 
 
+class Cohort:
+  """Read simulations for several samples of a genome file, run together. The samples share one SharedInputs, so the
+  reference and genome file are loaded, and each master list decoded, once for all of them. The blocks of all the
+  samples go through one pipeline (and pool of worker processes), chromosome by chromosome, and each sample's blocks
+  are written to its own output files in the order a ReadSimulator of the sample would write them. A sample gets the
+  same reads it would get from a run on its own with the same master seed"""
+  def __init__(self, base_dir, params, samples, ref_file=None, db_file=None, gzip_threads=1,
+               queue_depth=2, queue_mem=None, haplotype_cache_dir=None):
+    """
+    :param base_dir: the directory with respect to which relative file paths will be resolved
+    :param params: dict loaded from json file. sample_name and output_prefix are taken from samples instead
+    :param samples: list of (sample_name, output_prefix, master_seed). master_seed is None to use the one in params
+    :param gzip_threads: number of threads compressing the output, if it is gzipped. Shared by all the samples
+    Other parameters are as for ReadSimulator
+    """
+    self.inputs = SharedInputs(base_dir, params, ref_file=ref_file, db_file=db_file,
+                               haplotype_cache_dir=haplotype_cache_dir)
+    self.gzip_pool = ThreadPool(gzip_threads) if params['files'].get('gzipped', False) and gzip_threads > 1 else None
+    self.simulators = [
+      ReadSimulator(base_dir,
+                    dict(params, sample_name=sample_name,
+                         rng=dict(params['rng'], master_seed=master_seed or params['rng']['master_seed'])),
+                    out_prefix=out_prefix, gzip_threads=gzip_threads, queue_depth=queue_depth, queue_mem=queue_mem,
+                    inputs=self.inputs, gzip_pool=self.gzip_pool)
+      for sample_name, out_prefix, master_seed in samples]
+
+  def plan_memory(self, max_mem, workers=1):
+    """Plan the blocks for one sample and give every sample the same plan. They have the same settings, and the
+    blocks of all of them share the pipeline"""
+    plan = self.simulators[0].plan_memory(max_mem, workers=workers)
+    for sim in self.simulators[1:]:
+      sim.memory_plan, sim.blocks_for_chromosome, sim.queue_mem = plan, dict(plan.blocks), plan.queue_mem
+    return plan
+
+  def get_total_blocks_to_do(self):
+    return sum(sim.get_total_blocks_to_do() for sim in self.simulators)
+
+  def generate_and_save_reads(self, workers=1):
+    """Generate and write out the blocks of all the samples, yielding after each block is written"""
+    return generate_and_save_blocks(self.simulators, workers=workers)
+
+  def close(self):
+    for sim in self.simulators:
+      sim.close()
+    if self.gzip_pool is not None:
+      self.gzip_pool.close()
+      self.gzip_pool.join()
+
+
+def get_block_list(simulators):
+  """Return [(n, (chrom, cpy, blk)) ...], the blocks of the samples of the simulators, in the order they are written
+  out. This is chromosome by chromosome, in the order of the first simulator, and sample by sample within a
+  chromosome, so that the master list of a chromosome can be kept while all the samples work on it"""
+  block_lists = [sim.get_block_list() for sim in simulators]
+  chroms = []
+  for chrom, _, _ in block_lists[0]:
+    if chrom not in chroms:
+      chroms.append(chrom)
+  return [(n, task) for chrom in chroms for n, block_list in enumerate(block_lists)
+          for task in block_list if task[0] == chrom]
+
+
+def generate_and_save_blocks(simulators, workers=1):
+  """Generate and write out all the blocks of the simulators, yielding after each block is written. The simulators
+  should share their inputs and have the same settings, apart from the sample and output files (see Cohort)
+
+  The work is done as a pipeline: expand -> sample -> cigars -> bam -> format -> compress -> write. Each stage runs
+  in its own thread, with a few blocks queued up between stages, so generation and writing overlap. With more than one
+  worker the first three stages are done by a pool of processes instead and make up one stage, 'generate'. Time
+  spent in each stage is left in stage_stats of each simulator, and the peak RSS after each block is written in the
+  block_rss of the simulator it belongs to.
+
+  :param simulators: list of ReadSimulator
+  :param workers: number of processes to generate reads in. The output does not depend on this
+  """
+  sim0 = simulators[0]
+
+  def for_sample(stage):
+    # Items are (n, block), where block belongs to simulators[n]
+    return lambda item: (item[0], stage(simulators[item[0]], item[1]))
+
+  output_stages = ([('bam', for_sample(ReadSimulator.bam_block))] if sim0.bam_fp else []) + \
+                  [('format', for_sample(ReadSimulator.format_block))] + \
+                  ([('compress', for_sample(ReadSimulator.compress_block))] if sim0.gzipped else []) + \
+                  [('write', for_sample(partial(ReadSimulator.write_block, compressed=sim0.gzipped)))]
+  block_list = get_block_list(simulators)
+  if workers <= 1:
+    p = pipeline.Pipeline(block_list,
+                          [('expand', for_sample(ReadSimulator.expand_block)),
+                           ('sample', for_sample(ReadSimulator.sample_block)),
+                           ('cigars', for_sample(ReadSimulator.cigar_block))] + output_stages,
+                          depth=sim0.queue_depth, max_mem=sim0.queue_mem, source_name='blocks')
+    for i, _ in enumerate(p):
+      n, task = block_list[i]
+      simulators[n].block_rss.append(task + (blockplan.peak_rss(),))
+      yield
+    for sim in simulators:
+      sim.stage_stats = p.get_stats()
+    return
+
+  global _worker_simulators
+  _worker_simulators = simulators  # The pool processes are forked and get a copy of these
+  for sim in simulators:
+    for fp in sim.fastq_fp + sim.fastq_c_fp:
+      if fp is not None: fp.flush()
+    if sim.truth_writer is not None:
+      sim.truth_writer.flush()
+    if sim.coverage_writer is not None:
+      sim.coverage_writer.flush()
+  sim0.inputs.close_pop()
+  pool = multiprocessing.Pool(processes=workers, initializer=_init_worker)
+
+  def generated_blocks():
+    # We keep only a few blocks in flight, so finished blocks do not pile up in memory if writing is slow
+    pending = deque()
+    for n, task in block_list:
+      pending.append((n, task, pool.apply_async(_generate_block_in_worker, (n,) + task)))
+      if len(pending) < 2 * workers:
+        continue
+      yield finished_block(*pending.popleft())
+    while pending:
+      yield finished_block(*pending.popleft())
+
+  def finished_block(n, task, result):
+    block, pid, rss = result.get()
+    for sim in simulators:
+      sim.worker_rss[pid] = rss
+    return n, task[:2] + block
+
+  try:
+    p = pipeline.Pipeline(generated_blocks(), output_stages,
+                          depth=sim0.queue_depth, max_mem=sim0.queue_mem, source_name='generate')
+    for i, _ in enumerate(p):
+      n, task = block_list[i]
+      simulators[n].block_rss.append(task + (blockplan.peak_rss(),))
+      yield
+    for sim in simulators:
+      sim.stage_stats = p.get_stats()
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+    _worker_simulators = None
+    sim0.inputs.open_pop()
+
+
+_worker_simulators = None
+
+
+def _init_worker():
+  """Pool process initializer. We should not share the parent's open genome file with it"""
+  _worker_simulators[0].inputs.open_pop()
+
+
+def _generate_block_in_worker(n, chrom, cpy, blk):
+  """Returns the block of simulator n, with our pid and peak RSS so the parent can keep track of worker memory"""
+  return _worker_simulators[n].generate_block(chrom, cpy, blk), os.getpid(), blockplan.peak_rss()
+
+
+def load_sample_list(fname):
+  """Load the sample list of a cohort run: one sample per line, as the sample name, the output prefix and, optionally,
+  the master seed, separated by white space. Lines starting with # are skipped. Relative output prefixes are taken
+  relative to the directory of the list
+
+  :param fname: name of sample list file
+  :return: list of (sample_name, output_prefix, master_seed). master_seed is None if not given
+  """
+  base_dir = os.path.dirname(fname)
+  samples = []
+  for line in open(fname, 'r'):
+    cols = line.split()
+    if not cols or cols[0].startswith('#'):
+      continue
+    if len(cols) not in [2, 3]:
+      raise ValueError('Sample list lines should be: sample_name output_prefix [master_seed]. Got "{:s}"'.format(
+        line.strip()))
+    samples.append((cols[0], mitty.lib.rpath(base_dir, cols[1]), int(cols[2]) if len(cols) == 3 else None))
+  return samples
+
+
+def file_hash(fname, chunk_size=1 << 24):
+  """sha1 hex digest of the contents of a file"""
+  h = hashlib.sha1()
+  with open(fname, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(chunk_size), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def haplotype_cache_key(pop_hash, sample_name, chrom, cpy, seq_md5):
+  """Hash of everything that determines an expanded chromosome copy
+
+  :param pop_hash: file_hash of the genome file
+  :param sample_name: sample in the genome file
+  :param chrom: chromosome number
+  :param cpy: chromosome copy
+  :param seq_md5: md5 of the reference chromosome sequence
+  :return: hex digest
+  """
+  return hashlib.sha1(json.dumps({'pop': pop_hash, 'sample': sample_name, 'chrom': chrom, 'cpy': cpy,
+                                  'seq_md5': seq_md5, 'mitty': __version__},  # The table may change between versions
+                                 sort_keys=True, separators=(',', ':'))).hexdigest()
+
+
+_haplotype_arrays = ['seg_start', 'seg_src', 'seg_heap', 'heap', 'variant_waypoints', 'var_locs_alt_coords']
+
+
+def save_haplotype(fname, haplotype):
+  """Save the table of a HaplotypeView to a cache file. The datasets are contiguous and uncompressed so that
+  load_haplotype can map them from the file. We write to a temporary file first so that an interrupted run (or another
+  worker process saving the same copy) does not leave a broken cache entry"""
+  tmp_fname = fname + '.{:d}.tmp'.format(os.getpid())
+  with h5py.File(tmp_fname, 'w') as fp:
+    for name, data in zip(_haplotype_arrays, haplotype.get_table()):
+      fp.create_dataset(name, data=np.frombuffer(data, dtype=np.uint8) if name == 'heap' else data)
+  os.rename(tmp_fname, fname)
+
+
+def load_haplotype(fname, ref_seq):
+  """Load a HaplotypeView saved by save_haplotype. The segment arrays, which grow with the number of variants, are
+  mapped from the file (copy on write - the compiled code wants writable buffers) so only the pages we use are read
+
+  :param fname: cache file
+  :param ref_seq: reference sequence of the chromosome
+  :return: HaplotypeView
+  """
+  table = []
+  with h5py.File(fname, 'r') as fp:
+    for name in _haplotype_arrays:
+      ds = fp[name]
+      offset = ds.id.get_offset()  # None if the dataset has no storage (e.g. it is empty)
+      if name in ['seg_start', 'seg_src', 'seg_heap'] and offset is not None:
+        table.append(np.memmap(fname, dtype=ds.dtype, mode='c', offset=offset, shape=ds.shape))
+      elif name == 'heap':
+        table.append(ds[:].tostring())
+      elif name == 'variant_waypoints':
+        table.append(np.rec.array(ds[:]))
+      else:
+        table.append(ds[:])
+  return lib_reads.HaplotypeView(ref_seq, None, None, None, table=tuple(table))
+
+
+def load_targets(bed_fname, chrom_meta, chromosome_regions, padding=0):
+  """Load targets from a BED file, pad them, and merge any that now overlap
+
+  :param bed_fname: name of BED file
+  :param chrom_meta: reference sequence metadata, as from Fasta.get_seq_metadata
+  :param chromosome_regions: {chrom: {'start_f', 'stop_f'}} for the chromosomes we want. Targets are clipped to these
+  :param padding: bases added to either side of each target
+  :return: {chrom: N x 2 array of (start, stop)} in reference coordinates
+  """
+  bed = mio.read_bed(bed_fname)
+  names = {m['seq_id'].split(' ')[0]: n + 1 for n, m in enumerate(chrom_meta)}
+  names.update({str(n + 1): n + 1 for n in range(len(chrom_meta))})
+  unknown = [k for k in bed.keys() if k not in names]
+  if unknown:
+    logger.warning('Targets on unknown sequences ignored: {:s}'.format(', '.join(unknown)))
+  targets = {}
+  for chrom, region in chromosome_regions.items():
+    seq_len = chrom_meta[chrom - 1]['seq_len']
+    iv = np.array(sorted(t for k, v in bed.items() if names.get(k) == chrom for t in v), dtype=np.int64).reshape(-1, 2)
+    iv = lib_reads.merge_intervals(np.maximum(iv[:, 0] - padding, 0), np.minimum(iv[:, 1] + padding, seq_len))
+    targets[chrom] = lib_reads.intersect_intervals(
+      iv, [(int(seq_len * region['start_f']), int(seq_len * region['stop_f']))])
+  return targets
+
+
 def generate_reads(seq, seq_c, var_locs_alt_coords, variant_window,
                    read_model, coverage, corrupt, seed_rng,
                    start_f=0.0, stop_f=1.0,
-                   variants_only=False):
+                   variants_only=False, targets=None, n_free=None):
   """Wrapper around read function to handle both regular reads as well as reads restricted to around variants
 
-  :param seq:      forward sequence
-  :param seq_c:    complement sequence
+  :param seq:      forward sequence (or HaplotypeView, if the read model takes one)
+  :param seq_c:    complement sequence (None with a HaplotypeView)
   :param var_locs_alt_coords: as returned by expand_sequence
   :param variant_window: how many bases before and after variant should we include
-  :param read_model: read model object
+  :param read_model: read model object (v2, see plugins.reads.base_plugin.as_v2)
   :param coverage: real number indicating coverage needed for this run of the simulator
   :param corrupt:  T/F generate corrupted reads too or not
   :param seed_rng:    rng for seed generation
   :param start_f: start fraction for chromosome
   :param stop_f:  stop fraction for chromosome
   :param variants_only: set True if we want reads only from variant regions
+  :param targets:  N x 2 array of (start, stop) in sequence coordinates. If given, reads only come from these
+  :param n_free:   N x 2 array of (start, stop) of the stretches of sequence without N (see lib.reads.n_free_intervals).
+                   If given, templates are only placed inside these, at the same coverage per base
   :return:
   """
   start_base = int(len(seq) * start_f)
   stop_base = int(len(seq) * stop_f)
+  if targets is not None:
+    targets = lib_reads.merge_intervals(targets[:, 0], targets[:, 1])  # Padding may make neighbours touch on the alt
+  if n_free is not None:
+    n_free = lib_reads.merge_intervals(n_free[:, 0], n_free[:, 1])  # A deletion may take out a whole N run
+    targets = n_free if targets is None else lib_reads.intersect_intervals(targets, n_free)
   if variants_only:
-    rds, paired = read_model.get_zero_reads()
-    reads = [rds]
-    for v in var_locs_alt_coords:  # [1:-1]:
-      start, stop = max(v - variant_window, 0), min(v + variant_window, len(seq))
-      if start > stop_base or stop < start_base: continue
-      # v is the pos of the variant in sequence coordinates (rather than ref coordinates)
-      these_reads, paired = read_model.get_reads(seq, seq_c,
-                                                 start_base=start, end_base=stop,
-                                                 coverage=coverage,
-                                                 corrupt=corrupt,
-                                                 seed=seed_rng.randint(0, mitty.lib.SEED_MAX))
-      reads += [these_reads]
-    reads = np.concatenate(reads)
+    # v is the pos of the variant in sequence coordinates (rather than ref coordinates). Overlapping windows are merged
+    # so that no region is sampled twice
+    v = np.asarray(var_locs_alt_coords, dtype=np.int64)
+    start, stop = np.maximum(v - variant_window, 0), np.minimum(v + variant_window, len(seq))
+    keep = ~((start > stop_base) | (stop < start_base))
+    intervals = lib_reads.merge_intervals(start[keep], stop[keep])
+    if targets is not None:
+      intervals = lib_reads.intersect_intervals(intervals, targets)
+    reads, paired = get_reads_from_intervals(read_model, seq, seq_c, intervals, coverage, corrupt, seed_rng)
+  elif targets is not None:
+    intervals = lib_reads.intersect_intervals(targets, [(start_base, stop_base)])
+    reads, paired = get_reads_from_intervals(read_model, seq, seq_c, intervals, coverage, corrupt, seed_rng)
   else:
     reads, paired = read_model.get_reads(seq, seq_c,
                                          start_base=start_base, end_base=stop_base,
@@ -241,24 +885,53 @@ def generate_reads(seq, seq_c, var_locs_alt_coords, variant_window,
   return reads, paired
 
 
+def get_reads_from_intervals(read_model, seq, seq_c, intervals, coverage, corrupt, seed_rng):
+  """Take reads from a set of disjoint intervals. This is one call to the read model if it takes intervals, otherwise
+  we call it for each interval in turn
+
+  :param read_model: read model object (v2, see plugins.reads.base_plugin.as_v2)
+  :param seq:        forward sequence (or HaplotypeView, if the read model takes one)
+  :param seq_c:      complement sequence
+  :param intervals:  N x 2 array of (start, stop)
+  :param coverage:   coverage
+  :param corrupt:    T/F generate corrupted reads too or not
+  :param seed_rng:   rng for seed generation
+  :return: reads, paired
+  """
+  if read_model.accepts_intervals:
+    return read_model.get_reads(seq, seq_c, intervals=intervals, coverage=coverage, corrupt=corrupt,
+                                seed=seed_rng.randint(0, mitty.lib.SEED_MAX))
+  rds, paired = read_model.get_zero_reads()
+  reads = [rds]
+  for start, stop in intervals:
+    these_reads, paired = read_model.get_reads(seq, seq_c,
+                                               start_base=start, end_base=stop,
+                                               coverage=coverage,
+                                               corrupt=corrupt,
+                                               seed=seed_rng.randint(0, mitty.lib.SEED_MAX))
+    reads += [these_reads]
+  return ReadBatch.concatenate(reads), paired
+
+
 def write_reads_to_file(fastq_fp_1, fastq_fp_2,
                         fastq_c_fp_1, fastq_c_fp_2,
                         reads, paired, pos, cigars,
                         chrom, cpy,
                         first_serial_no):
-  """
+  """Write out a batch of reads. The whole batch is formatted in one go and written with one call per file
+
   :param fastq_fp_1:   file pointer to perfect reads file
   :param fastq_fp_2:   file pointer to perfect reads file 2. Same as 1 if interleaving. None if not paired
   :param fastq_c_fp_1: file pointer to corrupted reads file. None if no corrupted reads being written
   :param fastq_c_fp_2: file pointer to corrupted reads file 2. Same as 1 if interleaving. None if no corrupted reads being written. None if not paired
-  :param reads:        reads recarray
+  :param reads:        ReadBatch
   :param paired:       bool, are reads paired
   :param pos:          list of POS values for the reads
   :param cigars:       list of cigar values for the reads
   :param chrom:           chromosome number
   :param cpy:           chromosome copy
   :param first_serial_no: serial number of first template in this batch
-  :return: next_serial_no: the serial number the next batch should start at
+  :return: template_count, bases_covered
 
   qname format:
 
@@ -267,11 +940,58 @@ def write_reads_to_file(fastq_fp_1, fastq_fp_2,
   ro = readorder => 0 if forward seq, 1 if rev complement
 
   """
+  buffers, template_count, bases_covered = format_reads(reads, paired, pos, cigars, chrom, cpy, first_serial_no,
+                                                       interleaved=fastq_fp_2 is fastq_fp_1,
+                                                       corrupt=fastq_c_fp_1 is not None)
+  for fp, b in zip([fastq_fp_1, fastq_fp_2, fastq_c_fp_1, fastq_c_fp_2], buffers):
+    if b is not None:
+      fp.write(b)
+  return template_count, bases_covered
+
+
+def write_sam_to_bam(bam_fp, sam):
+  """Write SAM text (as made by lib.reads.format_sam) to an open BAM file"""
+  fromstring, header, write = pysam.AlignedSegment.fromstring, bam_fp.header, bam_fp.write
+  for line in sam.splitlines():
+    write(fromstring(line, header))
+
+
+def format_reads(reads, paired, pos, cigars, chrom, cpy, first_serial_no, interleaved=True, corrupt=False,
+                 compact=False):
+  """Format a batch of reads as FASTQ. See write_reads_to_file for the qname format
+
+  :param interleaved: put both mates of a pair in the first output
+  :param corrupt:     format the corrupted reads too
+  :param compact:     qnames are just the serial number. The truth needs to go into a sidecar (lib.truth)
+  :return: [perfect_1, perfect_2, corrupt_1, corrupt_2], template_count, bases_covered
+           Entries are None when there is nothing for that output
+  """
+  buffers = list(lib_reads.format_fastq(first_serial_no, chrom, cpy, reads.read_order, pos, cigars,
+                                        reads.flat(reads.seq), reads.offsets, None, paired, interleaved, compact))
+  if corrupt:
+    buffers += lib_reads.format_fastq(first_serial_no, chrom, cpy, reads.read_order, pos, cigars,
+                                      reads.flat(reads.corrupt), reads.offsets,
+                                      reads.flat(reads.qual) if reads.qual is not None else None,
+                                      paired, interleaved, compact, qual_shared=reads.qual_shared)
+  else:
+    buffers += [None, None]
+  template_count = len(reads) / 2 if paired else len(reads)
+  bases_covered = int(reads.read_len[:2 * template_count if paired else template_count].sum())
+  return buffers, template_count, bases_covered
+
+
+def py_write_reads_to_file(fastq_fp_1, fastq_fp_2,
+                           fastq_c_fp_1, fastq_c_fp_2,
+                           reads, paired, pos, cigars,
+                           chrom, cpy,
+                           first_serial_no):
+  """Pure Python version of write_reads_to_file, formatting and writing one read at a time"""
   bases_covered = 0
-  ro, pr_seq, cr_seq, phred = reads['read_order'], reads['perfect_reads'], reads['corrupt_reads'], reads['phred']
+  ro, pr_seq, cr_seq = reads.read_order, reads.as_strings(reads.seq), reads.as_strings(reads.corrupt)
+  phred = reads.as_strings(reads.qual) if reads.qual is not None else ['~' * l for l in reads.read_len]
 
   if paired:
-    for n in xrange(0, reads.shape[0], 2):
+    for n in xrange(0, len(reads), 2):
       l1, l2 = len(pr_seq[n]), len(pr_seq[n + 1])
       qname = '{:d}|{:d}|{:d}|{:d}|{:d}|{:d}|{:s}|{:d}|{:d}|{:d}|{:s}'.\
         format(first_serial_no + n/2, chrom, cpy, ro[n], pos[n], l1, cigars[n], ro[n + 1], pos[n + 1], l2, cigars[n + 1])
@@ -281,16 +1001,16 @@ def write_reads_to_file(fastq_fp_1, fastq_fp_2,
       if fastq_c_fp_1 is not None:
         fastq_c_fp_1.write('@' + qname + '/1\n' + cr_seq[n] + '\n+\n' + phred[n] + '\n')
         fastq_c_fp_2.write('@' + qname + '/2\n' + cr_seq[n + 1] + '\n+\n' + phred[n + 1] + '\n')
-    template_count = reads.shape[0] / 2
+    template_count = len(reads) / 2
   else:
-    for n in xrange(0, reads.shape[0]):
+    for n in xrange(0, len(reads)):
       l1 = len(pr_seq[n])
       qname = '{:d}|{:d}|{:d}|{:d}|{:d}|{:d}|{:s}'.format(first_serial_no + n, chrom, cpy, ro[n], pos[n], l1, cigars[n])
       fastq_fp_1.write('@' + qname + '\n' + pr_seq[n] + '\n+\n' + '~' * l1 + '\n')
       bases_covered += l1
       if fastq_c_fp_1 is not None:
         fastq_c_fp_1.write('@' + qname + '\n' + cr_seq[n] + '\n+\n' + phred[n] + '\n')
-    template_count = reads.shape[0]
+    template_count = len(reads)
   return template_count, bases_covered
 
 
@@ -314,9 +1034,20 @@ def cli():
 @click.option('--ref', type=click.Path(exists=True), help="Use this path for reference file. Over-rides entry in parameter file")
 @click.option('--db', type=click.Path(exists=True), help="Use this path for genome DB file. Over-rides entry in parameter file")
 @click.option('--out-prefix', type=click.Path(), help="Use this path for output file prefix. Over-rides entry in parameter file")
+@click.option('--workers', type=int, default=1, help='Number of processes to generate reads in. Output does not depend on this')
+@click.option('--gzip-threads', type=int, default=1, help='Number of threads compressing gzipped output')
+@click.option('--queue-depth', type=int, default=2, help='Number of blocks queued between pipeline stages')
+@click.option('--queue-mem', type=int, default=1024, help="Cap (MB) on the memory taken by queued blocks. 0 for no cap")
+@click.option('--max-mem', help="Memory budget, e.g. 4G. Block sizes (and --queue-mem) are planned to fit. "
+                                "Different plans give different reads for the same seed")
+@click.option('--haplotype-cache', type=click.Path(), help="Expanded haplotype cache directory. Over-rides entry in parameter file")
+@click.option('--samples', type=click.Path(exists=True), help="Cohort mode: generate reads for each sample in this "
+                                                              "file. One line per sample: name, output prefix and, "
+                                                              "optionally, master seed")
 @click.option('-v', count=True, help='Verbosity level')
 @click.option('-p', is_flag=True, help='Show progress bar')
-def generate(param_fname, ref, db, out_prefix, v, p):
+def generate(param_fname, ref, db, out_prefix, workers, gzip_threads, queue_depth, queue_mem, max_mem, haplotype_cache,
+             samples, v, p):
   """Generate reads (fastq) given a parameter file"""
   level = logging.DEBUG if v > 1 else logging.WARNING
   logging.basicConfig(level=level)
@@ -326,16 +1057,42 @@ def generate(param_fname, ref, db, out_prefix, v, p):
   base_dir = os.path.dirname(param_fname)     # Other files will be with respect to this
   params = json.load(open(param_fname, 'r'))
 
-  simulation = ReadSimulator(base_dir, params, ref_file=ref, db_file=db, out_prefix=out_prefix)
+  if samples is not None:
+    if out_prefix is not None:
+      raise click.BadParameter('Output prefixes come from the sample list in cohort mode', param_hint='--out-prefix')
+    try:
+      sample_list = load_sample_list(samples)
+    except ValueError as e:
+      raise click.BadParameter(str(e), param_hint='--samples')
+    simulation = Cohort(base_dir, params, sample_list, ref_file=ref, db_file=db,
+                        gzip_threads=gzip_threads, queue_depth=queue_depth, queue_mem=queue_mem * 1e6 or None,
+                        haplotype_cache_dir=haplotype_cache)
+    simulators = simulation.simulators
+  else:
+    simulation = ReadSimulator(base_dir, params, ref_file=ref, db_file=db, out_prefix=out_prefix,
+                               gzip_threads=gzip_threads, queue_depth=queue_depth, queue_mem=queue_mem * 1e6 or None,
+                               haplotype_cache_dir=haplotype_cache)
+    simulators = [simulation]
+  if max_mem is not None:
+    try:
+      simulation.plan_memory(blockplan.parse_mem(max_mem), workers=workers)
+    except ValueError as e:
+      raise click.BadParameter(str(e), param_hint='--max-mem')
 
   t0 = time.time()
   with click.progressbar(length=simulation.get_total_blocks_to_do(), label='Generating reads', file=None if p else io.BytesIO()) as bar:
-    for chrom in simulation.get_chromosome_list():
-      for cpy in [0, 1]:
-        for _ in simulation.generate_and_save_reads(chrom, cpy):
-          bar.update(1)
+    for _ in simulation.generate_and_save_reads(workers=workers):
+      bar.update(1)
+  simulation.close()
   t1 = time.time()
-  logger.debug('Took {:f}s to write {:d} reads ({:f} coverage)'.format(t1 - t0, simulation.get_read_count(), simulation.get_coverage_done()))
+  for sim in simulators:
+    logger.debug('Took {:f}s to write {:d} reads ({:f} coverage){:s}'.format(
+      t1 - t0, sim.get_read_count(), sim.get_coverage_done(), ' for ' + sim.sample_name if samples else ''))
+  pipeline.log_stats(simulators[0].stage_stats, logger.debug)
+  if simulators[0].memory_plan is not None:
+    simulators[0].memory_plan.log(simulators[0].get_measured_rss(),
+                                  [c for c, cpy, blk in simulators[0].get_block_list() if cpy == 0 and blk == 0],
+                                  logger.debug)
 
 
 @cli.group()
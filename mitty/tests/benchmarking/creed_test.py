@@ -131,3 +131,28 @@ def analyze_read_test2():
 #     r = pysam.AlignedSegment()
 
 
+
+
+def analyze_reads_compact_qname_test():
+  """Read analysis with the truth looked up from a sidecar is the same as with the truth in the qname"""
+  import os
+  import tempfile
+  import mitty.lib.truth as truth
+  fname = tempfile.mktemp(suffix='.h5')
+  w = truth.TruthWriter(fname, paired=True)
+  w.append(15, 0, [1, 0, 1, 0], [898, 744, 700, 900], 100, ['100=', '24=2I74=', '200S', '100='])
+  w.close()
+  reads = [MyRead(qname='0', secondary=False, paired=True, read1=True, unmapped=False, reference_id=14, pos=898, cigarstring='100M'),
+           MyRead(qname='0', secondary=False, paired=True, read1=False, unmapped=False, reference_id=14, pos=744, cigarstring='24M2I74M'),
+           MyRead(qname='1', secondary=False, paired=True, read1=True, unmapped=False, reference_id=14, pos=705, cigarstring='100I'),
+           MyRead(qname='xx', secondary=False, paired=True, read1=True, unmapped=False, reference_id=14, pos=705, cigarstring='100I')]
+  qnames = ['0|15|0|1|898|100|100=|0|744|100|24=2I74=', '0|15|0|1|898|100|100=|0|744|100|24=2I74=',
+            '1|15|0|1|700|100|200S|0|900|100|100=']
+  analysis = [a for _, a in creed.analyze_reads(reads, window=0, truth_reader=truth.TruthReader(fname), batch_size=3)]
+  for read, qname, a in zip(reads, qnames, analysis):
+    read.qname = qname
+    expected = list(creed.analyze_read(read, window=0))
+    expected[7] = int(expected[7])  # The mate read order is left as a string when parsed from the qname
+    assert list(a) == expected, (a, expected)
+  assert analysis[3] == [None] * 15  # Not a serial number
+  os.remove(fname)
@@ -1,6 +1,7 @@
 import tempfile
 import os
 import json
+import shutil
 
 from click.testing import CliRunner
 
@@ -56,4 +57,115 @@ def integration_test():
 
   assert len(ml) > 0
   assert len(pop.get_sample_names()) == 10
-  assert 'g0_s6' in pop.get_sample_names()
\ No newline at end of file
+  assert 'g0_s6' in pop.get_sample_names()
+
+
+def background_writer_test():
+  """'genomes' writes the same file with and without the background writer"""
+  _, param_file = tempfile.mkstemp(dir=mitty.tests.data_dir, suffix='.json')
+  _, db_file = tempfile.mkstemp(dir=mitty.tests.data_dir, suffix='.hdf5')
+  _, db_file_fg = tempfile.mkstemp(dir=mitty.tests.data_dir, suffix='.hdf5')
+  test_params = {
+    "files": {
+      "reference_dir": mitty.tests.example_data_dir,
+    },
+    "rng": {
+      "master_seed": 1
+    },
+    "sample_size": 10,
+    "chromosomes": [1, 2],
+    "variant_models": [
+      {
+        "snp": {
+          "p": 0.01
+        }
+      }
+    ]
+  }
+  json.dump(test_params, open(param_file, 'w'))
+
+  runner = CliRunner()
+  for fname, queue_depth in [(db_file, '2'), (db_file_fg, '0')]:
+    result = runner.invoke(genomes.cli, ['generate', param_file, '--db', fname, '--queue-depth', queue_depth])
+    assert result.exit_code == 0, result
+
+  pop, pop_fg = vr.Population(fname=db_file), vr.Population(fname=db_file_fg)
+  assert sorted(pop.get_sample_names()) == sorted(pop_fg.get_sample_names())
+  for chrom in [1, 2]:
+    assert (pop.get_variant_master_list(chrom).variants == pop_fg.get_variant_master_list(chrom).variants).all()
+    for sample_name in pop_fg.get_sample_names():
+      assert (pop.get_sample_variant_index_for_chromosome(chrom, sample_name) ==
+              pop_fg.get_sample_variant_index_for_chromosome(chrom, sample_name)).all()
+
+  os.remove(param_file)
+  os.remove(db_file)
+  os.remove(db_file_fg)
+
+
+def master_list_cache_test():
+  """'genomes' reuses cached master lists"""
+  _, param_file = tempfile.mkstemp(dir=mitty.tests.data_dir, suffix='.json')
+  _, db_file = tempfile.mkstemp(dir=mitty.tests.data_dir, suffix='.hdf5')
+  _, db_file_cached = tempfile.mkstemp(dir=mitty.tests.data_dir, suffix='.hdf5')
+  cache_dir = tempfile.mkdtemp(dir=mitty.tests.data_dir)
+  test_params = {
+    "files": {
+      "reference_dir": mitty.tests.example_data_dir,
+    },
+    "rng": {
+      "master_seed": 1
+    },
+    "sample_size": 2,
+    "site_model": {
+        "double_exp": {
+          "k1": 0.1,
+          "k2": 2.0,
+          "p0": 0.001,
+          "p1": 0.2,
+          "bin_cnt": 30
+        }
+    },
+    "chromosomes": [1, 2],
+    "variant_models": [
+      {
+        "snp": {
+          "p": 0.01
+        }
+      }
+    ]
+  }
+  json.dump(test_params, open(param_file, 'w'))
+
+  runner = CliRunner()
+  result = runner.invoke(genomes.cli, ['generate', param_file, '--db', db_file, '--ml-cache', cache_dir])
+  assert result.exit_code == 0, result
+  assert len(os.listdir(cache_dir)) == 2  # One per chromosome
+
+  # Only the population changes, so the master lists should come from the cache
+  test_params['sample_size'] = 5
+  json.dump(test_params, open(param_file, 'w'))
+  result = runner.invoke(genomes.cli, ['generate', param_file, '--db', db_file_cached, '--ml-cache', cache_dir])
+  assert result.exit_code == 0, result
+  assert len(os.listdir(cache_dir)) == 2
+
+  # And we should get exactly what we get without a cache
+  result = runner.invoke(genomes.cli, ['generate', param_file, '--db', db_file])
+  assert result.exit_code == 0, result
+  pop, pop_cached = vr.Population(fname=db_file), vr.Population(fname=db_file_cached)
+  for chrom in [1, 2]:
+    assert (pop.get_variant_master_list(chrom).variants == pop_cached.get_variant_master_list(chrom).variants).all()
+    for sample_name in pop.get_sample_names():
+      assert (pop.get_sample_variant_index_for_chromosome(chrom, sample_name) ==
+              pop_cached.get_sample_variant_index_for_chromosome(chrom, sample_name)).all()
+
+  # A different seed means new master lists
+  test_params['rng']['master_seed'] = 2
+  json.dump(test_params, open(param_file, 'w'))
+  result = runner.invoke(genomes.cli, ['generate', param_file, '--db', db_file_cached, '--ml-cache', cache_dir])
+  assert result.exit_code == 0, result
+  assert len(os.listdir(cache_dir)) == 4
+
+  os.remove(param_file)
+  os.remove(db_file)
+  os.remove(db_file_cached)
+  shutil.rmtree(cache_dir)
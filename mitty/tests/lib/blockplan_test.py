@@ -0,0 +1,47 @@
+from nose.tools import assert_raises
+
+import mitty.lib.blockplan as blockplan
+
+
+def parse_mem_test():
+  """Memory sizes with and without suffixes"""
+  assert blockplan.parse_mem('4G') == 4 << 30
+  assert blockplan.parse_mem('512m') == 512 << 20
+  assert blockplan.parse_mem('1.5GB') == 3 << 29
+  assert blockplan.parse_mem('100K') == 100 << 10
+  assert blockplan.parse_mem('200') == 200 << 20  # MB, like --queue-mem
+  assert_raises(ValueError, blockplan.parse_mem, '4Q')
+  assert_raises(ValueError, blockplan.parse_mem, 'G')
+
+
+def read_cost_test():
+  """Reads cost more the more we do with them"""
+  base = blockplan.read_cost(100)
+  assert all(c > 0 for c in base)
+  for kwargs in [{'corrupt': True}, {'truth_bam': True}, {'gzipped': True}, {'qname_len': 100}]:
+    w, q = blockplan.read_cost(100, **kwargs)
+    assert w > base[0] and q >= base[1], kwargs
+  assert blockplan.read_cost(250)[0] > base[0]
+  assert blockplan.read_cost(100, workers=4)[0] > blockplan.read_cost(100, workers=2)[0]
+
+
+def block_plan_test():
+  """Blocks are cut small enough to fit the budget, and no smaller"""
+  reads_per_copy = {1: 1e7, 2: 1e6, 3: 100}
+  cost = (2000, 1000)
+  plan = blockplan.BlockPlan(2 << 30, reads_per_copy, cost, depth=2, fixed=100 << 20, baseline=50 << 20)
+  budget = ((2 << 30) - (150 << 20)) * (1 - blockplan.HEADROOM)
+  for chrom, n_reads in reads_per_copy.items():
+    n = plan.blocks[chrom]
+    assert n_reads * 4000 / n <= budget  # Every stage busy and every queue full still fits
+    assert n == 1 or n_reads * 4000 / (n - 1) > budget  # One block fewer would not
+    assert plan.predicted_rss[chrom] <= 2 << 30
+  assert plan.blocks[1] > plan.blocks[2] > 1 and plan.blocks[3] == 1
+  assert 0 < plan.queue_mem < budget
+
+  plan2 = blockplan.BlockPlan(2 << 30, reads_per_copy, cost, fixed=100 << 20, baseline=50 << 20,
+                              min_blocks={1: 1, 2: 50, 3: 3})
+  assert plan2.blocks == {1: plan.blocks[1], 2: 50, 3: 3}
+
+  plan3 = blockplan.BlockPlan(100 << 20, reads_per_copy, cost, baseline=200 << 20)  # Budget taken up by baseline
+  assert plan3.blocks[1] >= 1e7 * 2000 / blockplan.MIN_BLOCK_BYTES
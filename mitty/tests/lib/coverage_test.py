@@ -0,0 +1,35 @@
+import tempfile
+import os
+
+import numpy as np
+
+import mitty.lib.coverage as coverage
+
+
+def binned_coverage_test():
+  """Binned coverage matches a per base count of the reads, across batches and chromosome copies"""
+  fname = tempfile.mktemp(suffix='.h5')
+  rng = np.random.RandomState(2)
+  seq_len = {1: 10005, 2: 3000}
+  spans = {}
+  w = coverage.CoverageWriter(fname, seq_len, bin_size=100)
+  for chrom, cpy in [(1, 0), (1, 1), (2, 0), (1, 0)]:  # Coming back to a copy adds to it
+    for _ in range(3):
+      start = rng.randint(-50, seq_len[chrom], size=500)
+      span = np.column_stack((start, start + rng.randint(0, 350, size=500)))
+      span[:5, 1] = span[:5, 0]  # Reads inside an insertion
+      w.add(chrom, cpy, span)
+      spans.setdefault((chrom, cpy), []).append(span)
+  w.close()
+
+  for (chrom, cpy), span in spans.items():
+    per_base = np.zeros(seq_len[chrom], dtype=np.int64)
+    for start, stop in np.concatenate(span):
+      per_base[max(start, 0):max(min(stop, seq_len[chrom]), 0)] += 1
+    counts, depth, bin_size = coverage.load_coverage(fname, chrom, cpy)
+    assert bin_size == 100
+    expected = np.add.reduceat(per_base, np.arange(0, seq_len[chrom], 100))
+    assert counts.tolist() == expected.tolist(), (chrom, cpy)
+    assert np.allclose(depth[:-1], expected[:-1] / 100.0)
+    assert np.isclose(depth[-1], expected[-1] / float(seq_len[chrom] % 100 or 100))
+  os.remove(fname)
@@ -168,4 +168,21 @@ def write_single_sample_to_vcf_test():
   assert v[2].alt == 'G'
   assert v[2].gt == '1|1'
 
-  os.remove(temp_name)
\ No newline at end of file
+  os.remove(temp_name)
+
+def bgzf_writer_test():
+  """BGZF output is readable by gzip and does not depend on the number of compression threads"""
+  rng = np.random.RandomState(1)
+  data = [np.array(list('ACGT\n'))[rng.randint(5, size=n)].tostring() for n in rng.randint(1, 100000, size=30)]
+  out = []
+  for threads in [1, 3]:
+    fname = tempfile.mktemp(suffix='.gz')
+    with mio.BgzfWriter(fname, threads=threads, chunk_size=100000) as fp:
+      for d in data:
+        fp.write(d)
+    assert gzip.open(fname).read() == ''.join(data)
+    out.append(open(fname, 'rb').read())
+    os.remove(fname)
+  assert out[0] == out[1]
+  assert out[0].endswith(mio.BGZF_EOF)
+  assert len(mio.bgzf_compress('A' * 100000)) < 1000  # Two blocks
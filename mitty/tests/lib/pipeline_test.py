@@ -0,0 +1,61 @@
+import time
+
+from nose.tools import assert_raises
+
+import mitty.lib.pipeline as pipeline
+
+
+def order_test():
+  """Pipeline gives results in source order and counts items through each stage"""
+  p = pipeline.Pipeline(xrange(100), [('double', lambda x: 2 * x), ('str', str)], depth=3)
+  assert list(p) == [str(2 * x) for x in range(100)]
+  stats = p.get_stats()
+  assert [st['name'] for st in stats] == ['source', 'double', 'str']
+  assert all(st['items'] == 100 for st in stats)
+
+
+def stall_test():
+  """A slow stage shows up as busy, the stage feeding it as stalled on output"""
+  p = pipeline.Pipeline(xrange(10), [('fast', lambda x: x), ('slow', lambda x: time.sleep(0.02) or x)], depth=1)
+  assert list(p) == range(10)
+  fast, slow = p.get_stats()[1:]
+  assert slow['busy'] > 0.15
+  assert fast['busy'] < 0.05 and fast['stall_out'] > 0.1
+
+
+def max_mem_test():
+  """Queued items stay inside the memory cap, give or take one item let into an empty queue"""
+  in_queue = []
+
+  def slow(x):
+    in_queue.append(p.mem)
+    time.sleep(0.01)
+    return x
+
+  p = pipeline.Pipeline((('A' * n) for n in [10, 20, 30, 100, 10, 10, 40, 40]),
+                        [('copy', lambda x: x + ''), ('slow', slow)], depth=10, max_mem=50, sizeof=len)
+  assert [len(x) for x in p] == [10, 20, 30, 100, 10, 10, 40, 40]
+  assert max(in_queue) <= 50 + 100, in_queue
+  assert p.mem == 0
+
+
+def error_test():
+  """An exception in a stage stops the pipeline and is raised to the consumer"""
+  def bad(x):
+    if x == 5:
+      raise ValueError('bad item')
+    return x
+
+  p = pipeline.Pipeline(xrange(100), [('bad', bad), ('id', lambda x: x)])
+  with assert_raises(ValueError):
+    list(p)
+
+
+def approx_size_test():
+  """Item size estimates"""
+  import numpy as np
+  assert pipeline.approx_size(('AAAA', None, np.zeros(10, dtype='i4'))) == 44
+  assert pipeline.approx_size(['ACGT'] * 100) == 400
+  a = np.zeros(3, dtype=[('a', 'i4'), ('s', 'O')])
+  a['s'] = 'ACGTACGT'
+  assert pipeline.approx_size(a) == a.nbytes + 24
@@ -18,7 +18,7 @@ def expand_seq_test1():
 
   assert ref_seq == alt_seq
   assert_sequence_equal(beacons[1:-1], [])
-  assert_sequence_equal(v_locs, [])
+  assert_sequence_equal(v_locs.tolist(), [])
 
 
 def expand_seq_test2():
@@ -39,12 +39,12 @@ def expand_seq_test2():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 0)
   assert ref_seq == alt_seq, alt_seq
   assert_sequence_equal(beacons[1:-1], [], str(beacons))
-  assert_sequence_equal(v_locs, [3])
+  assert_sequence_equal(v_locs.tolist(), [3])
 
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 1)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(3, 3, 0)])
-  assert_sequence_equal(v_locs, [3])
+  assert_sequence_equal(v_locs.tolist(), [3])
 
   pos = [3]
   stop = [4]
@@ -61,7 +61,7 @@ def expand_seq_test2():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 0)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(4, 4, 3)])
-  assert_sequence_equal(v_locs, [3])
+  assert_sequence_equal(v_locs.tolist(), [3])
 
   pos = [3]
   stop = [7]
@@ -79,7 +79,7 @@ def expand_seq_test2():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 0)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(7, 4, -3)])
-  assert_sequence_equal(v_locs, [3])
+  assert_sequence_equal(v_locs.tolist(), [3])
 
 
 def expand_seq_test3():
@@ -101,7 +101,7 @@ def expand_seq_test3():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 1)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(4, 4, 2), (8, 8, -2)])
-  assert_sequence_equal(v_locs, [3, 7])
+  assert_sequence_equal(v_locs.tolist(), [3, 7])
 
 
   chrom = npl([(0, 0), (1, 1)])
@@ -112,7 +112,7 @@ def expand_seq_test3():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 1)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(8, 6, -2)])
-  assert_sequence_equal(v_locs, [3, 5])
+  assert_sequence_equal(v_locs.tolist(), [3, 5])
 
   pos = [1, 5, 7]
   stop = [4, 6, 8]
@@ -129,7 +129,7 @@ def expand_seq_test3():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 0)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(4, 2, -2), (5, 3, 0), (8, 6, 2)])
-  assert_sequence_equal(v_locs, [1, 3, 5])
+  assert_sequence_equal(v_locs.tolist(), [1, 3, 5])
 
 
 def expand_seq_test4():
@@ -151,7 +151,57 @@ def expand_seq_test4():
   alt_seq, beacons, v_locs = reads.expand_sequence(ref_seq, ml, chrom, 0)
   assert alt_seq == m_alt, alt_seq
   assert_sequence_equal(beacons[1:-1].tolist(), [(3, 3, 2)])
-  assert_sequence_equal(v_locs, [2])
+  assert_sequence_equal(v_locs.tolist(), [2])
+
+
+def expand_seq_compiled_test():
+  """Expand sequence: compiled version matches pure Python version, incl. overlapping and skipped variants"""
+  #          012345678901234567890
+  ref_seq = 'ACTGACTGACTGACTGACTGA'
+  pos = [1, 2, 4, 8, 9, 12, 15]
+  stop = [2, 5, 5, 11, 10, 13, 16]
+  ref = ['C', 'TGA', 'A', 'ACT', 'C', 'C', 'G']
+  alt = ['CAAAA', 'T', 'T', 'A', 'T', 'G', 'GTT']
+  p = [0.1] * 7
+  ml = vr.VariantList(pos, stop, ref, alt, p)
+  chrom = npl([(0, 2), (1, 0), (2, 1), (3, 2), (4, 1), (5, 0), (6, 1)])
+  for cpy in [0, 1]:
+    alt_seq0, waypoints0, v_locs0 = reads.py_expand_sequence(ref_seq, ml, chrom, cpy)
+    for c, m in [(chrom, ml), (chrom.tolist(), ml), (chrom, ml.variants)]:  # Structured or list chrom, list or array ml
+      alt_seq, waypoints, v_locs = reads.expand_sequence(ref_seq, m, c, cpy)
+      assert alt_seq == alt_seq0, alt_seq
+      assert_sequence_equal(waypoints.tolist(), waypoints0.tolist())
+      assert_sequence_equal(v_locs.tolist(), v_locs0)
+
+
+def haplotype_view_test():
+  """Haplotype view: slices and reads match the expanded sequence, reference passed through with no variants"""
+  #          012345678901234567890
+  ref_seq = 'ACTGACTGACTGACTGACTGA'
+  pos = [1, 4, 8, 12, 15]
+  stop = [2, 5, 11, 13, 16]
+  ref = ['C', 'A', 'ACT', 'C', 'G']
+  alt = ['CAAAA', 'T', 'A', 'G', 'GTT']
+  p = [0.1] * 5
+  ml = vr.VariantList(pos, stop, ref, alt, p)
+  chrom = npl([(0, 2), (1, 0), (2, 1), (3, 2), (4, 1)])
+  for cpy in [0, 1]:
+    alt_seq, waypoints, v_locs = reads.expand_sequence(ref_seq, ml, chrom, cpy)
+    hv = reads.HaplotypeView(ref_seq, ml, chrom, cpy)
+    assert len(hv) == len(alt_seq)
+    assert hv[:] == alt_seq
+    assert hv[3] == alt_seq[3]
+    for lo in range(len(alt_seq)):
+      for hi in range(lo, len(alt_seq) + 2):
+        assert hv[lo:hi] == alt_seq[lo:hi], (lo, hi)
+    start, read_order = np.arange(len(alt_seq) - 4), np.arange(len(alt_seq) - 4) % 2
+    assert_sequence_equal(list(reads.read_matrix_to_strings(reads.extract_reads(hv, start, read_order, 4))),
+                          list(reads.read_matrix_to_strings(reads.extract_reads(alt_seq, start, read_order, 4))))
+    assert_sequence_equal(hv.variant_waypoints.tolist(), waypoints.tolist())
+
+  hv = reads.HaplotypeView(ref_seq, vr.VariantList(), [], 0)
+  assert hv.null
+  assert hv[:] is ref_seq
 
 
 def cigar_test1():
@@ -367,10 +417,114 @@ def cigar_test7():
   assert cigars[3] == '3=', cigars[3]
 
 
+def cigar_compiled_test():
+  """Rolling cigars: compiled version matches pure Python version, extended and old style"""
+  #          01234567890123456789
+  ref_seq = 'ACTGACTGACTGACTGACTG'
+  pos = [1, 4, 8, 12, 15]
+  stop = [2, 5, 11, 13, 16]
+  ref = ['C', 'A', 'ACT', 'C', 'G']
+  alt = ['CAAAA', 'T', 'A', 'G', 'GTT']
+  p = [0.1] * 5
+  ml = vr.VariantList(pos, stop, ref, alt, p)
+  chrom = npl([(0, 2), (1, 2), (2, 2), (3, 2), (4, 2)])
+  alt_seq, variant_waypoints, _ = reads.expand_sequence(ref_seq, ml, chrom, 0)
+  read_list = np.rec.fromrecords([(st, rl) for rl in [1, 3, 6, 10] for st in range(len(alt_seq) - rl)],
+                                 names=['start_a', 'read_len'])
+  pos0, cigars0 = reads.py_roll_cigars(variant_waypoints, read_list)
+  pos1, cigars1 = reads.roll_cigars(variant_waypoints, read_list)
+  assert_sequence_equal(pos1.tolist(), pos0)
+  assert_sequence_equal(cigars1, cigars0)
+  pos2, cigars2 = reads.roll_cigars(variant_waypoints, read_list, old_style=True)
+  assert_sequence_equal(cigars2, [reads.old_style_cigar(c) for c in cigars0])
+
+  pos3, cigar_buf, cigar_offsets = reads.roll_cigars_packed(variant_waypoints, read_list)
+  assert cigar_buf == ''.join(cigars0)
+  assert cigar_offsets[0] == 0 and cigar_offsets[-1] == len(cigar_buf)
+
+
 def old_style_cigar_test():
   """Converting extended cigars to old style cigars"""
   assert reads.old_style_cigar('100=') == '100M'
   assert reads.old_style_cigar('20=1X40=') == '61M'
   assert reads.old_style_cigar('20S1X40=') == '20S41M'
   assert reads.old_style_cigar('20S1X30I40=') == '20S1M30I40M'
-  assert reads.old_style_cigar('20S1X30I40=30D1X1X20M') == '20S1M30I40M30D22M'
\ No newline at end of file
+  assert reads.old_style_cigar('20S1X30I40=30D1X1X20M') == '20S1M30I40M30D22M'
+
+def extract_reads_test():
+  """Batch read extraction"""
+  import mitty.lib
+  #          0123456789012345
+  ref_seq = 'ACTGACTGNACTGACT'
+  ref_seq_c = mitty.lib.string.translate(ref_seq, mitty.lib.DNA_complement)
+  start, read_order = np.array([0, 5, 0, 11, 12]), np.array([0, 1, 1, 0, 1])
+  rd = reads.extract_reads(ref_seq, start, read_order, 4)
+  assert rd.shape == (5, 4)
+  expected = [ref_seq[s:s + 4] if ro == 0 else ref_seq_c[s:s + 4][::-1] for s, ro in zip(start, read_order)]
+  assert_sequence_equal(list(reads.read_matrix_to_strings(rd)), expected)
+  assert reads.extract_reads(ref_seq, np.array([], dtype=int), np.array([]), 4).shape == (0, 4)
+
+
+def merge_intervals_test():
+  """Merging overlapping and touching intervals"""
+  m = reads.merge_intervals([0, 2, 5, 10, 11, 30], [3, 5, 8, 20, 12, 31])
+  assert_sequence_equal(m.tolist(), [[0, 8], [10, 20], [30, 31]])
+  assert reads.merge_intervals([], []).shape == (0, 2)
+
+
+def intersect_intervals_test():
+  """Intersecting two sets of intervals"""
+  a = [(0, 10), (20, 30), (40, 50)]
+  b = [(5, 25), (28, 29), (45, 60), (70, 80)]
+  assert_sequence_equal(reads.intersect_intervals(a, b).tolist(), [[5, 10], [20, 25], [28, 29], [45, 50]])
+  assert reads.intersect_intervals(a, []).shape == (0, 2)
+
+
+def n_free_intervals_test():
+  """Index of the runs of a sequence without N, the same whatever the chunk size"""
+  seq = 'NNACGTNNNTTANACNN' + 'A' * 20 + 'N'
+  for chunk_size in [1, 2, 3, 5, 1 << 24]:
+    m = reads.n_free_intervals(seq, chunk_size=chunk_size)
+    assert_sequence_equal(m.tolist(), [[2, 6], [9, 12], [13, 15], [17, 37]])
+  assert_sequence_equal(reads.n_free_intervals('ACGT').tolist(), [[0, 4]])
+  assert reads.n_free_intervals('NNN').shape == (0, 2)
+  assert reads.n_free_intervals('').shape == (0, 2)
+
+
+def ref_to_alt_test():
+  """Mapping reference positions onto the expanded sequence"""
+  #          012345678901234
+  ref_seq = 'ACTGACTGACTGACT'
+  pos = [1, 3, 8]
+  stop = [2, 4, 11]
+  ref = ['C', 'G', 'ACT']
+  alt = ['T', 'GAA', 'A']
+  ml = vr.VariantList(pos, stop, ref, alt, [0.1] * 3)
+  chrom = npl([(0, 2), (1, 2), (2, 2)])
+  alt_seq, waypoints, _ = reads.expand_sequence(ref_seq, ml, chrom, 0)
+  #        0123  45678901234
+  #ref     ACTG  ACTGACTGACT
+  #alt     ATTGAAACTGA  GACT
+  #        01234567890  1234
+  m = reads.ref_to_alt(waypoints, np.arange(15))
+  assert_sequence_equal(m.tolist(), [0, 1, 2, 3, 6, 7, 8, 9, 10, 11, 11, 11, 12, 13, 14])
+
+
+def alt_to_ref_test():
+  """Mapping positions on the expanded sequence back to the reference, and the reference span of reads"""
+  ref_seq = 'ACTGACTGACTGACT'
+  ml = vr.VariantList([1, 3, 8], [2, 4, 11], ['C', 'G', 'ACT'], ['T', 'GAA', 'A'], [0.1] * 3)
+  chrom = npl([(0, 2), (1, 2), (2, 2)])
+  alt_seq, waypoints, _ = reads.expand_sequence(ref_seq, ml, chrom, 0)
+  #        0123  45678901234
+  #ref     ACTG  ACTGACTGACT
+  #alt     ATTGAAACTGA  GACT
+  #        01234567890  1234
+  m = reads.alt_to_ref(waypoints, np.arange(15))
+  assert_sequence_equal(m.tolist(), [0, 1, 2, 3, 4, 4, 4, 5, 6, 7, 8, 11, 12, 13, 14])
+  m = reads.alt_to_ref(waypoints, np.arange(15), insertion_side='left')
+  assert_sequence_equal(m.tolist(), [0, 1, 2, 3, 3, 3, 4, 5, 6, 7, 8, 11, 12, 13, 14])
+
+  rd = np.rec.fromarrays([[0, 4, 2, 9, 10], [2, 2, 4, 3, 1]], names=['start_a', 'read_len'])
+  # Plain, inside the insertion, ending inside the insertion, across the deletion, ending just before the deletion
+  assert_sequence_equal(reads.read_ref_spans(waypoints, rd).tolist(), [[0, 2], [4, 4], [2, 4], [7, 12], [8, 9]])
@@ -0,0 +1,30 @@
+import tempfile
+import os
+
+import numpy as np
+
+import mitty.lib.truth as truth
+
+
+def round_trip_test():
+  """Truth sidecar gives back what was written, across several flushes"""
+  fname = tempfile.mktemp(suffix='.h5')
+  rng = np.random.RandomState(1)
+  pos = rng.randint(0, 1000000, size=1000)
+  cigars = ['{:d}={:d}I{:d}='.format(a, b, 100 - a - b) for a, b in rng.randint(1, 50, size=(1000, 2))]
+  cigars[7] = ''
+  w = truth.TruthWriter(fname, paired=True, chunk_size=64)
+  for n in range(0, 1000, 100):  # 50 templates at a time
+    w.append(3, n % 2, np.arange(100) % 2, pos[n:n + 100], 100, cigars[n:n + 100])
+  w.close()
+
+  r = truth.TruthReader(fname)
+  assert r.paired and len(r) == 1000
+  rows = r.get_rows([0, 3, 499, 3], [1, 0, 1, 1])
+  assert rows.tolist() == [1, 6, 999, 7]
+  t, c = r.lookup(rows)
+  assert t['pos'].tolist() == pos[rows].tolist()
+  assert t['ro'].tolist() == [1, 0, 1, 1]
+  assert t['chrom'].tolist() == [3] * 4 and t['rlen'].tolist() == [100] * 4
+  assert c == [cigars[k] for k in rows]
+  os.remove(fname)
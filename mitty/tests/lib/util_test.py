@@ -154,4 +154,13 @@ def sequence_gen_test3():
   assert seq_l[0] == 'ACGA', seq_l[0]
   assert l[0] == 4
   assert seq_l[1] == 'TCTAAC', seq_l[1]
-  assert l[1] == 6
\ No newline at end of file
+  assert l[1] == 6
+
+def alias_table_test():
+  """Alias table sampling"""
+  weights = numpy.array([0.0, 1.0, 2.0, 0.5, 0.0, 4.5])
+  prob, alias = mitty.lib.util.alias_table(weights)
+  rng = numpy.random.RandomState(seed=1)
+  counts = numpy.bincount(mitty.lib.util.alias_sample(rng, prob, alias, 200000), minlength=weights.size)
+  assert counts[0] == 0 and counts[4] == 0
+  assert_array_almost_equal(counts / 200000.0, weights / weights.sum(), decimal=2)
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 import mitty.lib.variants as vr
 
 from nose.tools import assert_sequence_equal
@@ -117,6 +120,33 @@ def collision_test():
   assert_array_equal(z_idx, [0, 2])
 
 
+def collision_index_test():
+  """Collisions using the precomputed collision index"""
+  pos =  [1, 3, 5, 7]
+  stop = [3, 4, 7, 8]
+  nxt = vr.collision_index(pos, stop)
+  assert_array_equal(nxt, [2, 2, 4, 4])
+  assert_array_equal(vr.avoid_collisions_indexed(nxt, [0, 1, 2, 3]), [0, 2])
+  assert_array_equal(vr.avoid_collisions_indexed(nxt, [1, 2, 3]), [1, 2])
+
+
+def collision_index_random_test():
+  """Collision index gives identical results to avoid_collisions (singly and in blocks)"""
+  rng = np.random.RandomState(42)
+  pos = np.sort(rng.randint(0, 2000, size=1000)).astype('i4')
+  stop = (pos + rng.geometric(0.3, size=1000)).astype('i4')
+  stop[rng.randint(0, 1000, size=20)] += 100  # Some long deletions that swallow several variants
+  nxt = vr.collision_index(pos, stop)
+  sel = rng.rand(6, 1000) < 0.5
+  z_block = vr.avoid_collisions_block(nxt, sel)
+  for n in range(sel.shape[0]):
+    idx = sel[n].nonzero()[0]
+    z = vr.py_avoid_collisions(pos, stop, idx)
+    assert_array_equal(vr.avoid_collisions(pos, stop, idx), z)
+    assert_array_equal(vr.avoid_collisions_indexed(nxt, idx), z)
+    assert_array_equal(z_block[n], z)
+
+
 def merge_test():
   """Merging"""
   pos =  [1, 3, 5, 7]
@@ -225,6 +255,47 @@ def sample_roundtrip_test():
   assert_array_equal(chrom, c2)
 
 
+def delta_sample_roundtrip_test():
+  """Sample round-trip, with samples stored as deltas against a parent"""
+  genome_metadata = [{'seq_id': 'chr1', 'seq_len': 10, 'seq_md5': '10'}]
+  dt = [('index', 'i4'), ('gt', 'i1')]
+  s0 = np.array([(1, 0), (2, 1), (3, 2), (5, 0)], dtype=dt)
+  s1 = np.array([(0, 1), (1, 0), (3, 0), (4, 2), (5, 0), (6, 1)], dtype=dt)  # Adds, removes and changes a gt
+  s2 = np.array([(0, 1), (6, 1)], dtype=dt)
+  s3 = np.array([(2, 1), (1, 0)], dtype=dt)  # Records in a different order from the parent, stored in full
+  pl = vr.Population(fname='round_trip.h5', mode='w', genome_metadata=genome_metadata, in_memory=True)
+  ml = vr.VariantList()
+  ml.sort()
+  pl.set_master_list(chrom=1, master_list=ml)
+  pl.add_sample_chromosome(chrom=1, sample_name='s0', indexes=s0)
+  pl.add_sample_chromosome(chrom=1, sample_name='s1', indexes=s1, parent='s0')
+  pl.add_sample_chromosome(chrom=1, sample_name='s2', indexes=s2, parent='s1')
+  pl.add_sample_chromosome(chrom=1, sample_name='s3', indexes=s3, parent='s0')
+  assert pl.fp['/samples/s2/1'].attrs['parent'] == 's1'
+  assert 'parent' not in pl.fp['/samples/s3/1'].attrs
+
+  for name, s in [('s2', s2), ('s0', s0), ('s1', s1), ('s3', s3)]:
+    assert_array_equal(s, pl.get_sample_variant_index_for_chromosome(chrom=1, sample_name=name))
+    assert pl.get_sample_variant_count(chrom=1, sample_name=name) == s.size
+
+
+def sample_cache_copy_test():
+  """Changing the indexes after writing a sample does not change what we read back"""
+  genome_metadata = [{'seq_id': 'chr1', 'seq_len': 10, 'seq_md5': '10'}]
+  pl = vr.Population(fname='round_trip.h5', mode='w', genome_metadata=genome_metadata, in_memory=True)
+  ml = vr.VariantList()
+  ml.sort()
+  pl.set_master_list(chrom=1, master_list=ml)
+  a = vr.l2ca([(0, 2), (1, 0)])
+  pl.add_sample_chromosome(chrom=1, sample_name='s', indexes=a)
+  a['gt'][:] = 1
+  assert_index_array_equal(pl.get_sample_variant_index_for_chromosome(chrom=1, sample_name='s'), [(0, 2), (1, 0)])
+  b = vr.l2ca([(0, 2), (2, 1)])
+  pl.add_sample_chromosome(chrom=1, sample_name='t', indexes=b, parent='s')
+  b['index'][:] = 5
+  assert_index_array_equal(pl.get_sample_variant_index_for_chromosome(chrom=1, sample_name='t'), [(0, 2), (2, 1)])
+
+
 def chrom_metadata_roundtrip_test():
   """Chromosome metadata round-trip"""
   genome_metadata = [
@@ -256,3 +327,24 @@ def sample_variant_test():
 
   assert ch_v_l[0][0]['pos'] == 10
   assert ch_v_l[1][0]['pos'] == 20
+
+
+def population_writer_failure_test():
+  """A failure in the population writer process comes back to the producer, with the writer's traceback"""
+  genome_metadata = [{'seq_id': 'chr1', 'seq_len': 10, 'seq_md5': '10'}]
+  for wait in [True, False]:  # The next write, or close, finds out
+    fname = tempfile.mktemp(suffix='.h5')
+    pw = vr.PopulationWriter(fname, genome_metadata)
+    pw.add_sample_chromosome(1, 's', vr.l2ca([(0, 1)]))  # No master list for this chromosome
+    try:
+      if wait:
+        pw.proc.join(10)
+        pw.set_pedigree([])
+      else:
+        pw.close()
+    except RuntimeError as e:
+      assert 'absent in the master list' in str(e), str(e)
+    else:
+      assert False, 'Writer failure was not passed on'
+    if os.path.exists(fname):
+      os.remove(fname)
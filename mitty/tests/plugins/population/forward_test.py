@@ -0,0 +1,102 @@
+"""Run genomes generate with the forward-time model and check that children only carry variants from their parents"""
+import tempfile
+import os
+import json
+
+import numpy as np
+from numpy.testing import assert_array_equal
+from click.testing import CliRunner
+
+import mitty.lib.variants as vr
+import mitty.genomes as genomes
+import mitty.plugins.population.forward as forward
+import mitty.tests
+
+
+def copy_bits_test():
+  """Copying bit ranges between packed haplotypes"""
+  rng = np.random.RandomState(3)
+  a, b = rng.rand(2, 43) < 0.5
+  for lo, hi in [(0, 43), (0, 8), (3, 5), (5, 17), (8, 16), (9, 43), (16, 16), (42, 43)]:
+    dst = np.packbits(a)
+    forward.copy_bits(np.packbits(b), dst, lo, hi)
+    expected = a.copy()
+    expected[lo:hi] = b[lo:hi]
+    assert_array_equal(np.unpackbits(dst)[:43].view(bool), expected, (lo, hi))
+
+
+def block_size_test():
+  """Samples are the same however many we unpack at a time, including the block size we work out ourselves"""
+  rng = np.random.RandomState(4)
+  pos = np.sort(rng.choice(100000, size=500, replace=False))
+  ml = vr.VariantList(pos, pos + 1, ['A'] * 500, ['T'] * 500, [0.3] * 500)
+  ml.sort()
+  out = []
+  unpack_bytes = forward.UNPACK_BYTES
+  forward.UNPACK_BYTES = 4 * 2 * 500  # Four samples at a time
+  try:
+    for block_size in [None, 1, 3, 100]:
+      mdl = forward.Model(population_size=10, generations=3, recombination_rate=1e-4, output_generations=2,
+                          block_size=block_size)
+      out.append([(name, s.tolist()) for name, s, _ in mdl.samples(ml=ml, rng_seed=7)])
+  finally:
+    forward.UNPACK_BYTES = unpack_bytes
+  assert len(out[0]) == 20
+  assert out[0] == out[1] == out[2] == out[3]
+
+
+def forward_test():
+  """Test 'forward' population model"""
+  _, param_file = tempfile.mkstemp(suffix='.json')
+  _, db_file = tempfile.mkstemp(suffix='.hdf5')
+  test_params = {
+    "files": {
+      "reference_file": mitty.tests.test_fasta_genome_file,
+      "dbfile": db_file
+    },
+    "rng": {
+      "master_seed": 12345
+    },
+    "population_model": {
+      "forward": {
+        "population_size": 20,
+        "generations": 5,
+        "recombination_rate": 1e-3,
+        "output_generations": 2,
+        "block_size": 7
+      }
+    },
+    "chromosomes": [1, 2],
+    "variant_models": [
+      {
+        "snp": {
+          "p": 0.01
+        }
+      }
+    ]
+  }
+  json.dump(test_params, open(param_file, 'w'))
+
+  runner = CliRunner()
+  result = runner.invoke(genomes.cli, ['generate', param_file])
+  assert result.exit_code == 0, result
+  assert os.path.exists(db_file)
+
+  pop = vr.Population(fname=db_file, mode='r', in_memory=False)
+  assert len(pop.get_sample_names()) == 40
+  pedigree = pop.get_pedigree()
+  assert len(pedigree) == 40
+  for sample_name, father, mother in pedigree:
+    if not sample_name.startswith('g5'):
+      continue
+    assert father.startswith('g4') and mother.startswith('g4')
+    for chrom in [1, 2]:
+      # SNPs never collide, so a child can only carry variants its parents carry
+      child = pop.get_sample_variant_index_for_chromosome(chrom, sample_name)
+      parents = set(pop.get_sample_variant_index_for_chromosome(chrom, father)['index']) | \
+                set(pop.get_sample_variant_index_for_chromosome(chrom, mother)['index'])
+      assert len(child) > 0
+      assert set(child['index']) <= parents
+
+  os.remove(param_file)
+  os.remove(db_file)
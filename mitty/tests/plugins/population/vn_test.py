@@ -4,6 +4,7 @@ import tempfile
 import os
 import json
 
+import numpy as np
 from click.testing import CliRunner
 
 import mitty.lib.variants as vr
@@ -65,5 +66,55 @@ def vn_test():
   os.remove(param_file)
   os.remove(db_file)
 
+
+def vn_delta_encode_test():
+  """Test 'vn' population model with delta encoded samples"""
+  _, param_file = tempfile.mkstemp(suffix='.json')
+  _, db_file = tempfile.mkstemp(suffix='.hdf5')
+  _, db_file_delta = tempfile.mkstemp(suffix='.hdf5')
+  test_params = {
+    "files": {
+      "reference_file": mitty.tests.test_fasta_genome_file,
+    },
+    "rng": {
+      "master_seed": 12345
+    },
+    "population_model": {
+      "vn": {
+        "p_vx": 0.2,
+        "p_vn": [0.1, 0.5, 0.9]
+      }
+    },
+    "chromosomes": [1, 2],
+    "variant_models": [
+      {
+        "snp": {
+          "p": 0.01
+        }
+      }
+    ]
+  }
+  runner = CliRunner()
+  for delta_encode, fname in [(False, db_file), (True, db_file_delta)]:
+    test_params['files']['dbfile'] = fname
+    test_params['population_model']['vn']['delta_encode'] = delta_encode
+    json.dump(test_params, open(param_file, 'w'))
+    result = runner.invoke(genomes.cli, ['generate', param_file])
+    assert result.exit_code == 0, result
+
+  pop = vr.Population(fname=db_file, mode='r', in_memory=False)
+  pop_delta = vr.Population(fname=db_file_delta, mode='r', in_memory=False)
+  for chrom in [1, 2]:
+    for v in ['vx', 'v0', 'v1', 'v2']:
+      idx = pop.get_sample_variant_index_for_chromosome(chrom, v)
+      assert idx.size > 0
+      assert (v == 'vx') != ('parent' in pop_delta.fp['/samples/{}/{}'.format(v, chrom)].attrs)
+      np.testing.assert_array_equal(idx, pop_delta.get_sample_variant_index_for_chromosome(chrom, v))
+      assert pop.get_sample_variant_count(chrom, v) == pop_delta.get_sample_variant_count(chrom, v)
+
+  os.remove(param_file)
+  os.remove(db_file)
+  os.remove(db_file_delta)
+
 # Need cleanup code to work even if test fails ...
 # nosetests mitty.tests.plugins.population
\ No newline at end of file
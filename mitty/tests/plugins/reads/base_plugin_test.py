@@ -0,0 +1,71 @@
+import numpy as np
+
+from mitty.plugins.reads.base_plugin import ReadModel, ReadBatch, V1Adapter, as_v2
+
+
+def v1_reads(lengths):
+  rng = np.random.RandomState(1)
+  rd = np.recarray(dtype=ReadModel.dtype, shape=len(lengths))
+  rd['start_a'] = np.arange(len(lengths)) * 10
+  rd['read_len'] = lengths
+  rd['read_order'] = rng.randint(2, size=len(lengths))
+  rd['perfect_reads'] = [np.array(list('ACGT'))[rng.randint(4, size=l)].tostring() for l in lengths]
+  rd['corrupt_reads'] = [s.lower() for s in rd['perfect_reads']]
+  rd['phred'] = ['5' * len(s) for s in rd['perfect_reads']]
+  return rd
+
+
+class V1Model(ReadModel):
+  def __init__(self, lengths):
+    self.lengths, self.read_len = lengths, 7
+    ReadModel.__init__(self, True)
+
+  def get_reads(self, seq, seq_c, start_base=0, end_base=None, coverage=0.01, corrupt=False, seed=1):
+    return v1_reads(self.lengths), self.paired
+
+
+def from_recarray_test():
+  """v1 reads convert to a ReadBatch, fixed width when all reads are the same length, ragged otherwise"""
+  for lengths, fixed in [([5, 5, 5], True), ([3, 1, 7, 2], False)]:
+    rd = v1_reads(lengths)
+    b = ReadBatch.from_recarray(rd)
+    assert len(b) == len(lengths) and b.fixed_width == fixed
+    assert (b.start_a == rd['start_a']).all() and (b.read_order == rd['read_order']).all()
+    assert b.offsets.tolist() == np.cumsum([0] + lengths).tolist()
+    assert b.as_strings(b.seq) == rd['perfect_reads'].tolist()
+    assert b.as_strings(b.corrupt) == rd['corrupt_reads'].tolist()
+    assert b.as_strings(b.qual) == rd['phred'].tolist()
+
+
+def concatenate_test():
+  """Concatenated batches keep their reads in order and stay fixed width (with a shared quality row) when they can"""
+  seq = np.fromstring('ACGTACGTAC', dtype=np.uint8).reshape(2, 5)
+  qual = np.fromstring('ABCDE', dtype=np.uint8)
+  a = ReadBatch([0, 1], [5, 5], [0, 1], seq, seq, qual)
+  b = ReadBatch([2, 3], [5, 5], [1, 0], seq[::-1], seq, qual)
+  c = ReadBatch.concatenate([a, ReadBatch.empty(5), b])
+  assert c.fixed_width and c.qual_shared and c.start_a.tolist() == [0, 1, 2, 3]
+  assert c.as_strings(c.seq) == ['ACGTA', 'CGTAC', 'CGTAC', 'ACGTA']
+  assert c.as_strings(c.qual) == ['ABCDE'] * 4
+
+  d = ReadBatch([4], [2], [0], np.fromstring('GG', dtype=np.uint8), np.fromstring('gg', dtype=np.uint8),
+                np.fromstring('FF', dtype=np.uint8))
+  c = ReadBatch.concatenate([a, d])
+  assert not c.fixed_width and not c.qual_shared
+  assert c.as_strings(c.seq) == ['ACGTA', 'CGTAC', 'GG']
+  assert c.as_strings(c.corrupt) == ['ACGTA', 'CGTAC', 'gg']
+  assert c.as_strings(c.qual) == ['ABCDE', 'ABCDE', 'FF']
+
+  assert len(ReadBatch.concatenate([])) == 0
+
+
+def v1_adapter_test():
+  """A v1 plugin is wrapped to give ReadBatch, and the plugin's own attributes still show through"""
+  mdl = V1Model([4, 6])
+  wrapped = as_v2(mdl)
+  assert isinstance(wrapped, V1Adapter) and wrapped.abi_version == 2
+  assert wrapped.read_len == 7 and wrapped.paired
+  reads, paired = wrapped.get_reads('ACGT' * 10, None)
+  assert paired and isinstance(reads, ReadBatch) and reads.read_len.tolist() == [4, 6]
+  assert isinstance(wrapped.get_zero_reads()[0], ReadBatch)
+  assert as_v2(wrapped) is wrapped
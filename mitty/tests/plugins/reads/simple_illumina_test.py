@@ -0,0 +1,144 @@
+import numpy as np
+
+import mitty.lib
+import mitty.lib.reads as lib_reads
+import mitty.lib.variants as vr
+import mitty.plugins.reads.simple_illumina_plugin as ip
+
+
+def sample_error_locations_test():
+  """Sparse error location sampling follows the error profile"""
+  rng = np.random.RandomState(1)
+  error_profile = np.array([0, 1e-19, 0.001, 0.01, 0.1, 0.5, 1.0])
+  rows, cols = ip.sample_error_locations(rng, 100000, error_profile)
+  assert rows.size == cols.size
+  assert np.unique(rows * error_profile.size + cols).size == rows.size  # Each base is corrupted at most once
+  assert 0 <= rows.min() and rows.max() < 100000
+  rate = np.bincount(cols, minlength=error_profile.size) / 100000.0
+  assert np.abs(rate - error_profile).max() < 0.01, rate
+  assert rate[0] == 0 and rate[-1] == 1.0
+
+  rows, cols = ip.sample_error_locations(rng, 0, error_profile)
+  assert rows.size == 0 and cols.size == 0
+
+
+def corrupt_reads_test():
+  """Corrupted reads differ from perfect reads only at sampled error locations"""
+  rng = np.random.RandomState(2)
+  seq = np.array(list('ACGT'))[rng.randint(4, size=10000)].tostring()
+  seq_c = mitty.lib.string.translate(seq, mitty.lib.DNA_complement)
+  mdl = ip.Model(read_len=50, template_len_mean=150, template_len_sd=10, max_p_error=0.5, k=5)
+  reads, _ = mdl.get_reads(seq, seq_c, coverage=10, corrupt=True, seed=3)
+  pr, cr = reads.seq, reads.corrupt
+  assert pr.shape == cr.shape == (len(reads), 50)
+  mismatches = (pr != cr).sum()
+  assert 0 < mismatches < 0.5 * pr.size
+  assert set(np.unique(cr)) <= set(np.fromstring('ACGT', dtype=np.uint8))
+  assert reads.qual_shared and reads.qual.tostring() == mdl.phred
+
+
+def gc_cumsum_test():
+  """G/C running count, from a string and from a HaplotypeView, which is only ever sliced a chunk at a time"""
+  rng = np.random.RandomState(3)
+  ref_seq = np.array(list('ACGTN'))[rng.randint(5, size=20000)].tostring()
+  pos, stop = [100, 5000, 19990], [101, 5001, 20000]
+  ml = vr.VariantList(pos, stop, [ref_seq[p:q] for p, q in zip(pos, stop)], ['GGGCCCGGG', 'A', 'C'], [0.5] * 3)
+  chrom = np.array([(0, 2), (1, 2), (2, 2)], dtype=[('index', 'i4'), ('gt', 'i1')])
+  alt_seq, _, _ = lib_reads.expand_sequence(ref_seq, ml, chrom, 0)
+  hv = lib_reads.HaplotypeView(ref_seq, ml, chrom, 0)
+
+  def small_slices(item, getitem=hv.__getitem__):
+    assert item.stop - item.start <= 3000, 'Sliced too much of the haplotype view'
+    return getitem(item)
+  hv.__getitem__ = small_slices
+
+  chunk = ip.GC_CHUNK_BASES
+  ip.GC_CHUNK_BASES = 3000
+  try:
+    mdl = ip.Model(gc_bias={'bias_center': 0.5, 'bias_height': 1.5, 'bias_spread': 0.3})
+    cum = mdl.gc_cumsum(hv)
+    assert cum is mdl.gc_cumsum(hv)  # Kept for the same sequence
+    assert cum.tolist() == mdl.gc_cumsum(alt_seq).tolist()
+  finally:
+    ip.GC_CHUNK_BASES = chunk
+  for a, b in [(0, 100), (95, 110), (2999, 3001), (0, len(alt_seq))]:
+    assert cum[b] - cum[a] == alt_seq.count('G', a, b) + alt_seq.count('C', a, b)
+  assert mdl.fixed_memory(10 ** 8) > mdl.fixed_memory(10 ** 6) > ip.Model().fixed_memory(10 ** 8) == 0
+
+
+def gc_density_test():
+  """Templates are placed with a density that follows the GC curve, above 1.0 as well as below it"""
+  rng = np.random.RandomState(6)
+  # Stretches of 20% 50% and 65% GC
+  seq = ''.join(np.array(list('ACGT'))[rng.choice(4, size=60000, p=[(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2])]
+                .tostring() for gc in [0.2, 0.5, 0.65])
+  mdl = ip.Model(read_len=50, template_len_mean=150, template_len_sd=0,
+                 gc_bias={'bias_center': 0.55, 'bias_height': 2.0, 'bias_spread': 0.15})
+  reads, _ = mdl.get_reads(seq, None, coverage=30, seed=5)
+  template_locs = np.minimum(reads['start_a'][::2], reads['start_a'][1::2])
+  # Every template is 150 long, so we can work out the density we expect at each start
+  cum = mdl.gc_cumsum(seq)
+  s = np.arange(len(seq) - 150)
+  curve = mdl.gc_curve[np.minimum((100 * (cum[s + 150] - cum[s]) / 150.0).astype(int), 99)]
+  p_template = 0.5 * 30 / 50.0
+  for lo in [0, 60000, 120000]:
+    inside = (lo + 1000 <= template_locs) & (template_locs < lo + 59000)
+    expected = p_template * curve[lo + 1000:lo + 59000].sum()
+    assert abs(inside.sum() - expected) < 3 * np.sqrt(expected) + 1, (lo, inside.sum(), expected)
+  assert p_template * curve[61000:119000].mean() > 1.5 * p_template  # The curve goes above 1.0 here
+
+
+def gc_small_block_test():
+  """The number of GC biased templates is drawn, so a block expecting less than one template can still get one"""
+  seq = 'ACGT' * 1000
+  mdl = ip.Model(read_len=50, template_len_mean=150, template_len_sd=10,
+                 gc_bias={'bias_center': 0.5, 'bias_height': 1.0, 'bias_spread': 0.3})
+  n = [len(mdl.get_reads(seq, None, intervals=[(1000, 1300)], coverage=0.2, seed=seed)[0]) for seed in range(400)]
+  # 300 bases at 0.002 templates per base is 0.6 expected templates, about half of which fit in the interval
+  assert 0.4 < np.mean(n) < 0.8, np.mean(n)
+
+
+def gc_bias_test():
+  """GC biased reads come preferentially from regions with GC content near the bias center"""
+  rng = np.random.RandomState(4)
+  seq = np.array(list('AT'))[rng.randint(2, size=50000)].tostring() + \
+        np.array(list('ACGT'))[rng.randint(4, size=50000)].tostring()
+  seq_c = mitty.lib.string.translate(seq, mitty.lib.DNA_complement)
+  mdl = ip.Model(read_len=50, template_len_mean=150, template_len_sd=10,
+                 gc_bias={'bias_center': 0.5, 'bias_height': 1.0, 'bias_spread': 0.1})
+  reads, _ = mdl.get_reads(seq, seq_c, coverage=20, corrupt=False, seed=3)
+  at_rich = (reads['start_a'] < 50000).sum()
+  assert at_rich < 0.01 * len(reads), at_rich
+  # The balanced half has GC close to, but not exactly at, the center so gets a little under the full coverage
+  assert 0.5 * 20 * 50000 / 50.0 < len(reads) < 20 * 50000 / 50.0, len(reads)
+
+
+def gc_bias_template_test():
+  """GC bias follows the GC content of each template, not just that of the window it was drawn from"""
+  # 150 base blocks of all AT then all GC. The windows (a mean template long) start mid block and all have a GC content
+  # of one half, but only templates that start near the middle of a block do too
+  seq = ('AT' * 75 + 'GC' * 75) * 400
+  mdl = ip.Model(read_len=50, template_len_mean=150, template_len_sd=5,
+                 gc_bias={'bias_center': 0.5, 'bias_height': 1.0, 'bias_spread': 0.1})
+  reads, _ = mdl.get_reads(seq, None, intervals=[(75, len(seq))], coverage=20, seed=3)
+  template_locs = np.minimum(reads['start_a'][::2], reads['start_a'][1::2])
+  offset = (template_locs - 75) % 150
+  near_middle = ((offset < 20) | (offset > 130)).mean()
+  assert len(reads) > 1000 and near_middle > 0.9, (len(reads), near_middle)
+
+
+def intervals_test():
+  """Reads taken from a set of intervals lie inside them, with coverage per base the same for each"""
+  rng = np.random.RandomState(5)
+  seq = np.array(list('ACGT'))[rng.randint(4, size=100000)].tostring()
+  mdl = ip.Model(read_len=50, template_len_mean=150, template_len_sd=10)
+  r0, _ = mdl.get_reads(seq, None, start_base=1000, end_base=60000, coverage=5, seed=7)
+  r1, _ = mdl.get_reads(seq, None, intervals=[(1000, 60000)], coverage=5, seed=7)
+  assert (r0['start_a'] == r1['start_a']).all()  # One interval is the same as start_base/end_base
+
+  intervals = np.array([(0, 1000), (5000, 25000), (90000, 100000)])
+  reads, _ = mdl.get_reads(seq, None, intervals=intervals, coverage=20, seed=7)
+  k = np.searchsorted(intervals[:, 1], reads['start_a'], side='right')
+  assert (intervals[k, 0] <= reads['start_a']).all() and (reads['start_a'] + 50 <= intervals[k, 1]).all()
+  per_base = np.bincount(k, minlength=3) * 50.0 / (intervals[:, 1] - intervals[:, 0])
+  assert 15 < per_base[1] < 21 and 15 < per_base[2] < 21, per_base
@@ -1,5 +1,6 @@
 import os
 import json
+import gzip
 
 from click.testing import CliRunner
 
@@ -62,4 +63,383 @@ def integration_test():
   result = runner.invoke(reads.cli, ['generate', param_file])
   assert result.exit_code == 0, result
   assert os.path.exists(read_prefix + '.fq')
-  assert os.path.exists(read_prefix + '_c.fq')
\ No newline at end of file
+  assert os.path.exists(read_prefix + '_c.fq')
+
+
+def write_inputs(name, params=None, samples=None):
+  """Write the parameter file, and the genome database if there are samples, for a run of 'reads'
+
+  :param name:    goes into the file names, so each test has its own files
+  :param params:  parameters to add to, or change in, the defaults. 'files' is merged with the default 'files'. A
+                  value of None takes the parameter out
+  :param samples: [(sample_name, [(index, gt) ...]) ...] variants of chromosome 1 for each sample, pointing into a
+                  master list of three variants. If None we write no database
+  :return: param_file, db_file, read_prefix, test_params. db_file is None if there are no samples
+  """
+  param_file = os.path.abspath(os.path.join(mitty.tests.data_dir, 'param_{:s}.json'.format(name)))
+  read_prefix = os.path.abspath(os.path.join(mitty.tests.data_dir, 'reads_{:s}'.format(name)))
+  test_params = {
+    "files": {
+      "reference_dir": mitty.tests.example_data_dir,
+      "output_prefix": read_prefix,
+      "interleaved": True
+    },
+    "rng": {
+      "master_seed": 1
+    },
+    "chromosomes": [1, 2],
+    "variants_only": False,
+    "corrupt": True,
+    "coverage": 2,
+    "coverage_per_block": 0.5,
+    "read_model": "simple_illumina",
+    "model_params": {
+      "read_len": 100,
+      "template_len_mean": 250,
+      "template_len_sd": 30,
+      "max_p_error": 0.01,
+      "k": 20
+    }
+  }
+
+  db_file = None
+  if samples is not None:
+    db_file = os.path.abspath(os.path.join(mitty.tests.data_dir, 'pop_{:s}.hdf5'.format(name)))
+    test_params['files']['dbfile'] = db_file
+    test_params['sample_name'] = samples[0][0]
+    r_seq = mio.Fasta(multi_dir=mitty.tests.example_data_dir)
+    ml = vr.VariantList([27, 1000, 5000], [28, 1001, 5010], ['T', 'A', 'CTTAGCATTA'], ['G', 'ACCGT', 'C'],
+                        [0.9, 0.9, 0.9])
+    ml.sort()
+    pl = vr.Population(fname=db_file, mode='w', in_memory=False, genome_metadata=r_seq.get_seq_metadata())
+    pl.set_master_list(chrom=1, master_list=ml)
+    for sample_name, indexes in samples:
+      pl.add_sample_chromosome(chrom=1, sample_name=sample_name, indexes=vr.l2ca(indexes))
+    pl.close()
+
+  for k, v in (params or {}).items():
+    if k == 'files':
+      test_params['files'].update(v)
+    elif v is None:
+      test_params.pop(k, None)
+    else:
+      test_params[k] = v
+  json.dump(test_params, open(param_file, 'w'))
+  return param_file, db_file, read_prefix, test_params
+
+
+def workers_test():
+  """'reads' gives the same output for any number of workers"""
+  param_file, db_file, read_prefix, test_params = write_inputs(
+    'workers', params={'chromosomes': [1, 2, 3, 4], 'coverage_per_block': 0.1}, samples=[('g0_s0', [(0, 2)])])
+
+  runner = CliRunner()
+  fastq = []
+  for workers in ['1', '3']:
+    result = runner.invoke(reads.cli, ['generate', param_file, '--workers', workers])
+    assert result.exit_code == 0, result
+    fastq.append([open(read_prefix + suffix).read() for suffix in ['.fq', '_c.fq']])
+  assert len(fastq[0][0]) > 0
+  assert fastq[0] == fastq[1]
+
+  # Block gzipped output compressed on several threads holds the same reads
+  test_params['files']['gzipped'] = True
+  json.dump(test_params, open(param_file, 'w'))
+  result = runner.invoke(reads.cli, ['generate', param_file, '--workers', '3', '--gzip-threads', '3'])
+  assert result.exit_code == 0, result
+  assert [gzip.open(read_prefix + suffix).read() for suffix in ['.fq.gz', '_c.fq.gz']] == fastq[0]
+
+  for suffix in ['.fq', '_c.fq', '.fq.gz', '_c.fq.gz']:
+    os.remove(read_prefix + suffix)
+  os.remove(param_file)
+  os.remove(db_file)
+
+
+def haplotype_cache_test():
+  """'reads' saves expanded haplotypes to the cache and gives the same reads when it loads them back"""
+  import shutil
+  param_file, db_file, read_prefix, test_params = write_inputs(
+    'hap_cache', params={'corrupt': False}, samples=[('g0_s0', [(0, 2), (1, 0), (2, 1)])])
+  cache_dir = os.path.abspath(os.path.join(mitty.tests.data_dir, 'hap_cache'))
+  r_seq = mio.Fasta(multi_dir=mitty.tests.example_data_dir)
+
+  runner = CliRunner()
+  result = runner.invoke(reads.cli, ['generate', param_file])
+  assert result.exit_code == 0, result
+  fastq = open(read_prefix + '.fq').read()
+
+  result = runner.invoke(reads.cli, ['generate', param_file, '--haplotype-cache', cache_dir])
+  assert result.exit_code == 0, result
+  cached = sorted(os.listdir(cache_dir))
+  assert len(cached) == 4, cached  # Two copies of each chromosome
+  assert open(read_prefix + '.fq').read() == fastq
+
+  sim = reads.ReadSimulator(mitty.tests.data_dir, test_params, haplotype_cache_dir=cache_dir)
+  for chrom in [1, 2]:
+    for cpy in [0, 1]:
+      hap = sim.get_haplotype(chrom, cpy)
+      ref_hap = reads.lib_reads.HaplotypeView(r_seq[chrom]['seq'], sim.inputs.pop.get_variant_master_list(chrom=chrom),
+                                              sim.inputs.pop.get_sample_variant_index_for_chromosome(chrom, 'g0_s0'),
+                                              cpy)
+      assert hap[:] == ref_hap[:]
+      assert (hap.variant_waypoints == ref_hap.variant_waypoints).all()
+  assert sim.haplotype_cache_hits == 4
+
+  result = runner.invoke(reads.cli, ['generate', param_file, '--haplotype-cache', cache_dir])
+  assert result.exit_code == 0, result
+  assert sorted(os.listdir(cache_dir)) == cached
+  assert open(read_prefix + '.fq').read() == fastq
+
+  shutil.rmtree(cache_dir)
+  os.remove(read_prefix + '.fq')
+  os.remove(param_file)
+  os.remove(db_file)
+
+
+def cohort_test():
+  """'reads' in cohort mode gives each sample the reads of a run on its own"""
+  param_file, db_file, read_prefix, test_params = write_inputs(
+    'cohort', samples=[('g0_s0', [(0, 2), (1, 0)]), ('g0_s1', [(1, 1), (2, 2)])])
+  sample_file = os.path.abspath(os.path.join(mitty.tests.data_dir, 'samples_cohort.txt'))
+
+  samples = [('g0_s0', None), ('g0_s1', None), ('g0_s1', 7)]
+  with open(sample_file, 'w') as fp:
+    fp.write('# sample  output prefix  seed\n')
+    for n, (sample_name, seed) in enumerate(samples):
+      fp.write('{:s} reads_cohort_{:d}{:s}\n'.format(sample_name, n, ' {:d}'.format(seed) if seed else ''))
+
+  runner = CliRunner()
+  fastq = []
+  for n, (sample_name, seed) in enumerate(samples):
+    test_params['sample_name'] = sample_name
+    test_params['rng']['master_seed'] = seed or 1
+    json.dump(test_params, open(param_file, 'w'))
+    result = runner.invoke(reads.cli, ['generate', param_file])
+    assert result.exit_code == 0, result
+    fastq.append([open(read_prefix + suffix).read() for suffix in ['.fq', '_c.fq']])
+  assert fastq[0] != fastq[1] != fastq[2]
+
+  test_params['sample_name'], test_params['rng']['master_seed'] = 'g0_s0', 1
+  json.dump(test_params, open(param_file, 'w'))
+  for workers in ['1', '2']:
+    result = runner.invoke(reads.cli, ['generate', param_file, '--samples', sample_file, '--workers', workers])
+    assert result.exit_code == 0, result
+    for n in range(len(samples)):
+      assert [open(read_prefix + '_{:d}'.format(n) + suffix).read() for suffix in ['.fq', '_c.fq']] == fastq[n]
+
+  for suffix in ['', '_0', '_1', '_2']:
+    os.remove(read_prefix + suffix + '.fq')
+    os.remove(read_prefix + suffix + '_c.fq')
+  for fname in [param_file, db_file, sample_file]:
+    os.remove(fname)
+
+
+def coverage_track_test():
+  """'reads' writes a coverage track that agrees with the truth BAM"""
+  import numpy as np
+  import pysam
+  import mitty.lib.coverage as coverage
+  param_file, db_file, read_prefix, _ = write_inputs(
+    'coverage', params={'files': {'truth_bam': True, 'coverage_track': True}, 'corrupt': False, 'coverage': 5,
+                        'coverage_per_block': 1, 'coverage_bin': 50},
+    samples=[('g0_s0', [(0, 2), (1, 0), (2, 1)])])
+  r_seq = mio.Fasta(multi_dir=mitty.tests.example_data_dir)
+
+  for workers in ['1', '2']:
+    result = CliRunner().invoke(reads.cli, ['generate', param_file, '--workers', workers])
+    assert result.exit_code == 0, result
+
+    bam_fp = pysam.AlignmentFile(read_prefix + '.truth.bam')
+    for chrom in [1, 2]:
+      seq_len = r_seq.get_seq_metadata()[chrom - 1]['seq_len']
+      per_base = np.zeros(seq_len, dtype=np.int64)
+      for cpy in [0, 1]:
+        counts, depth, bin_size = coverage.load_coverage(read_prefix + '.coverage.h5', chrom, cpy)
+        assert bin_size == 50 and counts.shape[0] == -(-seq_len // 50)
+        assert counts.sum() > 0
+        per_base_cpy = np.zeros(seq_len, dtype=np.int64)
+        for r in bam_fp.fetch(bam_fp.references[chrom - 1]):
+          if r.query_name.split('|')[2] == str(cpy):
+            per_base_cpy[r.reference_start:r.reference_end] += 1
+        assert counts.tolist() == np.add.reduceat(per_base_cpy, np.arange(0, seq_len, 50)).tolist(), (chrom, cpy)
+    bam_fp.close()
+
+  for suffix in ['.fq', '.coverage.h5', '.truth.bam', '.truth.bam.bai']:
+    os.remove(read_prefix + suffix)
+  os.remove(param_file)
+  os.remove(db_file)
+
+
+def targets_test():
+  """'reads' with a BED file of targets takes reads only from the (padded) targets"""
+  bed_file = os.path.abspath(os.path.join(mitty.tests.data_dir, 'targets.bed'))
+  r_seq = mio.Fasta(multi_dir=mitty.tests.example_data_dir)
+  seq_id = r_seq.get_seq_metadata()[0]['seq_id'].split(' ')[0]
+  with open(bed_file, 'w') as fp:
+    fp.write('track name=test\n')
+    fp.write('{:s}\t1000\t1500\n{:s}\t3000\t3200\n2\t500\t900\n'.format(seq_id, seq_id))
+  param_file, _, read_prefix, _ = write_inputs(
+    'targets', params={'files': {'targets': bed_file}, 'chromosomes': [1, 2, 3], 'target_padding': 100,
+                       'corrupt': False, 'coverage': 20, 'coverage_per_block': 1})
+
+  runner = CliRunner()
+  result = runner.invoke(reads.cli, ['generate', param_file])
+  assert result.exit_code == 0, result
+  allowed = {1: [(900, 1600), (2900, 3300)], 2: [(400, 1000)]}
+  n = 0
+  for line in open(read_prefix + '.fq'):
+    if line.startswith('@'):
+      _, chrom, _, _, pos, rlen = line[1:].split('|')[:6]
+      assert any(a <= int(pos) and int(pos) + int(rlen) <= b for a, b in allowed[int(chrom)]), line
+      n += 1
+  # 20x over 1700 padded target bases, but a template (about 250 bases) has to fit inside its target
+  bases, expected = n * 100.0, 20 * ((700 - 250) + (400 - 250) + (600 - 250))
+  assert 0.8 * expected < bases < 1.2 * expected, bases
+
+  for f in [param_file, bed_file, read_prefix + '.fq']:
+    os.remove(f)
+
+
+def bam_test():
+  """'reads' writes unaligned and truth BAMs holding the same reads as the FASTQ, the truth BAM placing them correctly"""
+  import pysam
+  import mitty.benchmarking.creed as creed
+  param_file, _, read_prefix, _ = write_inputs('bam', params={'files': {'unaligned_bam': True, 'truth_bam': True}})
+
+  runner = CliRunner()
+  result = runner.invoke(reads.cli, ['generate', param_file])
+  assert result.exit_code == 0, result
+
+  fastq = open(read_prefix + '_c.fq').read().splitlines()
+  unaligned = list(pysam.AlignmentFile(read_prefix + '.unaligned.bam', check_sq=False))
+  assert len(unaligned) == len(fastq) / 4 > 0
+  for n, rd in enumerate(unaligned):
+    assert rd.is_unmapped and rd.is_paired and rd.is_read1 == (n % 2 == 0)
+    assert '@' + rd.query_name + ('/1' if rd.is_read1 else '/2') == fastq[4 * n]
+    assert rd.query_sequence == fastq[4 * n + 1] and rd.qual == fastq[4 * n + 3]
+
+  ref = mio.Fasta(multi_dir=mitty.tests.example_data_dir)
+  truth = pysam.AlignmentFile(read_prefix + '.truth.bam')
+  assert truth.check_index()
+  last, n = (0, 0), 0
+  for rd in truth:
+    assert (rd.reference_id, rd.reference_start) >= last  # Sorted
+    last = (rd.reference_id, rd.reference_start)
+    chrom_c, pos_c, cigar_c = creed.analyze_read(rd, window=0)[11:14]
+    assert chrom_c and pos_c and cigar_c
+    seq = ref[rd.reference_id + 1]['seq'][rd.reference_start:rd.reference_end]
+    assert sum(a != b for a, b in zip(seq, rd.query_sequence)) < 10  # Only the odd read error
+    assert abs(rd.template_length) >= 100
+    n += 1
+  assert n == len(unaligned)
+
+  for suffix in ['.fq', '_c.fq', '.unaligned.bam', '.truth.bam', '.truth.bam.bai']:
+    os.remove(read_prefix + suffix)
+  os.remove(param_file)
+
+
+def compact_qnames_test():
+  """With compact qnames, analysis using the truth sidecar is the same as analysis using the full qnames"""
+  import pysam
+  import mitty.benchmarking.creed as creed
+  import mitty.lib.truth as truth
+  analysis = []
+  for compact in [False, True]:
+    param_file, _, read_prefix, _ = write_inputs(
+      'cq{:d}'.format(compact), params={'files': {'unaligned_bam': True, 'compact_qnames': compact}})
+    result = CliRunner().invoke(reads.cli, ['generate', param_file])
+    assert result.exit_code == 0, result
+
+    bam = pysam.AlignmentFile(read_prefix + '.unaligned.bam', check_sq=False)
+    truth_reader = truth.TruthReader(read_prefix + '.truth.h5') if compact else None
+    analysis.append([list(a) for _, a in creed.analyze_reads(bam, window=0, truth_reader=truth_reader)])
+    if compact:
+      assert len(truth_reader) == len(analysis[0])
+      assert open(read_prefix + '.fq').readline() == '@0/1\n'
+    for suffix in ['.fq', '_c.fq', '.unaligned.bam'] + (['.truth.h5'] if compact else []):
+      os.remove(read_prefix + suffix)
+    os.remove(param_file)
+
+  for a in analysis[0]:
+    a[7] = int(a[7])  # The mate read order is left as a string when parsed from the qname
+  assert len(analysis[0]) > 0 and analysis[0] == analysis[1]
+
+
+def max_mem_test():
+  """'reads generate --max-mem' plans the blocks and works without coverage_per_block"""
+  param_file, _, read_prefix, test_params = write_inputs('mem', params={'coverage_per_block': None})
+
+  result = CliRunner().invoke(reads.cli, ['generate', param_file, '--max-mem', '2G'])
+  assert result.exit_code == 0, result
+  assert len(open(read_prefix + '.fq').read().splitlines()) > 0
+
+  simulation = reads.ReadSimulator(os.path.dirname(param_file), test_params)
+  assert simulation.blocks_for_chromosome == {1: 1, 2: 1}
+  plan = simulation.plan_memory(2 << 30)
+  assert simulation.blocks_for_chromosome == plan.blocks == {1: 1, 2: 1}
+  assert simulation.queue_mem == plan.queue_mem
+  simulation.close()
+
+  test_params['coverage'] = 20000  # About 7M reads from chrom 1
+  simulation = reads.ReadSimulator(os.path.dirname(param_file), test_params)
+  small, large = simulation.plan_memory(256 << 20).blocks, simulation.plan_memory(2 << 30).blocks
+  assert small[1] > large[1] > 1 and small[1] > small[2]
+  simulation.close()
+
+  result = CliRunner().invoke(reads.cli, ['generate', param_file, '--max-mem', 'lots'])
+  assert result.exit_code != 0
+
+  for suffix in ['.fq', '_c.fq']:
+    os.remove(read_prefix + suffix)
+  os.remove(param_file)
+
+
+def n_free_reads_test():
+  """Templates are only placed on stretches without N, with the asked for coverage over them"""
+  import numpy as np
+  import mitty.lib.reads as lib_reads
+  from mitty.plugins.reads.base_plugin import as_v2
+  import mitty.plugins.reads.simple_illumina_plugin as ip
+  import mitty.plugins.reads.simple_sequential_plugin as sp
+  rng = np.random.RandomState(3)
+  seq = np.array(list('ACGT'))[rng.randint(4, size=60000)].tostring()
+  seq = seq[:10000] + 'N' * 10000 + seq[20000:40000] + 'N' * 1000 + seq[41000:]
+  n_free = lib_reads.n_free_intervals(seq)
+  # simple_sequential puts a template (two reads) every read_len / coverage bases
+  for mdl, expected in [(ip.Model(read_len=50, template_len_mean=150, template_len_sd=10), 10),
+                        (sp.Model(read_len=50, template_len=150), 20)]:
+    rd, _ = reads.generate_reads(seq, None, [], 0, as_v2(mdl), 10, False, np.random.RandomState(1), n_free=n_free)
+    assert len(rd) > 0
+    assert all('N' not in r for r in rd.as_strings(rd.seq))
+    cov = rd.read_len.sum() / float((n_free[:, 1] - n_free[:, 0]).sum())
+    assert 0.8 * expected < cov < 1.05 * expected, (mdl, cov)
+
+
+def write_reads_to_file_test():
+  """Batch formatted FASTQ is identical to the read by read Python writer"""
+  import io
+  import numpy as np
+  from mitty.plugins.reads.base_plugin import ReadModel, ReadBatch
+  rng = np.random.RandomState(1)
+  rd = np.recarray(dtype=ReadModel.dtype, shape=10)
+  rd['read_order'] = rng.randint(2, size=10)
+  rd['perfect_reads'] = [np.array(list('ACGT'))[rng.randint(4, size=l)].tostring() for l in rng.randint(1, 200, size=10)]
+  rd['read_len'] = [len(s) for s in rd['perfect_reads']]
+  rd['corrupt_reads'] = [s.lower() for s in rd['perfect_reads']]
+  rd['phred'] = ['5' * len(s) for s in rd['perfect_reads']]
+  pos = rng.randint(1, 2 ** 31, size=10).tolist()
+  cigars = ['{:d}='.format(len(s)) for s in rd['perfect_reads']]
+  # Fixed width reads sharing one row of qualities, as simple_illumina gives them
+  seq = np.fromstring('ACGT', dtype=np.uint8)[rng.randint(4, size=(10, 30))]
+  fixed = ReadBatch(np.zeros(10), np.full(10, 30), rd['read_order'], seq, seq + 32, np.arange(33, 63))
+
+  for batch, cig in [(ReadBatch.from_recarray(rd), cigars), (fixed, ['30='] * 10)]:
+    for paired, interleaved in [(True, True), (True, False), (False, False)]:
+      out = []
+      for writer in [reads.write_reads_to_file, reads.py_write_reads_to_file]:
+        fp = [io.BytesIO() for _ in range(4)]
+        if interleaved or not paired:
+          fp[1], fp[3] = (fp[0], fp[2]) if interleaved else (None, None)
+        tc = writer(fp[0], fp[1], fp[2], fp[3], batch, paired, pos, cig, 3, 1, 1000)
+        out.append((tc, [f.getvalue() if f is not None else None for f in fp]))
+      assert out[0] == out[1], (batch.fixed_width, paired, interleaved)
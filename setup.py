@@ -21,7 +21,8 @@ setup(
                                  #'low_entropy_insert = mitty.plugins.variants.low_entropy_insert_plugin'
                                  ],
       'mitty.plugins.population': ['standard = mitty.plugins.population.standard',
-                                   'vn = mitty.plugins.population.vn'],
+                                   'vn = mitty.plugins.population.vn',
+                                   'forward = mitty.plugins.population.forward'],
       'mitty.plugins.reads': ['simple_sequential = mitty.plugins.reads.simple_sequential_plugin',
                               'simple_illumina = mitty.plugins.reads.simple_illumina_plugin'],
       # Command line scripts
@@ -48,7 +49,7 @@ setup(
       'numpy>=1.9.0',
       'docopt>=0.6.2',
       'click>=3.3',
-      'pysam>=0.8.1',
+      'pysam>=0.14',
       'h5py>=2.5.0',
       'matplotlib>=1.3.0',
       'scipy'